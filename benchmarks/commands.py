@@ -0,0 +1,319 @@
+"""Measures the command handlers of the real cogs against a fake guild and a local database.
+
+Run from the root of the repository:
+
+    python -m benchmarks.commands --sizes 10 100 1000 --iterations 20 --output bench.json
+
+Results are saved as JSON, with throughput, p50/p99 latency, time spent in the database, SQL statements and Discord
+API calls of each command for each Company size, so that two runs can be diffed.
+
+--backends compares the database backends: memory is SQLite in memory, sqlite is a SQLite file in a temporary
+directory, mysql uses the [Database] section of --mysql-config. The mysql backend drops all the tables of the
+configured database at the end of each run, never point it to the production database."""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import math
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+
+import discord
+
+from benchmarks.fakes import FakeContext, FakeGuild
+from companies import CompaniesClient, Config
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default_config.ini')
+COMPANY_NAME = 'Bench'
+FACTION = 'Fazione1'
+
+
+class BenchClient(CompaniesClient):
+    """Bot connected to FakeGuilds instead of the Discord gateway"""
+
+    def __init__(self, guilds):
+        super().__init__(config_path=CONFIG_PATH, case_insensitive=True, help_command=None,
+                         intents=discord.Intents.default())
+        self.fake_guilds = {guild.id: guild for guild in guilds}
+
+    @property
+    def guilds(self):
+        return list(self.fake_guilds.values())
+
+    def get_guild(self, guild_id):
+        return self.fake_guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        for guild in self.fake_guilds.values():
+            channel = guild.get_channel(channel_id) or guild.dm_channels.get(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    async def shutdown(self, drop_tables):
+        self.remove_cog('User')
+        if drop_tables:
+            await self.db.run(self.db.Base.metadata.drop_all, self.db.engine)
+        self.db.executor.shutdown()
+
+
+class World:
+    """A guild with a Company of the given size, its staff and the bot running on it.
+
+    With more than one guild the first one uses the top level sections of the config and the others their own
+    section of [Guilds], every guild gets the same Company. for_guild returns the World seen from one of them."""
+
+    def __init__(self, size, latency, backend, mysql_config, guilds=1):
+        self.size = size
+        self.backend = backend
+        self.guilds = [FakeGuild(latency) for _ in range(guilds)]
+        self.guild = self.guilds[0]
+        self.bot = BenchClient(self.guilds)
+        self.joined = 0
+        self.views = {}
+
+        cfg = self.bot.cfg
+        if backend == 'mysql':
+            cfg['Database'] = Config().load(mysql_config)['Database']
+        elif backend == 'sqlite':
+            cfg['Database']['backend'] = 'sqlite'
+            cfg['Database']['path'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        else:
+            cfg['Database']['backend'] = 'sqlite'
+            cfg['Database']['path'] = ':memory:'
+        self.configure_guild(self.guild, cfg)
+        for guild in self.guilds[1:]:
+            cfg['Guilds'][str(guild.id)] = {}
+            self.configure_guild(guild, cfg['Guilds'][str(guild.id)])
+        self.bot.reload_settings()
+
+    def configure_guild(self, guild, sections):
+        """Creates the special roles and channels of the guild and records them in sections"""
+        cfg = self.bot.cfg
+        values = {
+            'SpecialRoles': {key: guild.add_role(key).id for key in cfg['SpecialRoles']},
+            'Factions': {name: {'staff_role': guild.add_role('staff').id, 'member_role': guild.add_role('member').id,
+                                'emoji': faction['emoji']} for name, faction in cfg['Factions'].items()},
+            'Channels': {'company_apply_channel': guild.add_text_channel('apply').id,
+                         'user_command_channel': guild.add_text_channel('commands').id},
+            'CompanyCreationSurvey': {'category': guild.add_category('surveys').id},
+        }
+        for section, entries in values.items():
+            if section not in sections:
+                sections[section] = {}
+            for key, value in entries.items():
+                if isinstance(value, dict) and key in sections[section]:
+                    sections[section][key].update(value)
+                else:
+                    sections[section][key] = value
+
+    async def start(self):
+        await self.bot.initialize()
+        self.manager = self.bot.get_cog('CompanyManager')
+        self.user = self.bot.get_cog('User')
+        self.admin = self.bot.get_cog('Admin')
+        for guild in self.guilds:
+            view = self if guild is self.guild else copy.copy(self)
+            view.guild = guild
+            await view.populate()
+            self.views[guild.id] = view
+
+    async def populate(self):
+        config = self.bot.get_guild_config(self.guild)
+        self.commands_channel = self.guild.get_channel(config.user_command_channel_id)
+        self.survey_category = self.guild.get_channel(config.survey_category_id)
+        self.administrator = self.guild.add_member('admin', administrator=True)
+        self.approver = self.guild.add_member('approver', [config.roles['approve_companies']])
+        self.governatore = await self.add_company(COMPANY_NAME, 'BNCH', self.size)
+
+    def for_guild(self, guild):
+        return self.views[guild.id]
+
+    def new_member(self, roles=()):
+        self.joined += 1
+        return self.guild.add_member(f'member{self.joined}', roles)
+
+    async def add_company(self, name, tag, size):
+        """Creates a Company with its channels and size members, returns its Governatore"""
+        role = self.guild.add_role(name)
+        category = self.guild.add_category(name)
+        notify_channel = self.guild.add_text_channel(
+            self.bot.cfg['CompaniesNotify']['channel_name'] + f'-{tag}', category.id)
+        self.guild.add_text_channel('voice', category.id, 1)
+        roles = self.bot.get_guild_config(self.guild).roles
+        governatore = self.new_member([roles['to_add'], roles['governatore'], role])
+        await self.manager.create_company(name, tag, category, role, governatore, notify_channel)
+
+        members = [self.new_member([roles['to_add'], role]) for _ in range(size - 1)]
+        await self.bot.db.run(self.seed_members, name, tag, members)
+        self.manager.memberships.update(((self.guild.id, member.id), name) for member in members)
+        return governatore
+
+    def seed_members(self, company_name, tag, members):
+        session = self.bot.db.Session()
+        session.add(self.bot.db.CompanyName(guild_id=self.guild.id, name=company_name, tag=tag))
+        session.bulk_insert_mappings(self.bot.db.User, [{'guild_id': self.guild.id, 'member_id': member.id,
+                                                         'company_name': company_name} for member in members])
+        session.commit()
+        session.close()
+
+
+#
+# Operations, each returns the coroutine to measure after running its untimed setup
+#
+
+async def recruit(world, i):
+    ctx = FakeContext(world.governatore, world.commands_channel)
+    return world.user.recruit(ctx, world.new_member())
+
+
+async def accept_invite(world, i):
+    member = world.new_member()
+    ctx = FakeContext(world.governatore, world.commands_channel)
+    await world.user.recruit(ctx, member)
+    payload = discord.RawReactionActionEvent({'message_id': member.dm_channel.last_message_id,
+                                              'channel_id': member.dm_channel.id, 'user_id': member.id},
+                                             discord.PartialEmoji(name=world.bot.cfg['Emoji']['check']),
+                                             'REACTION_ADD')
+    return world.bot.on_raw_reaction_add(payload)
+
+
+async def list_members(world, i):
+    ctx = FakeContext(world.governatore, world.commands_channel)
+    return world.user.list_members(ctx)
+
+
+async def create_company(world, i):
+    ctx = FakeContext(world.new_member(), world.commands_channel)
+    return world.user.create_company(ctx, f'Richiesta{i}', f'R{i:03}')
+
+
+async def approve_company(world, i):
+    requester = world.new_member()
+    channel = world.guild.add_text_channel(f'richiesta-{i}', world.survey_category.id)
+    abort_message = await channel.send()
+    await world.manager.reserve_company_request(requester, f'Nuova{i}', f'N{i:03}')
+    await world.manager.create_company_request(requester, f'Nuova{i}', f'N{i:03}', channel, abort_message)
+    approval_message = await channel.send()
+    await world.manager.set_request_approval_id(requester, approval_message)
+    payload = discord.RawReactionActionEvent({'message_id': approval_message.id, 'channel_id': channel.id,
+                                              'user_id': world.approver.id, 'guild_id': world.guild.id},
+                                             discord.PartialEmoji(name=world.bot.cfg['Emoji']['check']),
+                                             'REACTION_ADD')
+    payload.member = world.approver
+    return world.bot.on_raw_reaction_add(payload)
+
+
+async def delete_company(world, i):
+    name = f'Eliminata{i}'
+    await world.add_company(name, f'E{i:03}', world.size)
+    ctx = FakeContext(world.administrator, world.commands_channel)
+    return world.admin.company_delete(ctx, name)
+
+
+async def set_faction(world, i):
+    ctx = FakeContext(world.administrator, world.commands_channel)
+    if i > 0:
+        await run_with_tasks(world.admin.kick_from_faction(ctx, COMPANY_NAME))
+    return world.admin.set_faction(ctx, COMPANY_NAME, FACTION)
+
+
+OPERATIONS = {
+    'recluta': recruit,
+    'accetta-invito': accept_invite,
+    'lista-membri': list_members,
+    'crea-compagnia': create_company,
+    'approvazione': approve_company,
+    'company-delete': delete_company,
+    'set-faction': set_faction,
+}
+
+
+async def run_with_tasks(coro):
+    """Awaits the coroutine and the background tasks it starts, like the role jobs"""
+    before = asyncio.all_tasks()
+    await coro
+    await asyncio.gather(*(asyncio.all_tasks() - before))
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+async def measure(operation, size, iterations, latency, backend, mysql_config):
+    world = World(size, latency, backend, mysql_config)
+    await world.start()
+    try:
+        samples = []
+        calls = 0
+        db_time = 0.0
+        statements = 0
+        for i in range(iterations):
+            coro = await OPERATIONS[operation](world, i)
+            calls_before = world.guild.calls
+            with world.bot.metrics.track('benchmark', operation) as invocation:
+                start = time.perf_counter()
+                await run_with_tasks(coro)
+                samples.append(time.perf_counter() - start)
+            calls += world.guild.calls - calls_before
+            db_time += invocation.db_time
+            statements += invocation.statements
+            if world.guild.errors > 0:
+                raise RuntimeError(f"{operation} replied with an error embed, the benchmark is not measuring it")
+    finally:
+        await world.bot.shutdown(drop_tables=backend == 'mysql')
+
+    return {
+        'backend': backend,
+        'operation': operation,
+        'members': size,
+        'iterations': iterations,
+        'throughput': iterations / sum(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'db_ms': db_time / iterations * 1000,
+        'sql_statements': statements / iterations,
+        'discord_calls': calls / iterations,
+    }
+
+
+async def main(args):
+    results = []
+    for backend in args.backends:
+        for size in args.sizes:
+            for operation in args.operations:
+                result = await measure(operation, size, args.iterations, args.latency, backend, args.mysql_config)
+                results.append(result)
+                print(f"{backend:>6} {operation:>15} {size:>5} members: {result['throughput']:8.1f} op/s, "
+                      f"p50 {result['p50_ms']:8.2f} ms, p99 {result['p99_ms']:8.2f} ms, "
+                      f"database {result['db_ms']:7.2f} ms ({result['sql_statements']:.1f} statements), "
+                      f"{result['discord_calls']:.1f} Discord calls")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'latency': args.latency,
+            'results': results,
+        }, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the Companies command handlers")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help="Number of members of the Company")
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS.keys(), default=list(OPERATIONS.keys()))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Simulated seconds of round trip of each Discord API call")
+    parser.add_argument('--backends', nargs='+', choices=('memory', 'sqlite', 'mysql'), default=['memory'])
+    parser.add_argument('--mysql-config', default='config.ini',
+                        help="Config file with the [Database] used by the mysql backend")
+    parser.add_argument('--output', default='bench.json')
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
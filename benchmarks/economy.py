@@ -0,0 +1,112 @@
+"""Stress test of the economy commands under concurrent donations and transfers.
+
+Run from the root of the repository:
+
+    python -m benchmarks.economy --donations 1000 --size 50 --backend mysql
+
+The members of a Company get a deposit, then run all the donations and transfers through the real User cog at the
+same time. The balances are checked against the expected totals, a lost update would make them differ. Every
+member then tries to donate its whole balance twice at once, only one of the two may succeed, and members the bot has
+never seen receive two deposits at once, which both insert their row.
+
+Only --backend mysql checks these properties: it runs the statements on concurrent connections, see
+benchmarks.commands for its configuration. The memory and sqlite backends have a single database thread, which runs
+every statement one after the other, so they only measure the throughput."""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from benchmarks.commands import World, COMPANY_NAME
+from benchmarks.fakes import FakeContext
+
+DEPOSIT = 1000
+
+
+async def main(args):
+    world = World(args.size, 0.0, args.backend, args.mysql_config)
+    await world.start()
+    guild = world.guild
+    members = [guild.get_member(member_id)
+               for member_id in await world.manager.get_company_members(guild.id, COMPANY_NAME)]
+    admin_ctx = FakeContext(world.administrator, world.commands_channel)
+    await asyncio.gather(*(world.admin.deposit(admin_ctx, member, DEPOSIT) for member in members))
+
+    # Amounts are small enough that every donation and transfer can be afforded
+    rng = random.Random(args.seed)
+    expected = {member.id: DEPOSIT for member in members}
+    donated = 0
+    operations = []
+    for i in range(args.donations):
+        donor = rng.choice(members)
+        amount = rng.randint(1, 5)
+        expected[donor.id] -= amount
+        donated += amount
+        operations.append(world.user.donate(FakeContext(donor, world.commands_channel), amount))
+        if i % args.transfer_every == 0:
+            sender, receiver = rng.sample(members, 2)
+            expected[sender.id] -= amount
+            expected[receiver.id] += amount
+            operations.append(world.user.transfer(FakeContext(sender, world.commands_channel), receiver, amount))
+    rng.shuffle(operations)
+
+    start = time.perf_counter()
+    await asyncio.gather(*operations)
+    elapsed = time.perf_counter() - start
+
+    problems = []
+    if guild.errors > 0:
+        problems.append(f"{guild.errors} operations failed")
+    balances = {member.id: await world.manager.get_balance(member) for member in members}
+    company_balance = next(iter(balances.values()))[2]
+    if company_balance != donated:
+        problems.append(f"Company balance {company_balance:g} instead of {donated}")
+    if sum(donations for _, donations, _ in balances.values()) != donated:
+        problems.append("donations of the members don't add up to the Company balance")
+    wrong = [member_id for member_id, (balance, _, _) in balances.items() if balance != expected[member_id]]
+    if len(wrong) > 0:
+        problems.append(f"{len(wrong)} members with a wrong balance")
+
+    # Double spending: both donations pass any check made before the other one is written
+    errors_before = guild.errors
+    await asyncio.gather(*(world.user.donate(FakeContext(member, world.commands_channel), expected[member.id])
+                           for member in members for _ in range(2) if expected[member.id] > 0))
+    spenders = sum(1 for balance in expected.values() if balance > 0)
+    if guild.errors - errors_before != spenders:
+        problems.append(f"{guild.errors - errors_before} double donations rejected instead of {spenders}")
+    balances = [await world.manager.get_balance(member) for member in members]
+    if any(balance != 0 for balance, _, _ in balances):
+        problems.append("members with a balance left or below zero")
+
+    # First deposits: both find no row to update and insert it
+    newcomers = [world.new_member() for _ in range(args.size)]
+    errors_before = guild.errors
+    await asyncio.gather(*(world.admin.deposit(admin_ctx, member, DEPOSIT) for member in newcomers for _ in range(2)))
+    if guild.errors > errors_before:
+        problems.append(f"{guild.errors - errors_before} first deposits failed")
+    balances = [await world.manager.get_balance(member) for member in newcomers]
+    if any(balance != 2 * DEPOSIT for balance, _, _ in balances):
+        problems.append("new members with a wrong balance after two deposits")
+    await world.bot.shutdown(drop_tables=args.backend == 'mysql')
+
+    print(f"{len(operations)} concurrent donations and transfers on {args.backend} in {elapsed:.2f}s "
+          f"({len(operations) / elapsed:.0f} op/s), {donated} donated by {len(members)} members")
+    if args.backend != 'mysql':
+        print(f"The {args.backend} backend runs one statement at a time, use --backend mysql to check for lost updates")
+    if len(problems) > 0:
+        raise SystemExit(f"Balances inconsistent: {', '.join(problems)}")
+    print("Balances consistent")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stress tests the economy commands with concurrent donations")
+    parser.add_argument('--donations', type=int, default=1000)
+    parser.add_argument('--transfer-every', type=int, default=4, help="Donations between two transfers")
+    parser.add_argument('--size', type=int, default=50, help="Number of members of the Company")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=('memory', 'sqlite', 'mysql'), default='memory')
+    parser.add_argument('--mysql-config', default='config.ini',
+                        help="Config file with the [Database] used by the mysql backend")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
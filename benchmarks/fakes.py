@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import discord
+
+# Snowflakes are hashed as id >> 22, generated ids keep the low bits clear so that they hash differently
+_ids = itertools.count(1 << 20)
+# Default of the keyword arguments that can be set to None
+_UNSET = object()
+
+
+def next_id():
+    return next(_ids) << 22
+
+
+class FakeGuild:
+    """In-memory guild with the subset of the discord.py API used by the cogs. Every call that would hit the Discord
+    API is counted and waits latency seconds, to simulate the round trip."""
+
+    def __init__(self, latency=0.0):
+        self.id = next_id()
+        self.owner_id = next_id()
+        self.latency = latency
+        self.calls = 0
+        # Error embeds sent by the bot
+        self.errors = 0
+        self._roles = dict()
+        self._channels = dict()
+        self._members = dict()
+        # DM channels of the members, the bot finds them by id like the private channels in its cache
+        self.dm_channels = dict()
+        self.default_role = FakeRole(self, '@everyone', default=True)
+
+    async def request(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def add_role(self, name):
+        role = FakeRole(self, name)
+        self._roles[role.id] = role
+        return role
+
+    def add_member(self, name, roles=(), administrator=False):
+        member = FakeMember(self, name, roles, administrator)
+        self._members[member.id] = member
+        return member
+
+    def add_text_channel(self, name, category_id=None, position=0):
+        channel = FakeTextChannel(self, name, category_id, position)
+        self._channels[channel.id] = channel
+        return channel
+
+    def add_category(self, name):
+        category = FakeCategory(self, name)
+        self._channels[category.id] = category
+        return category
+
+    async def create_role(self, name, **fields):
+        await self.request()
+        return self.add_role(name)
+
+    async def create_category(self, name, **fields):
+        await self.request()
+        return self.add_category(name)
+
+
+class FakeRole:
+    def __init__(self, guild, name, default=False):
+        self.guild = guild
+        self.id = guild.id if default else next_id()
+        self.name = name
+        self.default = default
+
+    @property
+    def mention(self):
+        return f'<@&{self.id}>'
+
+    def is_default(self):
+        return self.default
+
+    async def delete(self):
+        await self.guild.request()
+        self.guild._roles.pop(self.id, None)
+
+
+class FakeMember:
+    def __init__(self, guild, name, roles=(), administrator=False):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name
+        self.nick = None
+        self.discriminator = '0000'
+        self.avatar_url = ''
+        self.bot = False
+        self.roles = [guild.default_role, *roles]
+        self.guild_permissions = SimpleNamespace(administrator=administrator)
+        self.dm_channel = None
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    @property
+    def mention(self):
+        return f'<@!{self.id}>'
+
+    async def edit(self, roles=None, nick=_UNSET, **fields):
+        await self.guild.request()
+        if roles is not None:
+            self.roles = [self.guild.default_role, *roles]
+        if nick is not _UNSET:
+            self.nick = nick
+
+    async def send(self, content=None, embed=None):
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(self)
+            self.guild.dm_channels[self.dm_channel.id] = self.dm_channel
+        return await self.dm_channel.send(content, embed=embed)
+
+
+class FakeDMChannel:
+    def __init__(self, recipient):
+        self.guild = recipient.guild
+        self.id = next_id()
+        self.recipient = recipient
+        self.last_message_id = None
+
+    async def send(self, content=None, embed=None):
+        await self.guild.request()
+        message = FakeMessage(self.guild, content, embed, self)
+        self.last_message_id = message.id
+        return message
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self.guild, channel=self, message_id=message_id)
+
+
+class FakeMessage:
+    def __init__(self, guild, content=None, embed=None, channel=None, message_id=None, author=None):
+        if embed is not None and embed.colour == discord.Colour.red():
+            guild.errors += 1
+        self.guild = guild
+        self.id = message_id if message_id is not None else next_id()
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+
+    async def add_reaction(self, emoji):
+        await self.guild.request()
+
+    async def remove_reaction(self, emoji, member):
+        await self.guild.request()
+
+    async def edit(self, content=None, embed=None):
+        await self.guild.request()
+        self.embeds = [embed] if embed is not None else self.embeds
+
+    async def delete(self):
+        await self.guild.request()
+
+
+class FakeTextChannel(discord.TextChannel):
+    def __init__(self, guild, name, category_id=None, position=0):
+        self.guild = guild
+        self.id = next_id()
+        # Discord normalizes the names of text channels
+        self.name = name.lower().replace(' ', '-')
+        self.category_id = category_id
+        self.position = position
+
+    async def send(self, content=None, embed=None):
+        await self.guild.request()
+        return FakeMessage(self.guild, content, embed, self)
+
+    async def edit(self, name=None, **fields):
+        await self.guild.request()
+        if name is not None:
+            self.name = name
+
+    async def delete(self):
+        await self.guild.request()
+        self.guild._channels.pop(self.id, None)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, name, category_id=None, position=0):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name
+        self.category_id = category_id
+        self.position = position
+
+    async def delete(self):
+        await self.guild.request()
+        self.guild._channels.pop(self.id, None)
+
+
+class FakeCategory(discord.CategoryChannel):
+    def __init__(self, guild, name):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name
+        self.category_id = None
+        self.position = 0
+
+    @property
+    def channels(self):
+        channels = [ch for ch in self.guild._channels.values() if ch.category_id == self.id]
+        channels.sort(key=lambda ch: ch.position)
+        return channels
+
+    @property
+    def text_channels(self):
+        return [ch for ch in self.channels if isinstance(ch, FakeTextChannel)]
+
+    async def create_text_channel(self, name, overwrites=None, position=0, **fields):
+        await self.guild.request()
+        return self.guild.add_text_channel(name, self.id, position)
+
+    async def create_voice_channel(self, name, overwrites=None, position=0, **fields):
+        await self.guild.request()
+        channel = FakeVoiceChannel(self.guild, name, self.id, position)
+        self.guild._channels[channel.id] = channel
+        return channel
+
+    async def edit(self, name=None, **fields):
+        await self.guild.request()
+        if name is not None:
+            self.name = name
+
+    async def delete(self):
+        await self.guild.request()
+        self.guild._channels.pop(self.id, None)
+
+
+class FakeContext:
+    """Invocation context of a command sent by author in channel"""
+
+    def __init__(self, author, channel):
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+        self.command = SimpleNamespace(reset_cooldown=lambda ctx: None)
+
+    async def send(self, content=None, embed=None):
+        return await self.channel.send(content, embed=embed)
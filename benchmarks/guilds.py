@@ -0,0 +1,92 @@
+"""Load test of a bot serving many guilds at once.
+
+Run from the root of the repository:
+
+    python -m benchmarks.guilds --guilds 50 --iterations 10
+
+Every guild has its own roles and channels in [Guilds] and a Company with the same name. The guilds recruit members,
+open and approve Company requests with the same names and set the faction of their Company concurrently, then the
+data of each guild is checked to be untouched by the others."""
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.commands import World, COMPANY_NAME, FACTION, accept_invite, create_company, approve_company, \
+    set_faction
+
+OPERATIONS = (accept_invite, create_company, approve_company)
+
+
+async def load_guild(world, iterations):
+    for i in range(iterations):
+        for operation in OPERATIONS:
+            await (await operation(world, i))
+    await (await set_faction(world, 0))
+
+
+async def check_guild(world, iterations):
+    """Returns the list of problems found in the data of the guild"""
+    guild = world.guild
+    config = world.bot.get_guild_config(guild)
+    problems = []
+    if guild.errors > 0:
+        problems.append(f"{guild.errors} error embeds")
+
+    companies = set(await world.manager.get_company_list(guild.id))
+    expected = {COMPANY_NAME, *(f'Nuova{i}' for i in range(iterations))}
+    if companies != expected:
+        problems.append(f"Companies {sorted(companies ^ expected)} don't match")
+
+    members = await world.manager.get_company_members(guild.id, COMPANY_NAME)
+    if len(members) != world.size + iterations:
+        problems.append(f"{len(members)} members instead of {world.size + iterations}")
+    if any(guild.get_member(member_id) is None for member_id in members):
+        problems.append("members of other guilds in the Company")
+
+    if config.faction_roles[FACTION]['staff'] not in world.governatore.roles:
+        problems.append("the Governatore doesn't have the faction role")
+    for member in guild._members.values():
+        if any(role.guild is not guild for role in member.roles):
+            problems.append(f"{member.name} has roles of other guilds")
+            break
+    return problems
+
+
+async def main(args):
+    world = World(args.size, args.latency, 'memory', None, guilds=args.guilds)
+    await world.start()
+    views = [world.for_guild(guild) for guild in world.guilds]
+    calls_before = sum(guild.calls for guild in world.guilds)
+
+    before = asyncio.all_tasks()
+    start = time.perf_counter()
+    await asyncio.gather(*(load_guild(view, args.iterations) for view in views))
+    # The role jobs started by set-faction run in the background
+    await asyncio.gather(*(asyncio.all_tasks() - before))
+    elapsed = time.perf_counter() - start
+
+    calls = sum(guild.calls for guild in world.guilds) - calls_before
+    problems = {view.guild.id: await check_guild(view, args.iterations) for view in views}
+    await world.bot.shutdown(drop_tables=False)
+
+    operations = args.guilds * (args.iterations * len(OPERATIONS) + 1)
+    print(f"{args.guilds} guilds, {operations} operations in {elapsed:.2f}s ({operations / elapsed:.0f} op/s), "
+          f"{calls} Discord calls")
+    failed = {guild_id: found for guild_id, found in problems.items() if len(found) > 0}
+    for guild_id, found in failed.items():
+        print(f"Guild {guild_id}: {', '.join(found)}")
+    if len(failed) > 0:
+        raise SystemExit(f"{len(failed)} guilds with data of other guilds")
+    print("Data of every guild isolated")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load tests the bot serving many guilds concurrently")
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=10, help="Operations of each kind run in each guild")
+    parser.add_argument('--size', type=int, default=10, help="Number of members of the Company of each guild")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Simulated seconds of round trip of each Discord API call")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,130 @@
+"""Measures the leaderboards and checks them against the rankings recomputed by the database.
+
+Run from the root of the repository:
+
+    python -m benchmarks.leaderboards --size 5000 --companies 200 --donations 20000
+
+A Company of --size members and --companies smaller ones receive random donations, then classifica and
+classifica-compagnie are measured while the rankings keep changing, next to the indexed top-N queries and to a full
+scan and sort of the users table. Finally members leave, a Company is deleted and companies-leaderboard-check must
+find the rankings in sync."""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from benchmarks.commands import World, COMPANY_NAME
+from benchmarks.fakes import FakeContext
+
+# Companies with the same balance, whose names sort differently by code point and by a case insensitive collation
+TIED_NAMES = ('Zeta', 'alfa', 'Bravo', 'Ärger', 'ébano', 'Émile')
+
+
+def full_recompute(db, guild_id, company_name, limit):
+    """Ranking of the donors as computed without the leaderboards: every user read and sorted"""
+    session = db.Session()
+    rows = session.query(db.User.member_id, db.User.company_name, db.User.company_donations) \
+        .filter(db.User.guild_id == guild_id).all()
+    session.close()
+    ranked = sorted(((row.company_donations, row.member_id) for row in rows
+                     if row.company_name == company_name and row.company_donations > 0), reverse=True)
+    return [(member_id, donations) for donations, member_id in ranked[:limit]]
+
+
+async def timed(coro_factory, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await coro_factory()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+async def main(args):
+    world = World(args.size, 0.0, args.backend, None)
+    await world.start()
+    guild = world.guild
+    manager = world.manager
+    companies = [COMPANY_NAME]
+    for i in range(args.companies):
+        await world.add_company(f'Classifica{i}', f'L{i:03}', 5)
+        companies.append(f'Classifica{i}')
+
+    members = []
+    for name in companies:
+        members.extend(guild.get_member(member_id)
+                       for member_id in await manager.get_company_members(guild.id, name))
+    await asyncio.gather(*(manager.deposit(member, args.donations) for member in members))
+    rng = random.Random(args.seed)
+    # Half the donations come from the members of the big Company, so that its ranking keeps changing
+    big = members[:args.size]
+    donations = [(rng.choice(big if i % 2 == 0 else members), rng.randint(1, 100)) for i in range(args.donations)]
+    start = time.perf_counter()
+    await asyncio.gather(*(manager.donate(member, manager.memberships[(guild.id, member.id)], amount)
+                           for member, amount in donations))
+    donate_ms = (time.perf_counter() - start) / len(donations) * 1000
+
+    ctx = FakeContext(world.governatore, world.commands_channel)
+    cached_ms = await timed(lambda: world.user.donors_leaderboard(ctx), args.repeat)
+    companies_ms = await timed(lambda: world.user.companies_leaderboard(ctx), args.repeat)
+
+    async def donate_and_show():
+        donor = rng.choice(big)
+        await manager.donate(donor, COMPANY_NAME, 1000)
+        await world.user.donors_leaderboard(ctx)
+    changing_ms = await timed(donate_and_show, args.repeat)
+
+    session = world.bot.db.Session()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        indexed = manager.query_top_donors(session, guild.id, COMPANY_NAME)
+    indexed_ms = (time.perf_counter() - start) / args.repeat * 1000
+    session.close()
+    start = time.perf_counter()
+    full = full_recompute(world.bot.db, guild.id, COMPANY_NAME, len(indexed))
+    full_ms = (time.perf_counter() - start) * 1000
+
+    problems = []
+    if manager.get_donor_leaderboard(guild.id, COMPANY_NAME).top() != indexed or indexed != full:
+        problems.append("the donors ranking differs from the recomputed one")
+    # Richer than every other Company, so that the whole tie is in the top entries
+    tied_balance = 10 ** 9
+    for i, name in enumerate(TIED_NAMES):
+        governatore = await world.add_company(name, f'P{i:03}', 1)
+        await manager.deposit(governatore, tied_balance)
+        await manager.donate(governatore, name, tied_balance)
+    session = world.bot.db.Session()
+    ranked = manager.query_top_companies(session, guild.id)
+    session.close()
+    if manager.get_company_leaderboard(guild.id).top() != ranked:
+        problems.append("the Companies with the same balance are ranked differently than by the database")
+    # Members leaving and a Company deleted must update the rankings too
+    for member in [member for member in big if member is not world.governatore][:args.repeat]:
+        await world.user.remove_from_company(member)
+    admin_ctx = FakeContext(world.administrator, world.commands_channel)
+    await world.admin.company_delete(admin_ctx, companies[-1])
+    errors_before = guild.errors
+    await world.admin.companies_leaderboard_check(admin_ctx)
+    if guild.errors > errors_before:
+        problems.append("companies-leaderboard-check found the rankings out of sync")
+    await world.bot.shutdown(drop_tables=False)
+
+    print(f"{len(donations)} donations: {donate_ms:.3f} ms each")
+    print(f"classifica: {cached_ms * 1000:.1f} µs cached, {changing_ms:.2f} ms with a donation changing the top; "
+          f"classifica-compagnie: {companies_ms * 1000:.1f} µs")
+    print(f"Donors ranking of a Company with {args.size} members: {indexed_ms:.2f} ms with the index, "
+          f"{full_ms:.1f} ms reading and sorting all users")
+    if len(problems) > 0:
+        raise SystemExit(f"Leaderboards inconsistent: {', '.join(problems)}")
+    print("Leaderboards consistent with the database")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks and verifies the leaderboards")
+    parser.add_argument('--size', type=int, default=5000, help="Number of members of the biggest Company")
+    parser.add_argument('--companies', type=int, default=200, help="Number of other Companies")
+    parser.add_argument('--donations', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=100, help="Calls of each measured command")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,61 @@
+"""Measures the cost of on_message for the chat messages of the guild and for the answers to the surveys.
+
+Run from the root of the repository:
+
+    python -m benchmarks.messages --messages 100000 --surveys 100
+
+Chat messages are spread over a channel without category, a Company channel and the survey category, the surveys are
+answered until completion through the real User cog."""
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.commands import World, COMPANY_NAME
+from benchmarks.fakes import FakeContext, FakeMessage
+
+
+async def main(args):
+    world = World(1, 0.0, 'memory', None)
+    await world.start()
+    guild = world.guild
+    member = world.new_member()
+    company_category = next(channel for channel in guild._channels.values() if channel.name == COMPANY_NAME)
+    channels = [guild.add_text_channel('general'), guild.add_text_channel('compagnia', company_category.id),
+                guild.add_text_channel('richiesta-chiusa', world.survey_category.id)]
+    messages = [FakeMessage(guild, 'ciao', channel=channels[i % len(channels)], author=member)
+                for i in range(args.messages)]
+
+    start = time.perf_counter()
+    for message in messages:
+        await world.user.on_message(message)
+    chat_elapsed = time.perf_counter() - start
+
+    # Every requester opens a survey with crea-compagnia and answers all the questions
+    answers = []
+    for i in range(args.surveys):
+        requester = world.new_member()
+        await world.user.create_company(FakeContext(requester, world.commands_channel), f'Sondaggio{i}', f'S{i:03}')
+        survey_channel = guild.get_channel(world.manager.requests.by_member[(guild.id, requester.id)].approve_channel_id)
+        answers.extend(FakeMessage(guild, f'risposta {step}', channel=survey_channel, author=requester)
+                       for step in range(len(world.bot.settings.survey_questions)))
+    calls_before = guild.calls
+    start = time.perf_counter()
+    for message in answers:
+        await world.user.on_message(message)
+    survey_elapsed = time.perf_counter() - start
+    await world.bot.shutdown(drop_tables=False)
+
+    print(f"{args.messages} chat messages: {chat_elapsed / args.messages * 1e6:.2f} µs per message "
+          f"({args.messages / chat_elapsed:.0f} messages/s)")
+    if len(answers) > 0:
+        print(f"{len(answers)} survey answers: {survey_elapsed / len(answers) * 1e6:.1f} µs per answer, "
+              f"{(guild.calls - calls_before) / len(answers):.1f} Discord calls per answer")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks on_message for chat messages and survey answers")
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--surveys', type=int, default=100, help="Number of surveys answered until completion")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
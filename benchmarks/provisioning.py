@@ -0,0 +1,83 @@
+"""Compares the creation of the channels of a new Company before and after they were created concurrently.
+
+Run from the root of the repository:
+
+    python -m benchmarks.provisioning --channels 4 --latency 0.05 --iterations 10
+
+The channels of [CompanyChannels] are created in a category of a fake guild, whose Discord calls wait --latency
+seconds. The old provisioning created them one after another and set the overwrites of the text channels with a
+second edit call, the current one is CompanyManager.create_company_channels. --channels replaces [CompanyChannels]
+with that many channels, alternating text and voice."""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from benchmarks.commands import World
+
+
+async def create_sequentially(bot, category, company_tag, text_ow, admin_ow, voice_ow):
+    """Provisioning as it was before the channels were created concurrently"""
+    ch_section = bot.cfg['CompanyChannels']
+    for id in ch_section:
+        ch_name: str = ch_section[id]['name'].format(tag=company_tag)
+        ch_type = ch_section[id]['type']
+
+        if ch_type == "text":
+            new_ch = await category.create_text_channel(ch_name)
+            if ch_section[id]['admin'] == 'true':
+                await new_ch.edit(overwrites=admin_ow)
+            else:
+                await new_ch.edit(overwrites=text_ow)
+        elif ch_type == "voice":
+            await category.create_voice_channel(ch_name, overwrites=voice_ow)
+
+
+async def measure(world, provision, iterations):
+    """Returns the Discord calls of one provisioning and the median seconds it took"""
+    guild = world.guild
+    samples = []
+    calls = 0
+    for i in range(iterations):
+        category = guild.add_category(f'Company{i}')
+        calls_before = guild.calls
+        start = time.perf_counter()
+        await provision(category, f'C{i}', {}, {}, {})
+        samples.append(time.perf_counter() - start)
+        calls = guild.calls - calls_before
+    return calls, statistics.median(samples)
+
+
+async def main(args):
+    world = World(1, args.latency, 'memory', None)
+    if args.channels is not None:
+        world.bot.cfg['CompanyChannels'] = {
+            str(i): {'name': f'Canale{i}-{{tag}}', 'type': 'text', 'admin': 'false'} if i % 2 == 1
+            else {'name': f'CanaleVocale{i}', 'type': 'voice'} for i in range(1, args.channels + 1)}
+    await world.start()
+
+    def before(*provision_args):
+        return create_sequentially(world.bot, *provision_args)
+
+    results = {'sequential create and edit': await measure(world, before, args.iterations),
+               'concurrent create with overwrites': await measure(world, world.manager.create_company_channels,
+                                                                  args.iterations)}
+    await world.bot.shutdown(drop_tables=False)
+
+    channels = len(world.bot.cfg['CompanyChannels'])
+    print(f"{channels} channels, {args.latency * 1000:g} ms per Discord call, "
+          f"at most {world.bot.cfg['Concurrency']['channels']} at once")
+    for name, (calls, elapsed) in results.items():
+        print(f"{name}: {calls} Discord calls, {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares sequential and concurrent creation of Company channels")
+    parser.add_argument('--channels', type=int, default=None,
+                        help="Number of channels to create, instead of the ones in [CompanyChannels]")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Simulated seconds of round trip of each Discord API call")
+    parser.add_argument('--iterations', type=int, default=10)
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,67 @@
+"""Measures the cost of the reactions received by the bot, most of them on messages nobody is waiting on.
+
+Run from the root of the repository:
+
+    python -m benchmarks.reactions --rate 1000 --seconds 5 --registered 0.01
+
+Reactions are sent to CompaniesClient.on_raw_reaction_add at the given rate, a registered fraction of them is on
+messages with a handler that does nothing."""
+import argparse
+import asyncio
+import logging
+import time
+
+import discord
+
+from benchmarks.commands import World
+from benchmarks.fakes import next_id
+
+
+async def main(args):
+    world = World(1, 0.0, 'memory', None)
+    await world.start()
+    router = world.bot.reactions
+    member = world.new_member()
+    channel = world.guild.add_text_channel('general')
+    emoji = discord.PartialEmoji(name=world.bot.cfg['Emoji']['check'])
+
+    async def noop(payload):
+        pass
+
+    total = args.rate * args.seconds
+    step = round(1 / args.registered) if args.registered > 0 else total + 1
+    payloads = []
+    for i in range(total):
+        message_id = next_id()
+        if i % step == 0:
+            router.register(message_id, noop)
+        payload = discord.RawReactionActionEvent({'message_id': message_id, 'channel_id': channel.id,
+                                                  'user_id': member.id, 'guild_id': world.guild.id},
+                                                 emoji, 'REACTION_ADD')
+        payload.member = member
+        payloads.append(payload)
+
+    busy = 0.0
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads):
+        # Paced like the gateway would deliver them, only the time spent dispatching is counted
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        before = time.perf_counter()
+        await world.bot.on_raw_reaction_add(payload)
+        busy += time.perf_counter() - before
+    await world.bot.shutdown(drop_tables=False)
+
+    print(f"{total} reactions at {args.rate}/s: {busy / total * 1e6:.2f} µs per reaction, "
+          f"{busy / args.seconds * 100:.2f}% of the event loop, {router.seen} seen, {router.handled} handled")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the dispatch of the reactions")
+    parser.add_argument('--rate', type=int, default=1000, help="Reactions per second")
+    parser.add_argument('--seconds', type=int, default=5)
+    parser.add_argument('--registered', type=float, default=0.01,
+                        help="Fraction of reactions on messages with a handler")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,77 @@
+"""Checks that the event loop stays responsive while a database call is slow.
+
+Run from the root of the repository:
+
+    python -m benchmarks.responsiveness --delay 1 --max-lag 0.05
+
+A blocking time.sleep stands in for a slow query and runs through Database.run, like every CompanyManager method,
+while a ticker coroutine measures how late the loop wakes it up. The same sleep run directly on the loop is measured
+too, to show what the ticker sees when the loop is blocked."""
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.commands import World
+
+TICK = 0.01
+
+
+async def measure_lag(work):
+    """Runs work while ticking every TICK seconds, returns the worst delay of a tick in seconds"""
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lag = max(lag, time.perf_counter() - start - TICK)
+
+    task = asyncio.create_task(ticker())
+    # Let the ticker start before the work
+    await asyncio.sleep(0)
+    try:
+        await work()
+    finally:
+        done.set()
+        await task
+    return lag
+
+
+async def main(args):
+    world = World(1, 0.0, 'memory', None)
+    await world.start()
+    db = world.bot.db
+
+    async def slow_queries():
+        await asyncio.gather(*(db.run(time.sleep, args.delay) for _ in range(args.queries)))
+
+    async def blocking_query():
+        time.sleep(args.delay)
+
+    start = time.perf_counter()
+    offloaded = await measure_lag(slow_queries)
+    elapsed = time.perf_counter() - start
+    blocked = await measure_lag(blocking_query)
+    await world.bot.shutdown(drop_tables=False)
+
+    print(f"{args.queries} queries delayed {args.delay:g}s through Database.run in {elapsed:.2f}s: "
+          f"worst loop lag {offloaded * 1000:.1f} ms")
+    print(f"Same delay on the event loop: worst loop lag {blocked * 1000:.1f} ms")
+    if blocked < args.delay / 2:
+        raise SystemExit("The ticker didn't notice the blocked loop, the check is not measuring anything")
+    if offloaded > args.max_lag:
+        raise SystemExit(f"The event loop was blocked for {offloaded * 1000:.1f} ms by a database call")
+    print("Event loop responsive")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that slow database calls don't block the event loop")
+    parser.add_argument('--delay', type=float, default=1.0, help="Seconds of each artificially delayed query")
+    parser.add_argument('--queries', type=int, default=3,
+                        help="Delayed queries run at the same time, queued on the database thread")
+    parser.add_argument('--max-lag', type=float, default=0.05, help="Seconds of loop lag considered a failure")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+"""Checks the number of SQL statements of each CompanyManager lookup.
+
+Run from the root of the repository:
+
+    python -m benchmarks.statements --size 100
+
+Every lookup runs against a Company of the given size in SQLite in memory, for a Company that exists and for one
+that doesn't, while a before_cursor_execute listener counts the statements sent to the database. A lookup that
+loads its rows one by one, or runs a count before the select, makes its count grow past the expected one."""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import event
+
+from benchmarks.commands import World, COMPANY_NAME
+
+MISSING = 'Inesistente'
+
+
+def lookups(world):
+    """Returns (name, coroutine function, expected statements) of every lookup"""
+    manager = world.manager
+    guild_id = world.guild.id
+    member = world.governatore
+    return [
+        ('fetch_company_for', lambda: manager.fetch_company_for(member), 1),
+        ('get_company_for (cached)', lambda: manager.get_company_for(member), 0),
+        ('get_balance', lambda: manager.get_balance(member), 1),
+        *((f'{name} ({company})', (lambda f=func, c=company: f(guild_id, c)), 1)
+          for company in (COMPANY_NAME, MISSING)
+          for name, func in (('check_company_existence', manager.check_company_existence),
+                             ('get_company_members', manager.get_company_members),
+                             ('get_company_category', manager.get_company_category),
+                             ('get_company_basic_info', manager.get_company_basic_info),
+                             ('get_company_info', manager.get_company_info),
+                             ('get_faction_for', manager.get_faction_for),
+                             ('get_faction_info', manager.get_faction_info))),
+        ('get_company_list', lambda: manager.get_company_list(guild_id), 1),
+        ('get_notify_channels', lambda: manager.get_notify_channels(guild_id), 1),
+    ]
+
+
+async def main(args):
+    world = World(args.size, 0.0, 'memory', None)
+    await world.start()
+    statements = []
+    event.listen(world.bot.db.engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *_: statements.append(statement))
+
+    wrong = []
+    for name, lookup, expected in lookups(world):
+        statements.clear()
+        await lookup()
+        print(f"{name}: {len(statements)} statements")
+        if len(statements) != expected:
+            wrong.append(f"{name} ran {len(statements)} statements instead of {expected}")
+            for statement in statements:
+                print(f"    {' '.join(statement.split())}")
+    await world.bot.shutdown(drop_tables=False)
+
+    if len(wrong) > 0:
+        raise SystemExit(f"Unexpected statements: {', '.join(wrong)}")
+    print("Every lookup runs the expected statements")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks the SQL statements of each CompanyManager lookup")
+    parser.add_argument('--size', type=int, default=100, help="Number of members of the Company")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+"""Checks that a survey answered in part continues where it stopped after a restart of the bot.
+
+Run from the root of the repository:
+
+    python -m benchmarks.survey_restart --answered 1
+
+A requester opens a survey with crea-compagnia and answers --answered questions, the surveys are saved like the
+periodic task does and the bot is shut down. A new bot is started on the same SQLite file and guild: its User cog
+must have the same step and answers, and the next answer must get the next question."""
+import argparse
+import asyncio
+import logging
+
+from benchmarks.commands import World, BenchClient
+from benchmarks.fakes import FakeContext, FakeMessage
+
+
+async def restart(world):
+    """Shuts down the bot of the world and returns a new one started on the same database and guilds"""
+    await world.bot.shutdown(drop_tables=False)
+    bot = BenchClient(world.guilds)
+    bot.cfg = world.bot.cfg
+    bot.reload_settings()
+    await bot.initialize()
+    return bot
+
+
+async def main(args):
+    world = World(1, 0.0, 'sqlite', None)
+    await world.start()
+    guild = world.guild
+    questions = world.bot.settings.survey_questions
+    if not 0 < args.answered < len(questions):
+        raise SystemExit(f"--answered must be between 1 and {len(questions) - 1}")
+
+    requester = world.new_member()
+    await world.user.create_company(FakeContext(requester, world.commands_channel), 'Sondaggio', 'SOND')
+    channel = guild.get_channel(world.manager.requests.by_member[(guild.id, requester.id)].approve_channel_id)
+    answers = [f'risposta {i}' for i in range(args.answered)]
+    for answer in answers:
+        await world.user.on_message(FakeMessage(guild, answer, channel=channel, author=requester))
+    step = world.user.surveys.surveys[channel.id].step
+    await world.user.save_surveys()
+
+    bot = await restart(world)
+    user = bot.get_cog('User')
+    sent = []
+
+    async def send(content=None, embed=None):
+        sent.append(embed.description)
+        return FakeMessage(guild, content, embed, channel)
+
+    channel.send = send
+    problems = []
+    survey = user.surveys.surveys.get(channel.id)
+    if survey is None:
+        problems.append("the survey was not loaded")
+    else:
+        if survey.step != step:
+            problems.append(f"step {survey.step} instead of {step}")
+        if survey.answers != answers:
+            problems.append(f"answers {survey.answers} instead of {answers}")
+        if channel.id not in user.surveys.active:
+            problems.append("the survey is not waiting for answers")
+        if channel.id not in bot.get_cog('CompanyManager').requests.by_channel:
+            problems.append("the request of the survey was not loaded")
+
+        await user.on_message(FakeMessage(guild, 'risposta dopo il riavvio', channel=channel, author=requester))
+        expected = questions[step] if step < len(questions) else bot.settings.survey_last_message
+        if sent[:1] != [expected]:
+            problems.append(f"sent {sent} instead of {expected!r} after the next answer")
+    await bot.shutdown(drop_tables=False)
+
+    print(f"Survey answered {args.answered}/{len(questions)} before the restart, step {step}")
+    if len(problems) > 0:
+        raise SystemExit(f"Survey not restored: {', '.join(problems)}")
+    print("Survey restored after the restart")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that surveys continue where they stopped after a restart")
+    parser.add_argument('--answered', type=int, default=1, help="Questions answered before the restart")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,200 @@
+"""Checks the upgrade of a database created by the first release of the bot to the current schema.
+
+Run from the root of the repository:
+
+    python -m benchmarks.upgrade
+
+The tables of the first release are created in a SQLite file with a few Companies, members and requests, then
+Database.create_tables upgrades them like at the startup of the bot. Every CREATE TABLE must reference columns that
+already exist and are a key of their table, which MySQL enforces and SQLite doesn't.
+
+The upgrade is then repeated, stopping it with an error at each statement that changes the database. The DDL
+statements run before the error are not rolled back, like on MySQL where each one commits, and a second startup must
+complete the upgrade without losing rows. The models are also compiled to MySQL DDL."""
+import argparse
+import logging
+import os
+import re
+import tempfile
+from types import SimpleNamespace
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateTable
+
+import migrations
+from database import Database
+from metrics import Metrics
+
+GUILD_ID = 805120528812867600
+
+# Schema and data of the first release
+BASELINE = [
+    """CREATE TABLE companies (
+        name VARCHAR(50) NOT NULL, tag VARCHAR(4) NOT NULL, category_id BIGINT NOT NULL, role BIGINT NOT NULL,
+        faction VARCHAR(50), balance FLOAT NOT NULL, PRIMARY KEY (name), UNIQUE (tag))""",
+    """CREATE TABLE requests (
+        member_id BIGINT NOT NULL, name VARCHAR(50) NOT NULL, tag VARCHAR(4) NOT NULL, approve_message_id BIGINT,
+        approve_channel_id BIGINT, PRIMARY KEY (member_id))""",
+    """CREATE TABLE users (
+        member_id BIGINT NOT NULL, balance FLOAT NOT NULL, blacklisted BOOLEAN NOT NULL, company_name VARCHAR(50),
+        company_donations FLOAT NOT NULL, PRIMARY KEY (member_id), CHECK (blacklisted IN (0, 1)),
+        FOREIGN KEY(company_name) REFERENCES companies (name) ON DELETE SET NULL ON UPDATE CASCADE)""",
+    "INSERT INTO companies VALUES ('Alfa', 'ALF', 1, 2, NULL, 0), ('Beta', 'BET', 3, 4, 'Fazione1', 0)",
+    "INSERT INTO users VALUES (10, 5, 0, 'Alfa', 5), (11, 0, 0, 'Beta', 0), (12, 7, 0, NULL, 0)",
+    "INSERT INTO requests VALUES (20, 'Gamma', 'GAM', 30, 31), (21, 'Delta', 'DEL', NULL, NULL)",
+]
+EXPECTED = {
+    'companies': {(GUILD_ID, 'Alfa', 'ALF'), (GUILD_ID, 'Beta', 'BET')},
+    'users': {(GUILD_ID, 10, 'Alfa'), (GUILD_ID, 11, 'Beta'), (GUILD_ID, 12, None)},
+    'requests': {(GUILD_ID, 20, 'Gamma'), (GUILD_ID, 21, 'Delta')},
+    'company_names': {(GUILD_ID, 'Alfa', 'ALF'), (GUILD_ID, 'Beta', 'BET'), (GUILD_ID, 'Gamma', 'GAM'),
+                      (GUILD_ID, 'Delta', 'DEL')},
+}
+ROWS = {
+    'companies': "SELECT guild_id, name, tag FROM companies",
+    'users': "SELECT guild_id, member_id, company_name FROM users",
+    'requests': "SELECT guild_id, member_id, name FROM requests",
+    'company_names': "SELECT guild_id, name, tag FROM company_names",
+}
+
+
+class Crash(Exception):
+    pass
+
+
+def open_database(path):
+    bot = SimpleNamespace(cfg={'Database': {'backend': 'sqlite', 'path': path, 'liveness': 'pre_ping', 'workers': 1}},
+                          metrics=Metrics(), guilds=[SimpleNamespace(id=GUILD_ID)])
+    return Database(bot)
+
+
+def close_database(db):
+    db.executor.shutdown()
+    db.engine.dispose()
+
+
+def create_baseline():
+    path = os.path.join(tempfile.mkdtemp(), 'upgrade.db')
+    db = open_database(path)
+    with db.engine.connect() as con:
+        for statement in BASELINE:
+            con.execute(statement)
+    close_database(db)
+    return path
+
+
+def get_keys(dbapi_con, table):
+    """Returns the column lists that a foreign key may reference in the table: its primary key and its indexes"""
+    cursor = dbapi_con.cursor()
+    columns = cursor.execute(f"PRAGMA table_info({table})").fetchall()
+    keys = [[name for _, name, _, _, _, pk in sorted(columns, key=lambda column: column[5]) if pk > 0]]
+    for index in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        keys.append([column[2] for column in cursor.execute(f"PRAGMA index_info({index[1]})").fetchall()])
+    cursor.close()
+    return keys
+
+
+def watch(db, crash_at=None):
+    """Counts the statements that change the database, raising Crash at the crash_at one, and checks the foreign
+    keys of every CREATE TABLE. Returns the list of statements and the list of problems found"""
+    statements = []
+    problems = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if re.match(r'\s*(SELECT|PRAGMA|EXPLAIN)', statement) is None:
+            statements.append(statement)
+            if len(statements) == crash_at:
+                raise Crash(statement)
+        created = re.match(r'\s*CREATE TABLE (\w+)', statement)
+        if created is None:
+            return
+        for fk in db.Base.metadata.tables[created.group(1)].foreign_key_constraints:
+            referred = fk.referred_table.name
+            columns = [element.column.name for element in fk.elements]
+            # MySQL needs an index starting with the referenced columns
+            if not any(key[:len(columns)] == columns for key in get_keys(cursor.connection, referred)):
+                problems.append(f"{created.group(1)} references {referred}({', '.join(columns)}), "
+                                f"which is not a key of the existing table")
+
+    event.listen(db.engine, "before_cursor_execute", before_execute)
+    return statements, problems
+
+
+def check_data(db):
+    """Returns the differences of the upgraded database from the expected schema and rows"""
+    problems = []
+    with db.engine.connect() as con:
+        tables = con.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        left = [name for name, in tables if name.endswith('_old')]
+        if len(left) > 0:
+            problems.append(f"tables {left} left behind")
+        version = con.execute("SELECT MAX(version) FROM schema_version").scalar()
+        if version != migrations.MIGRATIONS[-1][0]:
+            problems.append(f"schema at version {version}")
+        for table in db.Base.metadata.sorted_tables:
+            columns = {column['name'] for column in inspect(con).get_columns(table.name)}
+            if columns != set(table.columns.keys()):
+                problems.append(f"{table.name} has columns {sorted(columns)}")
+        for table, query in ROWS.items():
+            rows = {tuple(row) for row in con.execute(query).fetchall()}
+            if rows != EXPECTED[table]:
+                problems.append(f"{table} has rows {sorted(rows, key=str)}")
+        if len(con.execute("PRAGMA foreign_key_check").fetchall()) > 0:
+            problems.append("rows violate the foreign keys")
+    return problems
+
+
+def upgrade(crash_at=None):
+    """Upgrades a new baseline database, crashing at the crash_at statement and restarting if given.
+    Returns the statements of the first startup and the problems found"""
+    db = open_database(create_baseline())
+    statements, problems = watch(db, crash_at)
+    try:
+        db.create_tables()
+        if crash_at is not None:
+            problems.append(f"no crash at statement {crash_at}")
+    except Crash:
+        path = db.bot.cfg['Database']['path']
+        close_database(db)
+        db = open_database(path)
+        problems.extend(watch(db)[1])
+        try:
+            db.create_tables()
+        except Exception as ex:
+            problems.append(f"the restart failed with {str(ex).splitlines()[0]}")
+            close_database(db)
+            return statements, problems
+    problems.extend(check_data(db))
+    close_database(db)
+    return statements, problems
+
+
+def main(args):
+    for table in Database.Base.metadata.sorted_tables:
+        str(CreateTable(table).compile(dialect=mysql.dialect()))
+    print(f"{len(Database.Base.metadata.sorted_tables)} tables compiled to MySQL DDL")
+
+    statements, problems = upgrade()
+    print(f"Upgrade from the first release: {len(statements)} statements")
+    failed = {None: problems} if len(problems) > 0 else {}
+    crash_points = range(1, len(statements) + 1) if args.crash_at is None else [args.crash_at]
+    for crash_at in crash_points:
+        problems = upgrade(crash_at)[1]
+        if len(problems) > 0:
+            failed[crash_at] = problems
+
+    for crash_at, problems in failed.items():
+        where = f"after a crash at '{' '.join(statements[crash_at - 1].split())[:80]}'" if crash_at else "upgrade"
+        print(f"{where}: {', '.join(problems)}")
+    if len(failed) > 0:
+        raise SystemExit(f"{len(failed)} upgrades failed")
+    print(f"Upgrade completed after a crash at each of the {len(crash_points)} statements")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks the upgrade of a database of the first release")
+    parser.add_argument('--crash-at', type=int, default=None,
+                        help="Only crash at this statement, counting from 1, instead of at each one")
+    logging.basicConfig(level=logging.ERROR)
+    main(parser.parse_args())
@@ -0,0 +1,52 @@
+"""Measures the username screening of on_member_join during a join flood.
+
+Run from the root of the repository:
+
+    python -m benchmarks.username --joins 10000 --flagged 0.2
+
+Every join goes through the real User cog, the alerts are counted on the fake guild."""
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.commands import World
+
+
+async def main(args):
+    world = World(1, args.latency, 'memory', None)
+    cfg = world.bot.cfg
+    alert_channel = world.guild.add_text_channel('alerts')
+    cfg['Username']['channel'] = alert_channel.id
+    cfg['Username']['alert_window'] = args.window
+    cfg['Username']['Patterns'] = {'link': r'discord\.gg/', 'spam': r'(?i)free nitro'}
+    world.bot.reload_settings()
+    await world.start()
+
+    # Every flagged-th member has a username matched by one of the patterns
+    step = round(1 / args.flagged) if args.flagged > 0 else args.joins + 1
+    members = [world.guild.add_member(f'★ raider{i} ★' if i % step == 0 else f'member{i}')
+               for i in range(args.joins)]
+    calls_before = world.guild.calls
+    start = time.perf_counter()
+    for member in members:
+        await world.user.on_member_join(member)
+    elapsed = time.perf_counter() - start
+    flagged = len(world.user.flagged_usernames.get(world.guild.id, ()))
+    if world.guild.id in world.user.username_alert_tasks:
+        await world.user.username_alert_tasks[world.guild.id]
+    await world.bot.shutdown(drop_tables=False)
+
+    print(f"{args.joins} joins screened in {elapsed * 1000:.1f} ms ({args.joins / elapsed:.0f} joins/s), "
+          f"{flagged} flagged, {world.guild.calls - calls_before} alert messages sent")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the username screening during a join flood")
+    parser.add_argument('--joins', type=int, default=10000)
+    parser.add_argument('--flagged', type=float, default=0.2, help="Fraction of joins with a flagged username")
+    parser.add_argument('--window', type=int, default=1, help="Seconds of the alert window")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Simulated seconds of round trip of each Discord API call")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
@@ -1,10 +1,18 @@
 import subprocess
 import logging
+import time
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from cogs import company_manager
+from guilds import get_guild_override
+from utils import gather_limited
+
+# Number of members whose roles are updated before the progress of a role job is saved
+ROLE_JOB_BATCH_SIZE = 25
+# Number of commands and listeners shown by companies-stats
+STATS_MAX_HANDLERS = 15
 
 
 class Admin(commands.Cog):
@@ -12,6 +20,16 @@ class Admin(commands.Cog):
         self.bot = bot
         self.company_manager: 'company_manager.CompanyManager' = bot.get_cog('CompanyManager')
         self.user = bot.get_cog('User')
+        # Guild ids and names of the Companies with a role job in progress
+        self.running_role_jobs = set()
+
+        metrics_sec = self.bot.cfg['Metrics']
+        if metrics_sec['file'] != '':
+            self.write_metrics_task.change_interval(seconds=metrics_sec['interval'])
+            self.write_metrics_task.start()
+
+    def cog_unload(self):
+        self.write_metrics_task.cancel()
 
     async def cog_check(self, ctx):
         permissions = ctx.author.guild_permissions
@@ -20,24 +38,27 @@ class Admin(commands.Cog):
     @commands.command(name='set-apply-channel', usage='{}set-apply-channel <canale>',
                       description="Imposta il canale dove verranno inviati i messaggi di approvazione Compagnie")
     async def set_apply_channel(self, ctx, channel: discord.TextChannel):
-        self.bot.cfg['Channels']['company_apply_channel'] = channel.id
+        get_guild_override(self.bot.cfg, ctx.guild.id, 'Channels')['company_apply_channel'] = channel.id
         self.bot.cfg.write()
+        self.bot.reload_settings()
 
         await self.bot.send_success_embed(ctx, 'set_channel', channel=channel)
 
     @commands.command(name='set-creation-survey-category', usage='{}set-creation-survey-category <categoria>',
                       description="Imposta la categoria dove verranno creati i canali di survey per creazione Compagnie")
     async def set_creation_survey_category(self, ctx, channel: discord.CategoryChannel):
-        self.bot.cfg['CompanyCreationSurvey']['category'] = channel.id
+        get_guild_override(self.bot.cfg, ctx.guild.id, 'CompanyCreationSurvey')['category'] = channel.id
         self.bot.cfg.write()
+        self.bot.reload_settings()
 
         await self.bot.send_success_embed(ctx, 'set_channel', channel=channel)
 
     @commands.command(name='set-user-channel', usage='{}set-user-channel <canale>',
                       description="Imposta il canale dove si possono eseguire i comandi utente")
     async def set_user_channel(self, ctx, channel: discord.TextChannel):
-        self.bot.cfg['Channels']['user_command_channel'] = channel.id
+        get_guild_override(self.bot.cfg, ctx.guild.id, 'Channels')['user_command_channel'] = channel.id
         self.bot.cfg.write()
+        self.bot.reload_settings()
 
         await self.bot.send_success_embed(ctx, 'set_channel', channel=channel)
 
@@ -45,43 +66,152 @@ class Admin(commands.Cog):
                       description="Imposta il canale dove verrà inviata un'allerta se un utente "
                                   "con username riconosciuto dall'espressione regolare nel cfg si unisce al server")
     async def set_username_check(self, ctx, channel: discord.TextChannel):
-        self.bot.cfg['Username']['channel'] = channel.id
+        get_guild_override(self.bot.cfg, ctx.guild.id, 'Username')['channel'] = channel.id
         self.bot.cfg.write()
+        self.bot.reload_settings()
 
         await self.bot.send_success_embed(ctx, 'set_channel', channel=channel)
 
     @commands.command(name='companies-reload', usage="{}companies-reload", description="Riavvia il bot")
     async def companies_reload(self, ctx):
         await self.bot.send_success_embed(ctx, 'reloading')
+        await self.user.save_surveys()
 
         subprocess.call(['service', self.bot.cfg['ServiceName'], 'restart'])
 
+    @commands.command(name='companies-cache-check', usage="{}companies-cache-check",
+                      description="Controlla che la cache delle Compagnie sia allineata con il database")
+    async def companies_cache_check(self, ctx):
+        count, mismatches = await self.company_manager.check_membership_cache()
+        hits, misses = self.company_manager.cache_hits, self.company_manager.cache_misses
+        if len(mismatches) > 0:
+            await self.bot.send_error_embed(ctx, 'cache_check_mismatch', count=len(mismatches), hits=hits,
+                                            misses=misses)
+        else:
+            await self.bot.send_success_embed(ctx, 'cache_check_success', count=count, hits=hits, misses=misses)
+
+    @commands.command(name='companies-leaderboard-check', usage="{}companies-leaderboard-check",
+                      description="Confronta le classifiche con quelle ricalcolate dal database")
+    async def companies_leaderboard_check(self, ctx):
+        count, mismatches = await self.company_manager.check_leaderboards(ctx.guild.id)
+        if len(mismatches) > 0:
+            await self.bot.send_error_embed(ctx, 'leaderboard_check_mismatch', count=len(mismatches), total=count)
+        else:
+            await self.bot.send_success_embed(ctx, 'leaderboard_check_success', count=count)
+
+    @commands.command(name='companies-db-stats', usage="{}companies-db-stats",
+                      description="Mostra le statistiche delle connessioni al database")
+    async def companies_db_stats(self, ctx):
+        await self.bot.send_success_embed(ctx, 'db_stats', liveness=self.bot.db.liveness, **self.bot.db.stats)
+
+    @commands.command(name='companies-stats', usage="{}companies-stats",
+                      description="Mostra i tempi di esecuzione, le query e le richieste a Discord di ogni comando")
+    async def companies_stats(self, ctx):
+        metrics = self.bot.metrics
+        lines = [self.bot.get_message('stats_summary', startup=f"{sum(self.bot.startup_timings.values()):.1f}",
+                                      sql=metrics.statements, http=metrics.http_calls,
+                                      saved=self.bot.role_editor.calls_saved, hits=self.company_manager.cache_hits,
+                                      misses=self.company_manager.cache_misses)]
+
+        # Slowest handlers first, by total time spent in them
+        handlers = sorted(metrics.handlers.items(), key=lambda item: item[1].latency.sum, reverse=True)
+        for name, stats in handlers[:STATS_MAX_HANDLERS]:
+            count = stats.latency.count
+            p99 = stats.latency.quantile(0.99)
+            lines.append(self.bot.get_message('stats_handler', handler=name, count=count,
+                                              avg=f"{stats.latency.sum / count * 1000:.0f}",
+                                              p99='∞' if p99 == float('inf') else f"{p99 * 1000:.0f}",
+                                              sql=f"{stats.statements / count:.1f}",
+                                              http=f"{stats.http_calls / count:.1f}"))
+
+        lines.append(self.bot.get_message('stats_reactions', seen=self.bot.reactions.seen,
+                                          handled=self.bot.reactions.handled))
+
+        errors = [f"{command or '?'} {outcome}: {count}" for (command, outcome), count in metrics.outcomes.items()
+                  if outcome != 'success']
+        if len(errors) > 0:
+            lines.append(self.bot.get_message('stats_errors', errors=', '.join(errors)))
+
+        embed = discord.Embed(colour=discord.Colour.gold(), title="Statistiche Compagnie", description='\n'.join(lines))
+        await ctx.send(embed=embed)
+
+    @tasks.loop(seconds=60)
+    async def write_metrics_task(self):
+        try:
+            self.bot.metrics.write(self.bot.cfg['Metrics']['file'], self.get_metric_gauges())
+        except OSError:
+            logging.error("Can't write the metrics file", exc_info=True)
+
+    def get_metric_gauges(self):
+        return {
+            'companies_startup_seconds': {f'phase="{phase}"': seconds
+                                          for phase, seconds in self.bot.startup_timings.items()},
+            'companies_db_events': {f'event="{event}"': count for event, count in self.bot.db.stats.items()},
+            'companies_role_edits': self.bot.role_editor.edits,
+            'companies_role_edit_calls_saved': self.bot.role_editor.calls_saved,
+            'companies_membership_cache_hits': self.company_manager.cache_hits,
+            'companies_membership_cache_misses': self.company_manager.cache_misses,
+            'companies_reactions_seen': self.bot.reactions.seen,
+            'companies_reactions_handled': self.bot.reactions.handled,
+            'companies_reaction_handlers': len(self.bot.reactions.handlers),
+            'companies_pending_requests': len(self.company_manager.requests.by_member),
+            'companies_pending_invites': len(self.company_manager.invites),
+            'companies_running_role_jobs': len(self.running_role_jobs),
+        }
+
     @commands.command(name='company-delete', usage="{}company-delete <name>", description="Elimina una Compagnia")
     async def company_delete(self, ctx, name: str):
-        category_id, company_role_id, faction, members = self.company_manager.get_company_info(name)
+        category_id, company_role_id, faction, members = await self.company_manager.get_company_info(ctx.guild.id, name)
         if company_role_id is None:
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
+        if (ctx.guild.id, name.lower()) in self.running_role_jobs:
+            await self.bot.send_error_embed(ctx, 'role_job_running')
+            return
+
+        start = time.perf_counter()
+        company_role = ctx.guild.get_role(company_role_id)
+        category = ctx.guild.get_channel(category_id)
 
+        # Every member ends up with the same roles removed, compute them once and edit each member with one call
+        config = self.bot.get_guild_config(ctx.guild)
+        company_roles = self.user.get_company_roles(config, company_role, faction)
+        to_remove = [config.roles['to_remove']]
+        teardown = []
         for member_id in members:
             member: discord.Member = ctx.guild.get_member(member_id)
-            await self.user.remove_from_company(member, prevent_governatore_removal=False, delete_from_db=False)
-
-        company_role = ctx.guild.get_role(company_role_id)
-        await company_role.delete()
+            if member is not None:
+                teardown.append(self.bot.role_editor.edit(member, add=to_remove, remove=company_roles, nick=None))
+        if category is not None:
+            teardown.extend(ch.delete() for ch in category.channels)
+
+        results = await gather_limited(self.bot.cfg['Concurrency']['teardown'], *teardown, return_exceptions=True)
+        calls = 0
+        for res in results:
+            if isinstance(res, int):
+                # Member edits return the number of calls they made, channel deletions return None
+                calls += res
+            else:
+                calls += 1
+                if isinstance(res, Exception):
+                    logging.warning(f"Error while deleting Company {name}: {res}")
 
-        category = ctx.guild.get_channel(category_id)
-        for ch in category.channels:
-            await ch.delete()
-        await category.delete()
+        if company_role is not None:
+            await company_role.delete()
+            calls += 1
+        if category is not None:
+            await category.delete()
+            calls += 1
 
-        self.company_manager.delete_company(name)
+        await self.company_manager.delete_company(ctx.guild.id, name)
 
-        await self.bot.send_success_embed(ctx, 'company_delete_success')
+        elapsed = time.perf_counter() - start
+        logging.info(f"Deleted Company {name} with {len(members)} members in {elapsed:.2f}s using {calls} calls")
+        await self.bot.send_success_embed(ctx, 'company_delete_success', time=f"{elapsed:.1f}", calls=calls)
 
     @commands.command(name='company-list', usage="{}company-list", description="Stampa la lista delle Compagnie")
     async def company_list(self, ctx):
-        companies = self.company_manager.get_company_list()
+        companies = await self.company_manager.get_company_list(ctx.guild.id)
         embed = discord.Embed(colour=discord.Colour.gold(), title="Lista Compagnie")
         content = ''
         for name in companies:
@@ -93,71 +223,62 @@ class Admin(commands.Cog):
     @commands.command(name='set-faction', usage="{}set-faction <company_name> <faction_name>",
                       description="Imposta la Fazione di appartenenza per una Compagnia")
     async def set_faction(self, ctx, company_name, faction_name):
-        if faction_name not in self.bot.faction_roles:
+        config = self.bot.get_guild_config(ctx.guild)
+        if faction_name not in config.faction_roles:
             await self.bot.send_error_embed(ctx, 'faction_not_exists')
             return
-        members = self.company_manager.get_company_members(company_name)
-        faction = self.company_manager.get_faction_for(company_name)
+        faction, members = await self.company_manager.get_faction_info(ctx.guild.id, company_name)
         if members is None:
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
         if faction is not None:
             await self.bot.send_error_embed(ctx, 'already_in_faction')
             return
+        if (ctx.guild.id, company_name.lower()) in self.running_role_jobs:
+            await self.bot.send_error_embed(ctx, 'role_job_running')
+            return
 
-        staff_role = self.bot.faction_roles[faction_name]['staff']
-        member_role = self.bot.faction_roles[faction_name]['member']
-        for member_id in members:
-            member = ctx.guild.get_member(member_id)
-            if self.bot.roles['governatore'] in member.roles or self.bot.roles['console'] in member.roles:
-                await member.add_roles(staff_role)
-            else:
-                await member.add_roles(member_role)
-
-        category_id = self.company_manager.get_company_category(company_name)
-        emoji = self.bot.cfg['Factions'][faction_name]['emoji']
+        category_id = await self.company_manager.get_company_category(ctx.guild.id, company_name)
+        emoji = config.factions[faction_name]['emoji']
         category = ctx.guild.get_channel(category_id)
         if category is not None:
             new_name = f"{emoji} - {company_name}"
             await category.edit(name=new_name)
 
-        self.company_manager.set_faction(company_name, faction_name)
+        await self.company_manager.set_faction(ctx.guild.id, company_name, faction_name)
 
-        await self.bot.send_success_embed(ctx, 'set_faction_success')
+        await self.start_role_job(ctx, 'add', company_name, faction_name, members)
 
     @commands.command(name='kick-from-faction', usage="{}kick-from-faction <company_name>",
                       description="Espelli la Compagnia dalla Fazione di appartenenza")
     async def kick_from_faction(self, ctx, company_name):
-        faction_name, members = self.company_manager.get_faction_info(company_name)
+        faction_name, members = await self.company_manager.get_faction_info(ctx.guild.id, company_name)
         if members is None:
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
         if faction_name is None:
             await self.bot.send_error_embed(ctx, 'not_in_faction')
             return
+        if (ctx.guild.id, company_name.lower()) in self.running_role_jobs:
+            await self.bot.send_error_embed(ctx, 'role_job_running')
+            return
 
-        staff_role = self.bot.faction_roles[faction_name]['staff']
-        member_role = self.bot.faction_roles[faction_name]['member']
-        for member_id in members:
-            member = ctx.guild.get_member(member_id)
-            await member.remove_roles(staff_role, member_role)
-
-        category_id = self.company_manager.get_company_category(company_name)
+        category_id = await self.company_manager.get_company_category(ctx.guild.id, company_name)
         category = ctx.guild.get_channel(category_id)
         if category is not None:
             await category.edit(name=company_name)
 
-        self.company_manager.kick_from_faction(company_name)
+        await self.company_manager.kick_from_faction(ctx.guild.id, company_name)
 
-        await self.bot.send_success_embed(ctx, 'kick_from_faction_success')
+        await self.start_role_job(ctx, 'remove', company_name, faction_name, members)
 
     @commands.command(name='force-recruit', usage="{}force-recruit <company_name> <member>",
                       description="Rendi l'utente membro della Compagnia")
     async def force_recruit(self, ctx, company_name, member: discord.Member):
-        if not self.company_manager.check_company_existence(company_name):
+        if not await self.company_manager.check_company_existence(ctx.guild.id, company_name):
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
-        member_company = self.company_manager.get_company_for(member)
+        member_company = await self.company_manager.get_company_for(member)
         if member_company is not None:
             await self.bot.send_error_embed(ctx, 'member_already_in_company')
             return
@@ -169,7 +290,7 @@ class Admin(commands.Cog):
     @commands.command(name='force-kick', usage="{}force-kick <member>",
                       description="Espelli l'utente della Compagnia di appartenenza")
     async def force_kick(self, ctx, member: discord.Member):
-        member_company = self.company_manager.get_company_for(member)
+        member_company = await self.company_manager.get_company_for(member)
         if member_company is None:
             await self.bot.send_error_embed(ctx, 'member_not_in_company')
             return
@@ -185,76 +306,222 @@ class Admin(commands.Cog):
     @commands.command(name='set-governatore', usage="{}set-governatore <company_name> <member>",
                       description="Imposta l'utente come Governatore della Compagnia specificata")
     async def set_governatore(self, ctx, company_name, member: discord.Member):
-        if self.bot.roles['governatore'] in member.roles:
+        staff_role = self.bot.get_guild_config(ctx.guild).roles['governatore']
+        if staff_role in member.roles:
             await self.bot.send_error_embed(ctx, 'already_governatore')
             return
-        if not self.company_manager.check_company_existence(company_name):
+        if not await self.company_manager.check_company_existence(ctx.guild.id, company_name):
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
-        member_company = self.company_manager.get_company_for(member)
+        member_company = await self.company_manager.get_company_for(member)
         if member_company is None:
-            await self.user.add_to_company(member, company_name)
+            await self.user.add_to_company(member, company_name, staff_role=staff_role)
         elif member_company.lower() != company_name.lower():
             await self.bot.send_error_embed(ctx, 'promote_mismatch')
             return
-
-        if self.bot.roles['console'] in member.roles:
-            await member.remove_roles(self.bot.roles['console'])
-        await member.add_roles(self.bot.roles['governatore'])
-        faction = self.company_manager.get_faction_for(company_name)
-        if faction is not None:
-            await member.remove_roles(self.bot.faction_roles[faction]['member'])
-            await member.add_roles(self.bot.faction_roles[faction]['staff'])
+        else:
+            faction = await self.company_manager.get_faction_for(ctx.guild.id, company_name)
+            await self.user.set_company_staff(member, staff_role, faction)
 
         await self.bot.send_success_embed(ctx, 'add_governatore_success')
 
     @commands.command(name='set-console', usage="{}set-console <company_name> <member>",
                       description="Imposta l'utente come Console della Compagnia specificata")
     async def set_console(self, ctx, company_name, member: discord.Member):
-        if self.bot.roles['console'] in member.roles:
+        staff_role = self.bot.get_guild_config(ctx.guild).roles['console']
+        if staff_role in member.roles:
             await self.bot.send_error_embed(ctx, 'already_console')
             return
-        if not self.company_manager.check_company_existence(company_name):
+        if not await self.company_manager.check_company_existence(ctx.guild.id, company_name):
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
-        member_company = self.company_manager.get_company_for(member)
+        member_company = await self.company_manager.get_company_for(member)
         if member_company is None:
-            await self.user.add_to_company(member, company_name)
+            await self.user.add_to_company(member, company_name, staff_role=staff_role)
         elif member_company.lower() != company_name.lower():
             await self.bot.send_error_embed(ctx, 'promote_mismatch')
             return
-
-        if self.bot.roles['governatore'] in member.roles:
-            await member.remove_roles(self.bot.roles['governatore'])
-        await member.add_roles(self.bot.roles['console'])
-        faction = self.company_manager.get_faction_for(company_name)
-        if faction is not None:
-            await member.remove_roles(self.bot.faction_roles[faction]['member'])
-            await member.add_roles(self.bot.faction_roles[faction]['staff'])
+        else:
+            faction = await self.company_manager.get_faction_for(ctx.guild.id, company_name)
+            await self.user.set_company_staff(member, staff_role, faction)
 
         await self.bot.send_success_embed(ctx, 'add_console_success')
 
     @commands.command(name='companies-notify', usage="{}companies-notify <title> <message>",
                       description="Manda un Embed in un canale testuale (specificato nel config) di tutte le Compagnie")
     async def companies_notify(self, ctx, title, *, message):
-        ch_name = self.bot.cfg['CompaniesNotify']['channel_name'].lower().replace(" ", "-")
         embed = discord.Embed(colour=discord.Colour.teal(), title=title, description=message)
-        categories = self.company_manager.get_companies_categories()
-        for company, category_id in categories.items():
-            category: discord.CategoryChannel = ctx.guild.get_channel(category_id)
-            for ch in category.text_channels:
-                if ch.name.startswith(ch_name):
-                    await ch.send(embed=embed)
+        channels, missing = await self.get_notify_channels(ctx.guild)
+
+        results = await gather_limited(self.bot.cfg['Concurrency']['notify'],
+                                       *(ch.send(embed=embed) for ch in channels.values()), return_exceptions=True)
+        sent = 0
+        for company, res in zip(channels.keys(), results):
+            if isinstance(res, Exception):
+                logging.warning(f"Can't send notify message to Company {company}: {res}")
+                missing.append(company)
+            else:
+                sent += 1
+
+        await self.bot.send_success_embed(ctx, 'companies_notify_success', sent=sent)
+        if len(missing) > 0:
+            await self.bot.send_error_embed(ctx, 'companies_notify_failed', companies=', '.join(missing))
+
+    @commands.command(name='companies-notify-dry-run', usage="{}companies-notify-dry-run",
+                      description="Mostra a quanti canali verrebbe inviato il messaggio di companies-notify")
+    async def companies_notify_dry_run(self, ctx):
+        channels, missing = await self.get_notify_channels(ctx.guild, record=False)
+
+        await self.bot.send_success_embed(ctx, 'companies_notify_dry_run', sends=len(channels))
+        if len(missing) > 0:
+            await self.bot.send_error_embed(ctx, 'companies_notify_failed', companies=', '.join(missing))
+
+    async def get_notify_channels(self, guild: discord.Guild, record=True):
+        """Resolves the notify channel of every Company from the ids recorded in the database.
+        Companies created before the ids were recorded, or whose channel was replaced, are looked up by name once
+        and their channel id is saved, unless record is False. Returns a dict company name -> channel and the list
+        of companies without a notify channel."""
+        channels = dict()
+        missing = list()
+        to_record = dict()
+        for company, (category_id, channel_id) in (await self.company_manager.get_notify_channels(guild.id)).items():
+            channel = guild.get_channel(channel_id) if channel_id is not None else None
+            if channel is None:
+                category: discord.CategoryChannel = guild.get_channel(category_id)
+                if category is not None:
+                    channel = self.company_manager.find_notify_channel(category.text_channels)
+                if channel is not None:
+                    to_record[company] = channel.id
+
+            if channel is not None:
+                channels[company] = channel
+            else:
+                missing.append(company)
 
-        await self.bot.send_success_embed(ctx, 'companies_notify_success')
+        if record and len(to_record) > 0:
+            await self.company_manager.set_notify_channels(guild.id, to_record)
+        return channels, missing
+
+    @commands.command(name='deposit', usage="{}deposit <member> <amount>",
+                      description="Aggiunge l'importo al saldo dell'utente")
+    async def deposit(self, ctx, member: discord.Member, amount: int):
+        if amount <= 0:
+            await self.bot.send_error_embed(ctx, 'amount_invalid')
+            return
+
+        await self.company_manager.deposit(member, amount)
+
+        await self.bot.send_success_embed(ctx, 'deposit_success', amount=amount, member=member.display_name)
 
     @commands.command(name='member-list', usage="{}member-list <company_name>",
                       description="Mostra la lista dei membri della Compagnia specificata")
     async def list_members(self, ctx, company_name):
-        if not self.company_manager.check_company_existence(company_name):
+        if not await self.company_manager.check_company_existence(ctx.guild.id, company_name):
             await self.bot.send_error_embed(ctx, 'company_not_exists')
             return
 
-        embed = self.user.get_member_list_embed(company_name, ctx.guild)
+        embed = await self.user.get_member_list_embed(company_name, ctx.guild)
 
         await ctx.send(embed=embed)
+
+    #
+    # Role jobs
+    #
+
+    async def start_role_job(self, ctx, action, company_name, faction, members):
+        """Adds or removes the faction roles of all members in the background, reporting progress in ctx"""
+        job_id = await self.company_manager.create_role_job(ctx.guild.id, action, company_name, faction, ctx.channel.id,
+                                                         members)
+        progress_message = await ctx.send(embed=self.get_role_job_embed(company_name, 0, len(members)))
+        await self.company_manager.set_role_job_message(job_id, progress_message.id)
+
+        self.bot.loop.create_task(self.run_role_job(job_id, action, company_name, faction, ctx.guild,
+                                                    progress_message, len(members), members))
+
+    async def resume_role_jobs(self, role_jobs):
+        """Restarts the role jobs, as returned by fetch_role_jobs, that were interrupted by a restart of the bot"""
+        for job_id, guild_id, action, company_name, faction, total, channel_id, message_id, pending in role_jobs:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or faction not in self.bot.get_guild_config(channel.guild).faction_roles \
+                    or not await self.company_manager.check_company_existence(guild_id, company_name):
+                logging.error(f"Can't resume role job {job_id} for {company_name}, discarding it")
+                await self.company_manager.delete_role_job(job_id)
+                continue
+
+            progress_message = channel.get_partial_message(message_id) if message_id is not None else None
+            logging.info(f"Resuming role job {job_id} for {company_name}, {len(pending)}/{total} members left")
+            self.bot.loop.create_task(self.run_role_job(job_id, action, company_name, faction, channel.guild,
+                                                        progress_message, total, pending))
+
+    async def run_role_job(self, job_id, action, company_name, faction, guild, progress_message, total, pending):
+        self.running_role_jobs.add((guild.id, company_name.lower()))
+        try:
+            config = self.bot.get_guild_config(guild)
+            staff_role = config.faction_roles[faction]['staff']
+            member_role = config.faction_roles[faction]['member']
+            done = total - len(pending)
+            failed = 0
+            for i in range(0, len(pending), ROLE_JOB_BATCH_SIZE):
+                batch = pending[i:i + ROLE_JOB_BATCH_SIZE]
+                results = await gather_limited(self.bot.cfg['Concurrency']['roles'],
+                                               *(self.update_faction_roles(guild.get_member(member_id), action, config,
+                                                                           staff_role, member_role)
+                                                 for member_id in batch),
+                                               return_exceptions=True)
+                succeeded = []
+                for member_id, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logging.warning(f"Can't update faction roles of member {member_id}: {result}")
+                        failed += 1
+                    else:
+                        succeeded.append(member_id)
+
+                # The members that failed stay pending, so that they are retried when the job is resumed
+                if len(succeeded) > 0:
+                    await self.company_manager.set_role_job_members_done(job_id, succeeded)
+                done += len(succeeded)
+                await self.edit_role_job_message(progress_message,
+                                                 self.get_role_job_embed(company_name, done, total))
+
+            if failed > 0:
+                logging.error(f"Role job {job_id} for {company_name} failed for {failed} members, "
+                              f"they will be retried at the next restart")
+                await self.edit_role_job_message(progress_message, discord.Embed(
+                    color=discord.Colour.red(),
+                    description=self.bot.get_message('role_job_failures', company=company_name, failed=failed,
+                                                     total=total)))
+                return
+
+            await self.company_manager.delete_role_job(job_id)
+            message = 'set_faction_success' if action == 'add' else 'kick_from_faction_success'
+            await self.edit_role_job_message(progress_message, discord.Embed(
+                color=discord.Colour.green(),
+                description=self.bot.get_message(message)))
+        except Exception:
+            logging.error(f"Role job {job_id} for {company_name} failed, it will be resumed at the next restart",
+                          exc_info=True)
+        finally:
+            self.running_role_jobs.discard((guild.id, company_name.lower()))
+
+    async def update_faction_roles(self, member: discord.Member, action, config, staff_role, member_role):
+        if member is None:
+            return
+        if action == 'remove':
+            await self.bot.role_editor.edit(member, remove=[staff_role, member_role])
+        elif config.roles['governatore'] in member.roles or config.roles['console'] in member.roles:
+            await self.bot.role_editor.edit(member, add=[staff_role])
+        else:
+            await self.bot.role_editor.edit(member, add=[member_role])
+
+    def get_role_job_embed(self, company_name, done, total):
+        return discord.Embed(color=discord.Colour.gold(),
+                             description=self.bot.get_message('role_job_progress', company=company_name, done=done,
+                                                              total=total))
+
+    async def edit_role_job_message(self, progress_message, embed):
+        if progress_message is None:
+            return
+        try:
+            await progress_message.edit(embed=embed)
+        except discord.HTTPException:
+            pass
@@ -1,11 +1,97 @@
+import asyncio
 import logging
+import time
+from datetime import datetime, timedelta
 from typing import Optional
 
 import discord
 from discord.ext import commands
+from sqlalchemy import LargeBinary, and_, cast, exists
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from database import Database
+from database import Database, run_in_executor
+from leaderboards import Leaderboard
+from utils import gather_limited
+
+# Number of entries shown by the leaderboards
+LEADERBOARD_SIZE = 10
+# Age after which a request still without survey channel is released, crea-compagnia takes a few seconds to create
+# it, also when it runs in another process of the bot
+INTERRUPTED_REQUEST_TIMEOUT = timedelta(minutes=10)
+
+
+class PendingRequest:
+    __slots__ = ('guild_id', 'member_id', 'name', 'tag', 'approve_message_id', 'approve_channel_id',
+                 'abort_message_id')
+
+    def __init__(self, guild_id, member_id, name, tag, approve_message_id, approve_channel_id, abort_message_id):
+        self.guild_id = guild_id
+        self.member_id = member_id
+        self.name = name
+        self.tag = tag
+        self.approve_message_id = approve_message_id
+        self.approve_channel_id = approve_channel_id
+        self.abort_message_id = abort_message_id
+
+
+class PendingInvite:
+    __slots__ = ('message_id', 'guild_id', 'channel_id', 'inviter_id', 'member_id', 'company_name', 'expires_at')
+
+    def __init__(self, message_id, guild_id, channel_id, inviter_id, member_id, company_name, expires_at):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        # DM channel of the invited member
+        self.channel_id = channel_id
+        self.inviter_id = inviter_id
+        self.member_id = member_id
+        self.company_name = company_name
+        self.expires_at = expires_at
+
+
+class ReservationError(Exception):
+    """Raised when the constraints reject a Company request, message is the error message to show to the member"""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def get_reservation_error(ex: IntegrityError):
+    """Returns the error message for a violated constraint of company_names. SQLite reports the columns of the
+    constraint, MySQL its name"""
+    error = str(ex.orig)
+    if 'uq_company_names_tag' in error or 'company_names.tag' in error:
+        return 'tag_already_exists'
+    return 'company_already_exists'
+
+
+class RequestRegistry:
+    """Pending Company requests indexed by requester (guild id, member id), approval message and survey channel"""
+
+    def __init__(self):
+        self.by_member = dict()
+        self.by_message = dict()
+        self.by_channel = dict()
+
+    def add(self, request: PendingRequest):
+        self.by_member[(request.guild_id, request.member_id)] = request
+        if request.approve_message_id is not None:
+            self.by_message[request.approve_message_id] = request
+        if request.approve_channel_id is not None:
+            self.by_channel[request.approve_channel_id] = request
+
+    def remove(self, guild_id, member_id) -> Optional[PendingRequest]:
+        request = self.by_member.pop((guild_id, member_id), None)
+        if request is not None:
+            self.by_message.pop(request.approve_message_id, None)
+            self.by_channel.pop(request.approve_channel_id, None)
+        return request
+
+    def set_approval_message(self, request: PendingRequest, message_id):
+        self.by_message.pop(request.approve_message_id, None)
+        request.approve_message_id = message_id
+        self.by_message[message_id] = request
 
 
 class CompanyManager(commands.Cog):
@@ -14,421 +100,975 @@ class CompanyManager(commands.Cog):
         self.user_model: Database.User.__class__ = self.bot.db.User
         self.company_model: Database.Company.__class__ = self.bot.db.Company
         self.request_model: Database.CompanyRequest.__class__ = self.bot.db.CompanyRequest
-        self.approval_messages = self.fetch_approval_messages()
+        self.company_name_model: Database.CompanyName.__class__ = self.bot.db.CompanyName
+        self.invite_model: Database.Invite.__class__ = self.bot.db.Invite
+        self.survey_model: Database.Survey.__class__ = self.bot.db.Survey
+        self.role_job_model: Database.RoleJob.__class__ = self.bot.db.RoleJob
+        self.role_job_member_model: Database.RoleJobMember.__class__ = self.bot.db.RoleJobMember
+        self.requests = RequestRegistry()
+        # Invites waiting for a reaction by message id, mirrored in the database
+        self.invites = dict()
+
+        # Write-through cache (guild id, member id) -> company name, None until it has been loaded from the database
+        self.memberships: Optional[dict] = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Guild id -> richest Companies and (guild id, lowercase company name) -> top donors of the Company, updated
+        # with every donation
+        self.company_leaderboards = dict()
+        self.donor_leaderboards = dict()
 
     def create_session(self) -> Session:
         return self.bot.db.Session()
 
+    async def load(self):
+        requests, self.memberships, invites, scores = await asyncio.gather(
+            self.fetch_requests(), self.fetch_memberships(), self.fetch_invites(), self.fetch_scores())
+        self.load_leaderboards(*scores)
+        self.invites = {row[0]: PendingInvite(*row) for row in invites}
+        for row in requests:
+            request = PendingRequest(*row)
+            # Without survey channel crea-compagnia has not completed the request yet
+            if request.approve_channel_id is not None:
+                self.requests.add(request)
+                self.register_reactions(request)
+        await self.release_interrupted_requests()
+
+    async def release_interrupted_requests(self):
+        """Releases the requests of the guilds of this process whose crea-compagnia was interrupted before creating
+        the survey channel. The recent ones may still be completed by a running command and are checked again when
+        they are old enough"""
+        released, waiting = await self.delete_interrupted_requests([guild.id for guild in self.bot.guilds],
+                                                                   datetime.utcnow() - INTERRUPTED_REQUEST_TIMEOUT)
+        for guild_id, name in released:
+            logging.info(f"Released the interrupted request for Company {name} in guild {guild_id}")
+        if waiting > 0:
+            self.bot.loop.call_later(INTERRUPTED_REQUEST_TIMEOUT.total_seconds(),
+                                     lambda: self.bot.loop.create_task(self.release_interrupted_requests()))
+
     #
-    # Listeners
+    # Reaction handlers, called by the ReactionRouter for the messages registered by register_reactions
     #
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        emoji_check = self.bot.cfg['Emoji']['check']
-        emoji_cross = self.bot.cfg['Emoji']['cross']
-
+    async def handle_approval_reaction(self, payload: discord.RawReactionActionEvent):
+        member: discord.Member = payload.member
+        if member is None or member.bot:
+            return
+        roles = self.bot.get_guild_config(member.guild).roles
+        if roles['approve_companies'] not in member.roles:
+            return
         emoji = str(payload.emoji)
+        if emoji not in self.bot.settings.reaction_emojis:
+            return
+        request = self.requests.by_message.get(payload.message_id)
+        if request is None:
+            return
+
+        # Forget the request right away, so that another reaction can't process it again
+        self.forget_request(request)
+        channel: discord.TextChannel = self.bot.get_channel(payload.channel_id)
+        company_name, company_tag = request.name, request.tag
+        requester: discord.Member = member.guild.get_member(request.member_id)
+        # A requester that left the guild can't lead the Company, the request is rejected
+        approved = emoji == self.bot.settings.emoji_check and requester is not None
+        if requester is None:
+            logging.info(f"Rejecting the request for Company {company_name}, the requester left the guild")
+        if approved:
+            role: discord.Role = await member.guild.create_role(name=company_name)
+            governatore_role: discord.Role = roles['governatore']
+            await self.bot.role_editor.edit(requester,
+                                            add=[role, governatore_role, roles['to_add']],
+                                            remove=[roles['to_remove']],
+                                            nick=f"{company_tag} - {requester.display_name}")
+
+            category: discord.CategoryChannel = await member.guild.create_category(company_name)
+
+            staff_role = roles['connect_to_voice']
+            see_voice = roles['view_voice_channels']
+            see_voice_2 = roles['view_voice_channels_2']
+            voice_ow = {
+                member.guild.default_role: discord.PermissionOverwrite(connect=False, view_channel=False),
+                staff_role: discord.PermissionOverwrite(connect=True, view_channel=True),
+                see_voice: discord.PermissionOverwrite(view_channel=True, connect=False),
+                see_voice_2: discord.PermissionOverwrite(view_channel=True, connect=False),
+                role: discord.PermissionOverwrite(connect=True, view_channel=True)
+            }
+
+            console_role = roles['console']
+            text_ow = {
+                member.guild.default_role: discord.PermissionOverwrite(read_messages=False,
+                                                                       view_channel=False),
+                governatore_role: discord.PermissionOverwrite(mention_everyone=True),
+                console_role: discord.PermissionOverwrite(mention_everyone=True),
+                role: discord.PermissionOverwrite(read_messages=True, send_messages=True, view_channel=True)
+            }
+            admin_ow = {
+                member.guild.default_role: discord.PermissionOverwrite(read_messages=False,
+                                                                       view_channel=False),
+                governatore_role: discord.PermissionOverwrite(send_messages=True, mention_everyone=True),
+                console_role: discord.PermissionOverwrite(send_messages=True, mention_everyone=True),
+                role: discord.PermissionOverwrite(read_messages=True, send_messages=False)
+            }
+
+            channels = await self.create_company_channels(category, company_tag, text_ow, admin_ow,
+                                                          voice_ow)
+            notify_channel = self.find_notify_channel(channels)
+
+            await self.create_company(company_name, company_tag, category, role, requester,
+                                      notify_channel)
+
+            await self.bot.send_success_embed(requester, 'company_creation_success')
+        elif requester is not None:
+            await self.bot.send_error_embed(requester, 'company_creation_failure')
+
+        self.bot.get_cog('User').end_survey(payload.channel_id)
+        if channel is not None:
+            await channel.delete()
+        # The name stays reserved by the new Company, or is released if the request was rejected
+        await self.remove_company_request(request.guild_id, request.member_id, None if approved else request.name)
+
+    async def handle_abort_reaction(self, payload: discord.RawReactionActionEvent):
         member: discord.Member = payload.member
         if member is None or member.bot:
             return
-        if emoji not in [emoji_check, emoji_cross]:
+        if self.bot.get_guild_config(member.guild).roles['approve_companies'] not in member.roles:
+            return
+        if str(payload.emoji) != self.bot.settings.emoji_cross:
             return
 
         channel: discord.TextChannel = self.bot.get_channel(payload.channel_id)
-        if channel is not None and channel.category is not None:
-            if channel.category.id == self.bot.cfg['CompanyCreationSurvey']['category']:
-                if self.bot.roles['approve_companies'] not in member.roles:
-                    return
-
-                if payload.message_id in self.approval_messages:
-                    requester_id, company_name, company_tag = self.get_request_by_message(payload.message_id)
-                    requester: discord.Member = member.guild.get_member(requester_id)
-                    if emoji == emoji_check:
-                        role: discord.Role = await member.guild.create_role(name=company_name)
-                        governatore_role: discord.Role = self.bot.roles['governatore']
-                        await requester.add_roles(role, governatore_role, self.bot.roles['to_add'])
-                        await requester.remove_roles(self.bot.roles['to_remove'])
-                        if requester is not member.guild.owner:
-                            try:
-                                await requester.edit(nick=f"{company_tag} - {requester.display_name}")
-                            except discord.Forbidden:
-                                logging.warning("Can't modify username of " + requester.display_name)
-
-                        category: discord.CategoryChannel = await member.guild.create_category(company_name)
-
-                        staff_role = self.bot.roles['connect_to_voice']
-                        see_voice = self.bot.roles['view_voice_channels']
-                        see_voice_2 = self.bot.roles['view_voice_channels_2']
-                        voice_ow = {
-                            member.guild.default_role: discord.PermissionOverwrite(connect=False, view_channel=False),
-                            staff_role: discord.PermissionOverwrite(connect=True, view_channel=True),
-                            see_voice: discord.PermissionOverwrite(view_channel=True, connect=False),
-                            see_voice_2: discord.PermissionOverwrite(view_channel=True, connect=False),
-                            role: discord.PermissionOverwrite(connect=True, view_channel=True)
-                        }
-
-                        console_role = self.bot.roles['console']
-                        text_ow = {
-                            member.guild.default_role: discord.PermissionOverwrite(read_messages=False,
-                                                                                   view_channel=False),
-                            governatore_role: discord.PermissionOverwrite(mention_everyone=True),
-                            console_role: discord.PermissionOverwrite(mention_everyone=True),
-                            role: discord.PermissionOverwrite(read_messages=True, send_messages=True, view_channel=True)
-                        }
-                        admin_ow = {
-                            member.guild.default_role: discord.PermissionOverwrite(read_messages=False,
-                                                                                   view_channel=False),
-                            governatore_role: discord.PermissionOverwrite(send_messages=True, mention_everyone=True),
-                            console_role: discord.PermissionOverwrite(send_messages=True, mention_everyone=True),
-                            role: discord.PermissionOverwrite(read_messages=True, send_messages=False)
-                        }
-
-                        ch_section = self.bot.cfg['CompanyChannels']
-                        for id in ch_section:
-                            ch_name: str = ch_section[id]['name'].format(tag=company_tag)
-                            ch_type = ch_section[id]['type']
-
-                            if ch_type == "text":
-                                new_ch: discord.TextChannel = await category.create_text_channel(ch_name)
-                                if ch_section[id]['admin'] == 'true':
-                                    await new_ch.edit(overwrites=admin_ow)
-                                else:
-                                    await new_ch.edit(overwrites=text_ow)
-
-                            elif ch_type == "voice":
-                                await category.create_voice_channel(ch_name, overwrites=voice_ow)
-                            else:
-                                logging.warning(f"[CompanyChannels] [[{id}]] does not have a valid type")
-
-                        self.create_company(company_name, company_tag, category, role, requester)
-
-                        await self.bot.send_success_embed(requester, 'company_creation_success')
-                    else:
-                        await self.bot.send_error_embed(requester, 'company_creation_failure')
-
-                    self.approval_messages.remove(payload.message_id)
-                    await channel.delete()
-                    self.delete_company_request(requester)
-                else:
-                    if emoji == emoji_cross:
-                        self.delete_company_request_from_channel(channel)
-                        self.bot.get_cog('User').survey_status.pop(channel.id)
-                        await channel.delete()
+        if channel is None:
+            return
+        await self.delete_company_request_from_channel(channel)
+        self.bot.get_cog('User').end_survey(channel.id)
+        await channel.delete()
 
     #
     # Methods
     #
 
-    def get_company_for(self, user: discord.Member) -> Optional[str]:
+    async def create_company_channels(self, category: discord.CategoryChannel, company_tag, text_ow, admin_ow,
+                                      voice_ow):
+        """Creates all channels in [CompanyChannels] concurrently, each with its overwrites set in the same call"""
+        start = time.perf_counter()
+        to_create = []
+        ch_section = self.bot.cfg['CompanyChannels']
+        for position, id in enumerate(ch_section):
+            ch_name: str = ch_section[id]['name'].format(tag=company_tag)
+            ch_type = ch_section[id]['type']
+
+            if ch_type == "text":
+                overwrites = admin_ow if ch_section[id]['admin'] == 'true' else text_ow
+                to_create.append(category.create_text_channel(ch_name, overwrites=overwrites, position=position))
+            elif ch_type == "voice":
+                to_create.append(category.create_voice_channel(ch_name, overwrites=voice_ow, position=position))
+            else:
+                logging.warning(f"[CompanyChannels] [[{id}]] does not have a valid type")
+
+        channels = await gather_limited(self.bot.cfg['Concurrency']['channels'], *to_create)
+        logging.info(f"Created {len(channels)} channels for {category.name} in {time.perf_counter() - start:.2f}s")
+        return channels
+
+    def find_notify_channel(self, channels) -> Optional[discord.TextChannel]:
+        """Returns the channel of a Company that receives the companies-notify messages, if any"""
+        ch_name = self.bot.cfg['CompaniesNotify']['channel_name'].lower().replace(" ", "-")
+        for ch in channels:
+            if isinstance(ch, discord.TextChannel) and ch.name.startswith(ch_name):
+                return ch
+        return None
+
+    async def get_company_for(self, user: discord.Member) -> Optional[str]:
+        if self.memberships is not None:
+            self.cache_hits += 1
+            return self.memberships.get((user.guild.id, user.id))
+
+        self.cache_misses += 1
+        return await self.fetch_company_for(user)
+
+    @run_in_executor
+    def fetch_company_for(self, user: discord.Member) -> Optional[str]:
         session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=user.id)
+        company_name = session.query(self.user_model.company_name) \
+            .filter_by(guild_id=user.guild.id, member_id=user.id).scalar()
 
         session.close()
 
-        if query.count() == 1:
-            return query[0].company_name
-        else:
-            return None
+        return company_name
 
-    def check_company_existence(self, name: str, include_requests: bool = False) -> bool:
+    @run_in_executor
+    def check_company_existence(self, guild_id, name: str) -> bool:
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
-        query2 = session.query(self.request_model).filter_by(name=name)
+        res = session.query(exists().where(and_(self.company_model.guild_id == guild_id,
+                                                self.company_model.name == name))).scalar()
 
         session.close()
 
-        if query.count() == 1 or (include_requests and query2.count() == 1):
-            return True
-        else:
-            return False
+        return bool(res)
 
-    def check_tag_existence(self, tag: str) -> bool:
-        session = self.create_session()
-        query = session.query(self.company_model).filter_by(tag=tag)
-        query2 = session.query(self.request_model).filter_by(tag=tag)
+    def check_request_existance_for(self, user: discord.Member):
+        return (user.guild.id, user.id) in self.requests.by_member
 
-        session.close()
+    @run_in_executor
+    def reserve_company_request(self, member: discord.Member, name: str, tag: str):
+        """Saves the request of the member and reserves its name and tag in one transaction, instead of checking
+        them first, so that concurrent requests and other processes of the bot can't take the same ones.
+        Raises ReservationError if the member already has a request or the name or the tag are taken"""
+        session = self.create_session()
+        try:
+            session.add(self.request_model(guild_id=member.guild.id, member_id=member.id, name=name, tag=tag,
+                                           created_at=datetime.utcnow()))
+            try:
+                session.flush()
+            except IntegrityError:
+                raise ReservationError('request_pending')
+            session.add(self.company_name_model(guild_id=member.guild.id, name=name, tag=tag))
+            try:
+                session.flush()
+            except IntegrityError as ex:
+                raise ReservationError(get_reservation_error(ex))
+            session.commit()
+        finally:
+            # Rolls back the request if the reservation failed
+            session.close()
 
-        if query.count() == 1 or query2.count() == 1:
-            return True
-        else:
+    async def create_company_request(self, member: discord.Member, name: str, tag: str,
+                                     channel: discord.TextChannel, abort_message: discord.Message) -> bool:
+        """Completes the request reserved by reserve_company_request with its survey channel. Returns False if the
+        reservation has been released in the meantime, see release_interrupted_requests"""
+        if not await self.save_company_request(member, channel, abort_message):
             return False
-
-    def check_request_existance_for(self, user: discord.Member):
+        request = PendingRequest(member.guild.id, member.id, name, tag, None, channel.id, abort_message.id)
+        self.requests.add(request)
+        self.register_reactions(request)
+        return True
+
+    @run_in_executor
+    def save_company_request(self, member: discord.Member, channel: discord.TextChannel,
+                             abort_message: discord.Message) -> bool:
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(member_id=user.id)
+        updated = session.query(self.request_model) \
+            .filter(self.request_model.guild_id == member.guild.id, self.request_model.member_id == member.id,
+                    self.request_model.approve_channel_id.is_(None)) \
+            .update({self.request_model.approve_channel_id: channel.id,
+                     self.request_model.abort_message_id: abort_message.id}, synchronize_session=False)
 
+        session.commit()
         session.close()
 
-        if query.count() == 1:
-            return True
-        else:
-            return False
+        return updated == 1
+
+    def register_reactions(self, request: PendingRequest):
+        if request.approve_message_id is not None:
+            self.bot.reactions.register(request.approve_message_id, self.handle_approval_reaction)
+        if request.abort_message_id is not None:
+            self.bot.reactions.register(request.abort_message_id, self.handle_abort_reaction)
 
-    def create_company_request(self, member: discord.Member, name: str, tag: str, channel: discord.TextChannel):
+    def forget_request(self, request: PendingRequest):
+        """Removes the request from memory, its reactions are no longer handled"""
+        if self.requests.remove(request.guild_id, request.member_id) is not None:
+            self.bot.reactions.unregister(request.approve_message_id, request.abort_message_id)
+
+    async def delete_company_request_from_channel(self, channel: discord.TextChannel):
+        request = self.requests.by_channel.get(channel.id)
+        if request is not None:
+            self.forget_request(request)
+            await self.remove_company_request(request.guild_id, request.member_id, request.name)
+
+    @run_in_executor
+    def remove_company_request(self, guild_id, member_id, released_name=None):
+        """Deletes the request, released_name is the name whose reservation is deleted with it"""
         session = self.create_session()
-        new_request = self.request_model(member_id=member.id, name=name, tag=tag, approve_channel_id=channel.id)
-        session.add(new_request)
+        session.query(self.request_model).filter_by(guild_id=guild_id, member_id=member_id) \
+            .delete(synchronize_session=False)
+        if released_name is not None:
+            session.query(self.company_name_model).filter_by(guild_id=guild_id, name=released_name) \
+                .delete(synchronize_session=False)
 
         session.commit()
         session.close()
 
-    def delete_company_request(self, member: discord.Member):
+    async def set_request_approval_id(self, member: discord.Member, message: discord.Message):
+        request = self.requests.by_member.get((member.guild.id, member.id))
+        if request is not None:
+            await self.save_request_approval_id(member, message)
+            self.bot.reactions.unregister(request.approve_message_id)
+            self.requests.set_approval_message(request, message.id)
+            self.register_reactions(request)
+
+    @run_in_executor
+    def save_request_approval_id(self, member: discord.Member, message: discord.Message):
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(member_id=member.id)
+        session.query(self.request_model).filter_by(guild_id=member.guild.id, member_id=member.id) \
+            .update({self.request_model.approve_message_id: message.id}, synchronize_session=False)
 
-        if query.count() == 1:
-            session.delete(query[0])
-            session.commit()
+        session.commit()
         session.close()
 
-    def delete_company_request_from_channel(self, channel: discord.TextChannel):
+    @run_in_executor
+    def delete_interrupted_requests(self, guild_ids, cutoff: datetime):
+        """Deletes the requests of the guilds without survey channel created before cutoff, with their reserved
+        names. Returns the (guild id, name) of the deleted requests and the number of newer ones left"""
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(approve_channel_id=channel.id)
-
-        if query.count() == 1:
-            session.delete(query[0])
-            session.commit()
+        request = self.request_model
+        rows = session.query(request.guild_id, request.member_id, request.name, request.created_at) \
+            .filter(request.guild_id.in_(guild_ids), request.approve_channel_id.is_(None)).all()
+        released = []
+        waiting = 0
+        for row in rows:
+            if row.created_at >= cutoff:
+                waiting += 1
+                continue
+            # Unless crea-compagnia has completed the request since it was read
+            deleted = session.query(request) \
+                .filter(request.guild_id == row.guild_id, request.member_id == row.member_id,
+                        request.approve_channel_id.is_(None)) \
+                .delete(synchronize_session=False)
+            if deleted == 1:
+                session.query(self.company_name_model).filter_by(guild_id=row.guild_id, name=row.name) \
+                    .delete(synchronize_session=False)
+                released.append((row.guild_id, row.name))
 
+        session.commit()
         session.close()
 
-    def get_request_by_message(self, message_id: int):
+        return released, waiting
+
+    @run_in_executor
+    def fetch_requests(self):
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(approve_message_id=message_id)
+        request = self.request_model
+        rows = session.query(request.guild_id, request.member_id, request.name, request.tag,
+                             request.approve_message_id, request.approve_channel_id, request.abort_message_id).all()
 
         session.close()
 
-        if query.count() == 1:
-            return query[0].member_id, query[0].name, query[0].tag
-        else:
-            return None, None
+        return [(row.guild_id, row.member_id, row.name, row.tag, row.approve_message_id, row.approve_channel_id,
+                 row.abort_message_id) for row in rows]
+
+    async def create_invite(self, message: discord.Message, inviter: discord.Member, member: discord.Member,
+                            company_name, expires_at) -> PendingInvite:
+        invite = PendingInvite(message.id, member.guild.id, message.channel.id, inviter.id, member.id, company_name,
+                               expires_at)
+        await self.save_invite(invite)
+        self.invites[invite.message_id] = invite
+        return invite
 
-    def get_request_for(self, member: discord.Member):
+    @run_in_executor
+    def save_invite(self, invite: PendingInvite):
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(member_id=member.id)
+        session.add(self.invite_model(message_id=invite.message_id, guild_id=invite.guild_id,
+                                      channel_id=invite.channel_id,
+                                      inviter_id=invite.inviter_id, member_id=invite.member_id,
+                                      company_name=invite.company_name, expires_at=invite.expires_at))
 
+        session.commit()
         session.close()
 
-        if query.count() == 1:
-            return query[0].name, query[0].tag
-        else:
-            return None, None
-
-    def set_request_approval_id(self, member: discord.Member, message: discord.Message):
+    def forget_invites(self, message_ids) -> list:
+        """Removes the invites from memory, their reactions are no longer handled. Returns the invites removed"""
+        invites = []
+        for message_id in message_ids:
+            invite = self.invites.pop(message_id, None)
+            if invite is not None:
+                invites.append(invite)
+        self.bot.reactions.unregister(*message_ids)
+        return invites
+
+    async def delete_invites(self, message_ids: list) -> list:
+        invites = self.forget_invites(message_ids)
+        if len(invites) > 0:
+            await self.remove_invites([invite.message_id for invite in invites])
+        return invites
+
+    @run_in_executor
+    def remove_invites(self, message_ids: list):
         session = self.create_session()
-        query = session.query(self.request_model).filter_by(member_id=member.id)
-
-        if query.count() == 1:
-            query[0].approve_message_id = message.id
-            self.approval_messages.append(message.id)
+        session.query(self.invite_model).filter(self.invite_model.message_id.in_(message_ids)) \
+            .delete(synchronize_session=False)
 
         session.commit()
         session.close()
 
-    def fetch_approval_messages(self):
+    def get_expired_invites(self, now: datetime) -> list:
+        return [message_id for message_id, invite in self.invites.items() if invite.expires_at <= now]
+
+    @run_in_executor
+    def fetch_invites(self):
         session = self.create_session()
-        query = session.query(self.request_model.approve_message_id)
+        invite = self.invite_model
+        rows = session.query(invite.message_id, invite.guild_id, invite.channel_id, invite.inviter_id,
+                             invite.member_id, invite.company_name, invite.expires_at).all()
 
         session.close()
 
-        res = list()
-        for row in query:
-            res.append(row.approve_message_id)
-        return res
+        return [(row.message_id, row.guild_id, row.channel_id, row.inviter_id, row.member_id, row.company_name,
+                 row.expires_at) for row in rows]
 
-    def create_company(self, name, tag, category, role: discord.Role, governor: discord.Member):
-        session = self.create_session()
-        new_company = self.company_model(name=name, tag=tag, category_id=category.id, role=role.id)
-        session.add(new_company)
+    async def create_company(self, name, tag, category, role: discord.Role, governor: discord.Member,
+                             notify_channel: discord.TextChannel = None):
+        await self.save_company(name, tag, category, role, governor, notify_channel)
+        if self.memberships is not None:
+            self.memberships[(governor.guild.id, governor.id)] = name
 
-        query = session.query(self.user_model).filter_by(member_id=governor.id)
-        if query.count() == 1:
-            query[0].company = new_company
-        else:
-            new_user = self.user_model(member_id=governor.id)
-            session.add(new_user)
-            new_user.company = new_company
+    @run_in_executor
+    def save_company(self, name, tag, category, role: discord.Role, governor: discord.Member,
+                     notify_channel: discord.TextChannel = None):
+        session = self.create_session()
+        session.add(self.company_model(guild_id=governor.guild.id, name=name, tag=tag, category_id=category.id,
+                                       role=role.id,
+                                       notify_channel_id=notify_channel.id if notify_channel is not None else None))
+        session.flush()
+        self.set_member_company(session, governor.guild.id, governor.id, name)
 
         session.commit()
         session.close()
 
-    def get_company_members(self, name):
-        session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
+    def set_member_company(self, session: Session, guild_id, member_id, company_name):
+        """Points the member to the company, creating the user row if this is the first time we see the member"""
+        self.update_user(session, guild_id, member_id, {self.user_model.company_name: company_name},
+                         company_name=company_name)
+
+    def update_user(self, session: Session, guild_id, member_id, values, **new_row):
+        """Updates the row of the member with values, inserting it with the columns in new_row if there is none.
+        A concurrent transaction may insert the row after the update found none: the insert then fails in its own
+        savepoint, keeping the rest of the transaction, and the update is repeated on the new row"""
+        query = session.query(self.user_model).filter_by(guild_id=guild_id, member_id=member_id)
+        if query.update(values, synchronize_session=False) > 0:
+            return
+        try:
+            with session.begin_nested():
+                session.add(self.user_model(guild_id=guild_id, member_id=member_id, **new_row))
+        except IntegrityError:
+            query.update(values, synchronize_session=False)
+
+    def query_company_with_members(self, session: Session, guild_id, name, *columns):
+        """Selects the given company columns together with the id of every member in a single statement,
+        returns None if the company doesn't exist"""
+        rows = session.query(*columns, self.user_model.member_id) \
+            .outerjoin(self.company_model.members) \
+            .filter(self.company_model.guild_id == guild_id, self.company_model.name == name).all()
+        if len(rows) == 0:
+            return None
 
-        if query.count() == 1:
-            members = []
-            for member in query[0].members:
-                members.append(member.member_id)
+        members = []
+        for row in rows:
+            if row.member_id is not None:
+                members.append(row.member_id)
+        return rows[0], members
 
-            session.close()
+    @run_in_executor
+    def get_company_members(self, guild_id, name):
+        session = self.create_session()
+        res = self.query_company_with_members(session, guild_id, name, self.company_model.name)
 
-            return members
-        else:
-            session.close()
+        session.close()
 
+        if res is not None:
+            return res[1]
+        else:
             return None
 
-    def get_company_category(self, name):
+    @run_in_executor
+    def get_company_category(self, guild_id, name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
+        category_id = session.query(self.company_model.category_id).filter_by(guild_id=guild_id, name=name).scalar()
 
         session.close()
 
-        if query.count() == 1:
-            return query[0].category_id
-        else:
-            return None
+        return category_id
 
-    def get_company_basic_info(self, name):
+    @run_in_executor
+    def get_company_basic_info(self, guild_id, name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
+        row = session.query(self.company_model.tag, self.company_model.role, self.company_model.faction) \
+            .filter_by(guild_id=guild_id, name=name).one_or_none()
 
         session.close()
 
-        if query.count() == 1:
-            return query[0].tag, query[0].role, query[0].faction
+        if row is not None:
+            return row.tag, row.role, row.faction
         else:
-            return None, None
+            return None, None, None
 
-    def get_company_info(self, name):
+    @run_in_executor
+    def get_company_info(self, guild_id, name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
-
-        if query.count() == 1:
-            members = []
-            for member in query[0].members:
-                members.append(member.member_id)
+        res = self.query_company_with_members(session, guild_id, name, self.company_model.category_id,
+                                              self.company_model.role, self.company_model.faction)
 
-            session.close()
+        session.close()
 
-            return query[0].category_id, query[0].role, query[0].faction, members
+        if res is not None:
+            company, members = res
+            return company.category_id, company.role, company.faction, members
         else:
-            session.close()
-
             return None, None, None, None
 
-    def delete_company(self, name):
+    async def delete_company(self, guild_id, name):
+        deleted_name = await self.remove_company(guild_id, name)
+        if deleted_name is not None and self.memberships is not None:
+            for key in [k for k, v in self.memberships.items() if k[0] == guild_id and v == deleted_name]:
+                self.memberships.pop(key)
+        if deleted_name is not None:
+            self.forget_invites([message_id for message_id, invite in self.invites.items()
+                                 if invite.guild_id == guild_id and invite.company_name == deleted_name])
+            self.get_company_leaderboard(guild_id).remove(deleted_name)
+            self.donor_leaderboards.pop((guild_id, deleted_name.lower()), None)
+
+    @run_in_executor
+    def remove_company(self, guild_id, name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=name)
-
-        if query.count() == 1:
-            session.delete(query[0])
+        deleted_name = session.query(self.company_model.name).filter_by(guild_id=guild_id, name=name).scalar()
+
+        if deleted_name is not None:
+            session.query(self.user_model).filter_by(guild_id=guild_id, company_name=deleted_name) \
+                .update({self.user_model.company_name: None, self.user_model.company_donations: 0},
+                        synchronize_session=False)
+            session.query(self.invite_model).filter_by(guild_id=guild_id, company_name=deleted_name) \
+                .delete(synchronize_session=False)
+            session.query(self.company_model).filter_by(guild_id=guild_id, name=deleted_name) \
+                .delete(synchronize_session=False)
+            session.query(self.company_name_model).filter_by(guild_id=guild_id, name=deleted_name) \
+                .delete(synchronize_session=False)
+            # A role job waiting to retry its failed members would give the faction roles back to the ex-members
+            jobs = session.query(self.role_job_model.id).filter_by(guild_id=guild_id, company_name=deleted_name)
+            session.query(self.role_job_member_model).filter(self.role_job_member_model.job_id.in_(jobs.subquery())) \
+                .delete(synchronize_session=False)
+            jobs.delete(synchronize_session=False)
             session.commit()
 
         session.close()
 
-    def get_company_list(self):
+        return deleted_name
+
+    @run_in_executor
+    def get_company_list(self, guild_id):
         session = self.create_session()
-        query = session.query(self.company_model.name)
+        rows = session.query(self.company_model.name).filter_by(guild_id=guild_id).all()
 
         session.close()
 
         res = list()
-        for row in query:
+        for row in rows:
             res.append(row.name)
         return res
 
-    def get_companies_categories(self):
+    @run_in_executor
+    def get_notify_channels(self, guild_id):
         session = self.create_session()
-        query = session.query(self.company_model.name, self.company_model.category_id)
+        rows = session.query(self.company_model.name, self.company_model.category_id,
+                             self.company_model.notify_channel_id).filter_by(guild_id=guild_id).all()
 
         session.close()
 
         res = dict()
-        for row in query:
-            res[row.name] = row.category_id
+        for row in rows:
+            res[row.name] = row.category_id, row.notify_channel_id
         return res
 
-    def set_faction(self, company_name, faction):
+    @run_in_executor
+    def set_notify_channels(self, guild_id, channels: dict):
+        """Records the notify channel id of each company in the given dict company name -> channel id"""
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
+        for name, channel_id in channels.items():
+            session.query(self.company_model).filter_by(guild_id=guild_id, name=name) \
+                .update({self.company_model.notify_channel_id: channel_id}, synchronize_session=False)
 
-        if query.count() == 1:
-            query[0].faction = faction
-            session.commit()
+        session.commit()
+        session.close()
+
+    @run_in_executor
+    def set_faction(self, guild_id, company_name, faction):
+        session = self.create_session()
+        session.query(self.company_model).filter_by(guild_id=guild_id, name=company_name) \
+            .update({self.company_model.faction: faction}, synchronize_session=False)
 
+        session.commit()
         session.close()
 
-    def get_faction_for(self, company_name):
+    @run_in_executor
+    def get_faction_for(self, guild_id, company_name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
+        faction = session.query(self.company_model.faction).filter_by(guild_id=guild_id, name=company_name).scalar()
 
         session.close()
 
-        if query.count() == 1:
-            return query[0].faction
-        else:
-            return None
+        return faction
 
-    def get_faction_info(self, company_name):
+    @run_in_executor
+    def get_faction_info(self, guild_id, company_name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
+        res = self.query_company_with_members(session, guild_id, company_name, self.company_model.faction)
 
-        if query.count() == 1:
-            members = []
-            for member in query[0].members:
-                members.append(member.member_id)
-
-            session.close()
+        session.close()
 
-            return query[0].faction, members
+        if res is not None:
+            company, members = res
+            return company.faction, members
         else:
-            session.close()
             return None, None
 
-    def kick_from_faction(self, company_name):
+    @run_in_executor
+    def kick_from_faction(self, guild_id, company_name):
         session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
+        session.query(self.company_model).filter_by(guild_id=guild_id, name=company_name) \
+            .update({self.company_model.faction: None}, synchronize_session=False)
 
-        if query.count() == 1:
-            query[0].faction = None
-            session.commit()
+        session.commit()
+        session.close()
+
+    async def add_member_to_company(self, company_name, member: discord.Member):
+        name = await self.save_member_company(company_name, member)
+        if self.memberships is not None:
+            self.memberships[(member.guild.id, member.id)] = name
+
+    @run_in_executor
+    def save_member_company(self, company_name, member: discord.Member):
+        session = self.create_session()
+        # The lookup is case insensitive, use the name as stored in the database
+        name = session.query(self.company_model.name).filter_by(guild_id=member.guild.id, name=company_name).scalar()
+        self.set_member_company(session, member.guild.id, member.id, name)
 
+        session.commit()
         session.close()
 
-    def add_member_to_company(self, company_name, member: discord.Member):
+        return name
+
+    async def remove_member_from_company(self, member: discord.Member):
+        await self.clear_member_company(member)
+        self.forget_member(member.guild.id, member.id)
+
+    @run_in_executor
+    def clear_member_company(self, member: discord.Member):
         session = self.create_session()
-        company = session.query(self.company_model).filter_by(name=company_name)[0]
-        query = session.query(self.user_model).filter_by(member_id=member.id)
+        # The donations count only towards the current Company
+        session.query(self.user_model).filter_by(guild_id=member.guild.id, member_id=member.id) \
+            .update({self.user_model.company_name: None, self.user_model.company_donations: 0},
+                    synchronize_session=False)
 
-        if query.count() == 1:
-            query[0].company = company
-        else:
-            new_user = self.user_model(member_id=member.id)
-            session.add(new_user)
-            new_user.company = company
+        session.commit()
+        session.close()
+
+    #
+    # Economy, every change is a single UPDATE of the balance relative to its current value, so that concurrent
+    # changes never overwrite each other
+    #
+
+    @run_in_executor
+    def get_balance(self, member: discord.Member):
+        """Returns the balance of the member, the donations to the Company and the balance of the Company"""
+        session = self.create_session()
+        row = session.query(self.user_model.balance, self.user_model.company_donations,
+                            self.company_model.balance.label('company_balance')) \
+            .outerjoin(self.user_model.company) \
+            .filter(self.user_model.guild_id == member.guild.id, self.user_model.member_id == member.id).first()
+
+        session.close()
+
+        if row is None:
+            return 0, 0, None
+        return row.balance, row.company_donations, row.company_balance
+
+    def add_to_balance(self, session: Session, guild_id, member_id, amount):
+        """Adds amount to the balance of the member, creating the user row if this is the first time we see the
+        member"""
+        self.update_user(session, guild_id, member_id, {self.user_model.balance: self.user_model.balance + amount},
+                         balance=amount)
+
+    @run_in_executor
+    def deposit(self, member: discord.Member, amount):
+        session = self.create_session()
+        self.add_to_balance(session, member.guild.id, member.id, amount)
 
         session.commit()
         session.close()
 
-    def remove_member_from_company(self, member: discord.Member):
+    async def donate(self, member: discord.Member, company_name, amount) -> bool:
+        """Moves amount from the balance of the member to the balance of the Company, returns False if the member
+        can't afford it or is no longer in the Company"""
+        if not await self.save_donation(member, company_name, amount):
+            return False
+        self.get_company_leaderboard(member.guild.id).add(company_name, amount)
+        self.get_donor_leaderboard(member.guild.id, company_name).add(member.id, amount)
+        return True
+
+    @run_in_executor
+    def save_donation(self, member: discord.Member, company_name, amount) -> bool:
         session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member.id)
+        user = self.user_model
+        # The condition is checked by the UPDATE itself, no read can go stale before the write
+        updated = session.query(user) \
+            .filter(user.guild_id == member.guild.id, user.member_id == member.id, user.company_name == company_name,
+                    user.balance >= amount) \
+            .update({user.balance: user.balance - amount, user.company_donations: user.company_donations + amount},
+                    synchronize_session=False)
+        if updated == 1:
+            session.query(self.company_model).filter_by(guild_id=member.guild.id, name=company_name) \
+                .update({self.company_model.balance: self.company_model.balance + amount},
+                        synchronize_session=False)
+            session.commit()
+
+        session.close()
+
+        return updated == 1
 
-        if query.count() == 1:
-            query[0].company = None
+    @run_in_executor
+    def transfer(self, sender: discord.Member, receiver: discord.Member, amount) -> bool:
+        """Moves amount from the balance of sender to the balance of receiver, returns False if sender can't
+        afford it"""
+        session = self.create_session()
+        guild_id = sender.guild.id
+        user = self.user_model
+
+        def withdraw():
+            return session.query(user) \
+                .filter(user.guild_id == guild_id, user.member_id == sender.id, user.balance >= amount) \
+                .update({user.balance: user.balance - amount}, synchronize_session=False) == 1
+
+        # Rows are always updated in member id order, so that two opposite transfers can't deadlock on MySQL
+        if sender.id < receiver.id:
+            done = withdraw()
+            if done:
+                self.add_to_balance(session, guild_id, receiver.id, amount)
+        else:
+            self.add_to_balance(session, guild_id, receiver.id, amount)
+            done = withdraw()
+        if done:
             session.commit()
 
+        # Rolls back the deposit if the withdrawal failed
         session.close()
 
-    def reset_donations(self, member: discord.Member):
+        return done
+
+    async def delete_member(self, guild_id, member_id):
+        await self.remove_member(guild_id, member_id)
+        self.forget_member(guild_id, member_id)
+
+    def forget_member(self, guild_id, member_id):
+        """Removes the member that left its Company from the membership cache, its donations no longer count"""
+        if self.memberships is not None:
+            company_name = self.memberships.pop((guild_id, member_id), None)
+            if company_name is not None:
+                self.get_donor_leaderboard(guild_id, company_name).remove(member_id)
+
+    @run_in_executor
+    def remove_member(self, guild_id, member_id):
         session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member.id)
+        session.query(self.user_model).filter_by(guild_id=guild_id, member_id=member_id) \
+            .delete(synchronize_session=False)
 
-        if query.count() == 1:
-            query[0].company_donations = 0
-            session.commit()
+        session.commit()
+        session.close()
+
+    @run_in_executor
+    def fetch_memberships(self):
+        session = self.create_session()
+        rows = session.query(self.user_model.guild_id, self.user_model.member_id, self.user_model.company_name) \
+            .filter(self.user_model.company_name.isnot(None)).all()
+
+        session.close()
+
+        res = dict()
+        for row in rows:
+            res[(row.guild_id, row.member_id)] = row.company_name
+        return res
+
+    @run_in_executor
+    def fetch_surveys(self):
+        session = self.create_session()
+        rows = session.query(self.survey_model.channel_id, self.survey_model.member_id, self.survey_model.step,
+                             self.survey_model.answers).all()
 
         session.close()
 
-    def delete_member(self, member_id):
+        return [(row.channel_id, row.member_id, row.step, row.answers) for row in rows]
+
+    @run_in_executor
+    def save_surveys(self, surveys: list, deleted: list):
+        """Writes a batch of survey changes, surveys is a list of dicts with the columns of the changed surveys
+        and deleted is a list of the channel ids of the surveys to remove"""
         session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member_id)
+        to_remove = [survey['channel_id'] for survey in surveys] + deleted
+        if len(to_remove) > 0:
+            session.query(self.survey_model).filter(self.survey_model.channel_id.in_(to_remove)) \
+                .delete(synchronize_session=False)
+        if len(surveys) > 0:
+            session.bulk_insert_mappings(self.survey_model, surveys)
 
-        if query.count() == 1:
-            session.delete(query[0])
-            session.commit()
+        session.commit()
+        session.close()
+
+    @run_in_executor
+    def create_role_job(self, guild_id, action, company_name, faction, channel_id, members):
+        """Saves a new role job for all the members of the Company, replacing a previous job of the Company that
+        is waiting to retry its failed members"""
+        session = self.create_session()
+        previous = session.query(self.role_job_model.id).filter_by(guild_id=guild_id, company_name=company_name)
+        session.query(self.role_job_member_model).filter(self.role_job_member_model.job_id.in_(previous.subquery())) \
+            .delete(synchronize_session=False)
+        previous.delete(synchronize_session=False)
+        job = self.role_job_model(guild_id=guild_id, action=action, company_name=company_name, faction=faction,
+                                  total=len(members), channel_id=channel_id)
+        session.add(job)
+        session.flush()
+        job_id = job.id
+        session.bulk_insert_mappings(self.role_job_member_model,
+                                     [{'job_id': job_id, 'member_id': member_id, 'done': False}
+                                      for member_id in members])
 
+        session.commit()
+        session.close()
+
+        return job_id
+
+    @run_in_executor
+    def set_role_job_message(self, job_id, message_id):
+        session = self.create_session()
+        session.query(self.role_job_model).filter_by(id=job_id) \
+            .update({self.role_job_model.message_id: message_id}, synchronize_session=False)
+
+        session.commit()
+        session.close()
+
+    @run_in_executor
+    def set_role_job_members_done(self, job_id, member_ids):
+        session = self.create_session()
+        session.query(self.role_job_member_model) \
+            .filter(self.role_job_member_model.job_id == job_id,
+                    self.role_job_member_model.member_id.in_(member_ids)) \
+            .update({self.role_job_member_model.done: True}, synchronize_session=False)
+
+        session.commit()
         session.close()
+
+    @run_in_executor
+    def delete_role_job(self, job_id):
+        session = self.create_session()
+        session.query(self.role_job_member_model).filter_by(job_id=job_id).delete(synchronize_session=False)
+        session.query(self.role_job_model).filter_by(id=job_id).delete(synchronize_session=False)
+
+        session.commit()
+        session.close()
+
+    @run_in_executor
+    def fetch_role_jobs(self):
+        """Returns every unfinished role job together with the ids of the members still to process"""
+        session = self.create_session()
+        job, job_member = self.role_job_model, self.role_job_member_model
+        rows = session.query(job.id, job.guild_id, job.action, job.company_name, job.faction, job.total,
+                             job.channel_id, job.message_id, job_member.member_id) \
+            .outerjoin(job_member, and_(job_member.job_id == job.id, job_member.done.is_(False))) \
+            .order_by(job.id).all()
+
+        session.close()
+
+        res = dict()
+        for row in rows:
+            if row.id not in res:
+                res[row.id] = (row.id, row.guild_id, row.action, row.company_name, row.faction, row.total,
+                               row.channel_id, row.message_id, [])
+            if row.member_id is not None:
+                res[row.id][8].append(row.member_id)
+        return list(res.values())
+
+    #
+    # Leaderboards, the rankings are kept in memory and the indexed top-N queries are used to verify them
+    #
+
+    def get_company_leaderboard(self, guild_id) -> Leaderboard:
+        board = self.company_leaderboards.get(guild_id)
+        if board is None:
+            board = self.company_leaderboards[guild_id] = Leaderboard(LEADERBOARD_SIZE)
+        return board
+
+    def get_donor_leaderboard(self, guild_id, company_name) -> Leaderboard:
+        key = (guild_id, company_name.lower())
+        board = self.donor_leaderboards.get(key)
+        if board is None:
+            board = self.donor_leaderboards[key] = Leaderboard(LEADERBOARD_SIZE)
+        return board
+
+    def load_leaderboards(self, companies, donors):
+        """Builds the leaderboards from the scores returned by fetch_scores"""
+        self.company_leaderboards = dict()
+        self.donor_leaderboards = dict()
+        for guild_id, name, balance in companies:
+            self.get_company_leaderboard(guild_id).set(name, balance)
+        for guild_id, company_name, member_id, donations in donors:
+            self.get_donor_leaderboard(guild_id, company_name).set(member_id, donations)
+
+    @run_in_executor
+    def fetch_scores(self):
+        """Returns the balance of every Company and the donations of every member to its Company"""
+        session = self.create_session()
+        company, user = self.company_model, self.user_model
+        companies = session.query(company.guild_id, company.name, company.balance).filter(company.balance > 0).all()
+        donors = session.query(user.guild_id, user.company_name, user.member_id, user.company_donations) \
+            .filter(user.company_name.isnot(None), user.company_donations > 0).all()
+
+        session.close()
+
+        return companies, donors
+
+    def query_top_companies(self, session: Session, guild_id):
+        company = self.company_model
+        # Ties are broken by the bytes of the name, not by its collation: UTF-8 bytes sort like the code points
+        # compared by the leaderboard in memory, the case insensitive collations of SQLite and MySQL don't
+        return [(row.name, row.balance) for row in
+                session.query(company.name, company.balance).filter(company.guild_id == guild_id, company.balance > 0)
+                .order_by(company.balance.desc(), cast(company.name, LargeBinary).desc()).limit(LEADERBOARD_SIZE)]
+
+    def query_top_donors(self, session: Session, guild_id, company_name):
+        user = self.user_model
+        return [(row.member_id, row.company_donations) for row in
+                session.query(user.member_id, user.company_donations)
+                .filter(user.guild_id == guild_id, user.company_name == company_name, user.company_donations > 0)
+                .order_by(user.company_donations.desc(), user.member_id.desc()).limit(LEADERBOARD_SIZE)]
+
+    @run_in_executor
+    def fetch_rankings(self, guild_id):
+        """Recomputes the leaderboards of the guild, returns the richest Companies and a dict lowercase company name
+        -> top donors"""
+        session = self.create_session()
+        companies = self.query_top_companies(session, guild_id)
+        donors = {name.lower(): self.query_top_donors(session, guild_id, name) for name, in
+                  session.query(self.company_model.name).filter_by(guild_id=guild_id)}
+
+        session.close()
+
+        return companies, donors
+
+    async def check_leaderboards(self, guild_id):
+        """Compares the leaderboards of the guild with the ones recomputed by the database, reloading all of them
+        if they differ. Returns the number of leaderboards checked and the names of the ones that were out of sync,
+        None for the richest Companies"""
+        companies, donors = await self.fetch_rankings(guild_id)
+
+        mismatches = []
+        if self.get_company_leaderboard(guild_id).top() != companies:
+            mismatches.append(None)
+        names = donors.keys() | {name for board_guild_id, name in self.donor_leaderboards if board_guild_id == guild_id}
+        for name in names:
+            board = self.donor_leaderboards.get((guild_id, name))
+            if (board.top() if board is not None else []) != donors.get(name, []):
+                mismatches.append(name)
+        if len(mismatches) > 0:
+            logging.warning(f"Leaderboards out of sync for guild {guild_id}: {mismatches}, reloading them")
+            self.load_leaderboards(*await self.fetch_scores())
+
+        return len(names) + 1, mismatches
+
+    async def check_membership_cache(self):
+        """Compares the membership cache with the database, reloading the cache if they differ.
+        Returns the number of members checked and the (guild id, member id) of the ones that were out of sync."""
+        db_memberships = await self.fetch_memberships()
+        cached = self.memberships if self.memberships is not None else dict()
+
+        mismatches = [key for key in db_memberships.keys() | cached.keys()
+                      if db_memberships.get(key) != cached.get(key)]
+        if len(mismatches) > 0:
+            logging.warning(f"Membership cache out of sync for members {mismatches}, reloading it")
+            self.memberships = db_memberships
+
+        return len(db_memberships), mismatches
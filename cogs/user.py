@@ -1,12 +1,24 @@
-import re
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 import logging
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import BadArgument
 
 from cogs import company_manager
+from guilds import GuildConfig
+from metrics import instrumented
+from surveys import COMPLETED, SurveyMachine
+from utils import gather_limited
+
+# Seconds between two writes of the changed surveys to the database
+SURVEY_SAVE_INTERVAL = 10
+# Maximum length of the member list in a username alert, Discord messages are limited to 2000 characters
+USERNAME_ALERT_MEMBERS_LENGTH = 1500
+# Seconds between two checks for expired invites, and maximum number of invites deleted with one query
+INVITE_SWEEP_INTERVAL = 10 * 60
+INVITE_SWEEP_BATCH = 500
 
 
 class User(commands.Cog):
@@ -20,15 +32,31 @@ class User(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.company_manager: 'company_manager.CompanyManager' = bot.get_cog('CompanyManager')
-        self.survey_status = dict()
-        self.survey_questions = self.bot.cfg['CompanyCreationSurvey']['questions']
+        self.surveys = SurveyMachine()
+        # Guild id -> members with a non compliant username that joined since the last alert, with the patterns they
+        # matched, and the task that sends the alert
+        self.flagged_usernames = dict()
+        self.username_alert_tasks = dict()
+
+    def load(self, surveys):
+        self.surveys.load(surveys)
+        self.save_surveys_task.start()
+        for message_id in self.company_manager.invites:
+            self.bot.reactions.register(message_id, self.handle_invite_reaction)
+        self.expire_invites_task.start()
+
+    def cog_unload(self):
+        self.save_surveys_task.cancel()
+        self.expire_invites_task.cancel()
+        for task in self.username_alert_tasks.values():
+            task.cancel()
 
     async def cog_check(self, ctx: commands.Context) -> bool:
         if ctx.author.guild_permissions.administrator:
             return True
 
         is_cmd_channel = False
-        cmd_channel = self.bot.cfg['Channels']['user_command_channel']
+        cmd_channel = self.bot.get_guild_config(ctx.guild).user_command_channel_id
         if cmd_channel != '':
             is_cmd_channel = cmd_channel == ctx.channel.id
         return is_cmd_channel
@@ -38,103 +66,108 @@ class User(commands.Cog):
     #
 
     @commands.Cog.listener()
+    @instrumented
     async def on_member_join(self, member: discord.Member):
-        name_regex = self.bot.cfg['Username']['regex']
-        channel = member.guild.get_channel(self.bot.cfg['Username']['channel'])
-        if channel is None:
-            logging.warning("Can't find username warn channel")
+        patterns = self.bot.settings.username_patterns
+        if not patterns:
             return
-        if name_regex != '':
-            match = re.search(name_regex, member.display_name)
-            if match is not None:
-                await channel.send(self.bot.get_message('username_warn', member=member.mention))
+        matched = patterns.match(member.display_name)
+        if len(matched) > 0:
+            # During a raid hundreds of members join in a minute, alert once for all of them
+            self.flagged_usernames.setdefault(member.guild.id, []).append((member.mention, matched))
+            if member.guild.id not in self.username_alert_tasks:
+                self.username_alert_tasks[member.guild.id] = self.bot.loop.create_task(
+                    self.send_username_alert(member.guild))
 
     @commands.Cog.listener()
+    @instrumented
     async def on_member_remove(self, member: discord.Member):
-        self.company_manager.delete_member(member.id)
+        await self.company_manager.delete_member(member.guild.id, member.id)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if not message.author.bot and isinstance(message.channel, discord.TextChannel) and \
-                message.channel.category is not None:
-            if message.channel.category.id == self.bot.cfg['CompanyCreationSurvey']['category']:
-                if message.channel.id in self.survey_status and self.survey_status[message.channel.id] >= 0:
-                    if self.bot.roles['approve_companies'] in message.author.roles:
-                        return
-
-                    if self.survey_status[message.channel.id] < len(self.survey_questions):
-                        await self.bot.send_survey_embed(message.channel,
-                                                         self.survey_questions[self.survey_status[message.channel.id]])
-                        self.survey_status[message.channel.id] += 1
-                    else:
-                        self.survey_status.pop(message.channel.id)
-                        name, tag = self.company_manager.get_request_for(message.author)
-                        if name is not None:
-                            await self.bot.send_survey_embed(message.channel,
-                                                             self.bot.cfg['CompanyCreationSurvey']['last_message'])
-                            apply_embed = discord.Embed(color=discord.Color.gold())
-                            apply_embed.set_author(
-                                name=f'{message.author.display_name}#{message.author.discriminator}',
-                                icon_url=message.author.avatar_url)
-                            apply_embed.title = 'Richiesta approvazione Compagnia'
-                            apply_embed.add_field(name='Nome Compagnia', value=name)
-                            apply_embed.add_field(name='Tag Compagnia', value=tag)
-                            apply_embed.timestamp = datetime.utcnow()
-                            approval_message = await message.channel.send(embed=apply_embed)
-                            self.company_manager.set_request_approval_id(message.author, approval_message)
-                            await approval_message.add_reaction(self.bot.cfg['Emoji']['check'])
-                            await approval_message.add_reaction(self.bot.cfg['Emoji']['cross'])
-
-                            await message.channel.guild.get_channel(self.bot.cfg['Channels']['company_apply_channel']) \
-                                .send(self.bot.get_message('company_apply_done', channel=message.channel.mention))
+        # Runs for every message of the guild, only the answers to the surveys are measured and handled
+        if message.channel.id in self.surveys.active and not message.author.bot:
+            await self.on_survey_answer(message)
+
+    @instrumented
+    async def on_survey_answer(self, message: discord.Message):
+        config = self.bot.get_guild_config(message.guild)
+        if config.roles['approve_companies'] in message.author.roles:
+            return
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if payload.guild_id is not None:
+        settings = self.bot.settings
+        step = self.surveys.answer(message.channel.id, message.content, len(settings.survey_questions))
+        if step != COMPLETED:
+            await self.bot.send_survey_embed(message.channel, settings.survey_questions[step])
             return
-        user: discord.User = self.bot.get_user(payload.user_id)
-        if user is None or user.bot:
+
+        request = self.company_manager.requests.by_channel.get(message.channel.id)
+        if request is not None:
+            await self.bot.send_survey_embed(message.channel, settings.survey_last_message)
+            apply_embed = discord.Embed(color=discord.Color.gold())
+            apply_embed.set_author(name=f'{message.author.display_name}#{message.author.discriminator}',
+                                   icon_url=message.author.avatar_url)
+            apply_embed.title = 'Richiesta approvazione Compagnia'
+            apply_embed.add_field(name='Nome Compagnia', value=request.name)
+            apply_embed.add_field(name='Tag Compagnia', value=request.tag)
+            apply_embed.timestamp = datetime.utcnow()
+            approval_message = await message.channel.send(embed=apply_embed)
+            await self.company_manager.set_request_approval_id(message.author, approval_message)
+            await approval_message.add_reaction(settings.emoji_check)
+            await approval_message.add_reaction(settings.emoji_cross)
+
+            await message.guild.get_channel(config.apply_channel_id) \
+                .send(self.bot.get_message('company_apply_done', channel=message.channel.mention))
+
+    async def handle_invite_reaction(self, payload: discord.RawReactionActionEvent):
+        """Reaction router handler of the recruit invites sent in DM"""
+        invite: company_manager.PendingInvite = self.company_manager.invites.get(payload.message_id)
+        # The reactions added by the bot to the invite are dispatched too
+        if invite is None or payload.user_id != invite.member_id:
             return
-        emoji_check = self.bot.cfg['Emoji']['check']
-        emoji_cross = self.bot.cfg['Emoji']['cross']
+        settings = self.bot.settings
+        emoji_check = settings.emoji_check
+        emoji_cross = settings.emoji_cross
         emoji = str(payload.emoji)
-        if emoji not in [emoji_check, emoji_cross]:
+        if emoji not in settings.reaction_emojis:
             return
-        dm_channel = user.dm_channel
-        if dm_channel is None:
-            dm_channel = await user.create_dm()
-        message: discord.Message = await dm_channel.fetch_message(payload.message_id)
-        if not message.author.bot:
-            return
-        if len(message.embeds) != 1 or len(message.embeds[0].fields) != 1:
+        guild = self.bot.get_guild(invite.guild_id)
+        channel = self.bot.get_channel(payload.channel_id)
+        user: discord.User = self.bot.get_user(payload.user_id)
+        if guild is None or (channel is None and user is None):
             return
-        company_name = None
-        try:
-            company_name = message.embeds[0].fields[0].__getattribute__('value')
-        except AttributeError:
+
+        # Forget the invite right away, so that another reaction can't process it again
+        await self.company_manager.delete_invites([invite.message_id])
+        if channel is None:
+            channel = await user.create_dm()
+        message: discord.PartialMessage = channel.get_partial_message(invite.message_id)
+        if invite.expires_at <= datetime.utcnow():
+            await message.edit(embed=self.get_expired_invite_embed())
             return
 
         await message.remove_reaction(emoji_check, self.bot.user)
         await message.remove_reaction(emoji_cross, self.bot.user)
         if emoji == emoji_check:
-            member = self.bot.guilds[0].get_member(user.id)
+            member = guild.get_member(invite.member_id)
             if member is None:
-                await self.bot.send_error_embed(user, 'no_longer_in_server')
+                await self.bot.send_error_embed(channel, 'no_longer_in_server')
                 await message.delete()
                 return
-            if self.company_manager.get_company_for(member) is not None:
-                await self.bot.send_error_embed(user, 'already_in_company')
+            if await self.company_manager.get_company_for(member) is not None:
+                await self.bot.send_error_embed(channel, 'already_in_company')
                 await message.delete()
                 return
 
             try:
-                await self.add_to_company(member, company_name)
+                await self.add_to_company(member, invite.company_name)
             except CompanyError:
-                await self.bot.send_error_embed(user, 'company_not_exists')
+                await self.bot.send_error_embed(channel, 'company_not_exists')
                 await message.delete()
                 return
             except RoleError:
-                await self.bot.send_error_embed(user, 'role_error')
+                await self.bot.send_error_embed(channel, 'role_error')
                 await message.delete()
                 return
 
@@ -155,67 +188,88 @@ class User(commands.Cog):
     async def create_company(self, ctx: commands.Context, name: str, tag: str):
         if ctx.author.guild_permissions.administrator:
             ctx.command.reset_cooldown(ctx)
-        apply_channel: discord.TextChannel = ctx.guild.get_channel(self.bot.cfg['Channels']['company_apply_channel'])
-        survey_category: discord.CategoryChannel = ctx.guild.get_channel(
-            self.bot.cfg['CompanyCreationSurvey']['category'])
+        settings = self.bot.settings
+        config = self.bot.get_guild_config(ctx.guild)
+        apply_channel: discord.TextChannel = ctx.guild.get_channel(config.apply_channel_id)
+        survey_category: discord.CategoryChannel = ctx.guild.get_channel(config.survey_category_id)
         if apply_channel is None or survey_category is None or not isinstance(survey_category, discord.CategoryChannel):
             ctx.command.reset_cooldown(ctx)
             return await self.bot.send_error_embed(ctx, 'not_configured')
         if len(tag) > 4:
             ctx.command.reset_cooldown(ctx)
             return await self.bot.send_error_embed(ctx, 'tag_invalid')
-        if self.company_manager.get_company_for(ctx.author) is not None:
+        if await self.company_manager.get_company_for(ctx.author) is not None:
             ctx.command.reset_cooldown(ctx)
             return await self.bot.send_error_embed(ctx, 'already_in_company')
         if self.company_manager.check_request_existance_for(ctx.author):
             ctx.command.reset_cooldown(ctx)
             return await self.bot.send_error_embed(ctx, 'request_pending')
-        if self.company_manager.check_company_existence(name, include_requests=True):
-            ctx.command.reset_cooldown(ctx)
-            return await self.bot.send_error_embed(ctx, 'company_already_exists')
-        if self.company_manager.check_tag_existence(tag):
+        try:
+            await self.company_manager.reserve_company_request(ctx.author, name, tag)
+        except company_manager.ReservationError as ex:
             ctx.command.reset_cooldown(ctx)
-            return await self.bot.send_error_embed(ctx, 'tag_already_exists')
+            return await self.bot.send_error_embed(ctx, ex.message)
 
         overwrites = {
             ctx.guild.default_role: discord.PermissionOverwrite(read_messages=False, add_reactions=False),
             ctx.author: discord.PermissionOverwrite(read_messages=True)
         }
-        survey_channel: discord.TextChannel = await survey_category \
-            .create_text_channel(name=f"Richiesta di {ctx.author.display_name}",
-                                 overwrites=overwrites)
-        await survey_channel.send(ctx.author.mention)
-        msg = await self.bot.send_survey_embed(survey_channel, self.bot.cfg['CompanyCreationSurvey']['first_message'])
-        await msg.add_reaction(self.bot.cfg['Emoji']['cross'])
-        await self.bot.send_survey_embed(survey_channel, self.survey_questions[0])
-        self.survey_status[survey_channel.id] = 1
-
-        self.company_manager.create_company_request(ctx.author, name, tag, survey_channel)
+        survey_channel = None
+        try:
+            survey_channel: discord.TextChannel = await survey_category \
+                .create_text_channel(name=f"Richiesta di {ctx.author.display_name}",
+                                     overwrites=overwrites)
+            await survey_channel.send(ctx.author.mention)
+            msg = await self.bot.send_survey_embed(survey_channel, settings.survey_first_message)
+            await msg.add_reaction(settings.emoji_cross)
+            await self.bot.send_survey_embed(survey_channel, settings.survey_questions[0])
+            self.surveys.start(survey_channel.id, ctx.author.id)
+
+            created = await self.company_manager.create_company_request(ctx.author, name, tag, survey_channel, msg)
+        except Exception:
+            # Releases the reservation, otherwise the member couldn't make another request until it expires
+            await self.company_manager.remove_company_request(ctx.guild.id, ctx.author.id, name)
+            if survey_channel is not None:
+                self.end_survey(survey_channel.id)
+                try:
+                    await survey_channel.delete()
+                except discord.HTTPException:
+                    logging.warning(f"Can't delete the survey channel of the failed request of {ctx.author.id}")
+            raise
+
+        if not created:
+            # The request took so long that it has been released as interrupted, its name may be taken already
+            self.end_survey(survey_channel.id)
+            await survey_channel.delete()
+            ctx.command.reset_cooldown(ctx)
+            return await self.bot.send_error_embed(ctx, 'request_expired')
 
         await self.bot.send_success_embed(ctx, 'company_apply_success', channel=survey_channel.mention)
 
     @commands.command(name='lista-membri', usage="{}lista-membri", description="Mostra la lista dei membri della tua Compagnia")
     async def list_members(self, ctx):
-        company = self.company_manager.get_company_for(ctx.author)
+        company = await self.company_manager.get_company_for(ctx.author)
         if company is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
             return
-        if not (self.bot.roles['console'] in ctx.author.roles or self.bot.roles['governatore'] in ctx.author.roles):
+        roles = self.bot.get_guild_config(ctx.guild).roles
+        if not (roles['console'] in ctx.author.roles or roles['governatore'] in ctx.author.roles):
             await self.bot.send_error_embed(ctx, 'only_company_staff')
             return
 
-        embed = self.get_member_list_embed(company, ctx.guild)
+        embed = await self.get_member_list_embed(company, ctx.guild)
 
         await ctx.send(embed=embed)
 
     @commands.command(name='recluta', usage="{}recluta <utente>", description="Invita un utente ad unirsi alla tua Compagnia")
     async def recruit(self, ctx, member: discord.Member):
-        company = self.company_manager.get_company_for(ctx.author)
-        member_company = self.company_manager.get_company_for(member)
+        company = await self.company_manager.get_company_for(ctx.author)
+        member_company = await self.company_manager.get_company_for(member)
         if company is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
             return
-        if not (self.bot.roles['console'] in ctx.author.roles or self.bot.roles['governatore'] in ctx.author.roles):
+        roles = self.bot.get_guild_config(ctx.guild).roles
+        if not (roles['console'] in ctx.author.roles or roles['governatore'] in ctx.author.roles):
             await self.bot.send_error_embed(ctx, 'only_company_staff')
             return
         if member_company is not None:
@@ -226,12 +280,16 @@ class User(commands.Cog):
             recruit_embed = discord.Embed(colour=discord.Colour.gold(),
                                           title=self.bot.get_message('recruit_embed_title'))
             recruit_embed.add_field(name="Compagnia", value=company)
-            recruit_embed.description = self.bot.get_message('recruit_embed_content',
-                                                             check=self.bot.cfg['Emoji']['check'],
-                                                             cross=self.bot.cfg['Emoji']['cross'])
+            settings = self.bot.settings
+            recruit_embed.description = self.bot.get_message('recruit_embed_content', check=settings.emoji_check,
+                                                             cross=settings.emoji_cross,
+                                                             expiry=settings.invite_expiry // timedelta(hours=1))
             message: discord.Message = await member.send(embed=recruit_embed)
-            await message.add_reaction(self.bot.cfg['Emoji']['check'])
-            await message.add_reaction(self.bot.cfg['Emoji']['cross'])
+            await self.company_manager.create_invite(message, ctx.author, member, company,
+                                                     datetime.utcnow() + settings.invite_expiry)
+            self.bot.reactions.register(message.id, self.handle_invite_reaction)
+            await message.add_reaction(settings.emoji_check)
+            await message.add_reaction(settings.emoji_cross)
         except discord.Forbidden:
             await self.bot.send_error_embed(ctx, 'dm_disabled')
             return
@@ -253,18 +311,19 @@ class User(commands.Cog):
 
     @commands.command(name='espelli', usage="{}espelli <utente>", description="Espelli l'utente dalla tua Compagnia")
     async def kick_from_company(self, ctx, member: discord.Member):
-        company = self.company_manager.get_company_for(ctx.author)
-        member_company = self.company_manager.get_company_for(member)
+        company = await self.company_manager.get_company_for(ctx.author)
+        member_company = await self.company_manager.get_company_for(member)
         if company is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
             return
-        if not (self.bot.roles['console'] in ctx.author.roles or self.bot.roles['governatore'] in ctx.author.roles):
+        roles = self.bot.get_guild_config(ctx.guild).roles
+        if not (roles['console'] in ctx.author.roles or roles['governatore'] in ctx.author.roles):
             await self.bot.send_error_embed(ctx, 'only_company_staff')
             return
         if member_company != company:
             await self.bot.send_error_embed(ctx, 'member_not_in_your_company')
             return
-        if self.bot.roles['console'] in member.roles and self.bot.roles['governatore'] not in ctx.author.roles:
+        if roles['console'] in member.roles and roles['governatore'] not in ctx.author.roles:
             await self.bot.send_error_embed(ctx, 'expel_console_error')
             return
 
@@ -284,6 +343,65 @@ class User(commands.Cog):
             pass
         await self.bot.send_success_embed(ctx, 'expel_success')
 
+    @commands.command(name='saldo', usage="{}saldo", description="Mostra il tuo saldo e quello della tua Compagnia")
+    async def balance(self, ctx):
+        balance, donations, company_balance = await self.company_manager.get_balance(ctx.author)
+        if company_balance is None:
+            await self.bot.send_success_embed(ctx, 'balance', balance=f"{balance:g}")
+        else:
+            await self.bot.send_success_embed(ctx, 'balance_company', balance=f"{balance:g}",
+                                              donations=f"{donations:g}", company_balance=f"{company_balance:g}")
+
+    @commands.command(name='dona', usage="{}dona <importo>", description="Dona parte del tuo saldo alla tua Compagnia")
+    async def donate(self, ctx, amount: int):
+        if amount <= 0:
+            await self.bot.send_error_embed(ctx, 'amount_invalid')
+            return
+        company = await self.company_manager.get_company_for(ctx.author)
+        if company is None:
+            await self.bot.send_error_embed(ctx, 'not_in_company')
+            return
+
+        if not await self.company_manager.donate(ctx.author, company, amount):
+            await self.bot.send_error_embed(ctx, 'insufficient_balance')
+            return
+
+        await self.bot.send_success_embed(ctx, 'donate_success', amount=amount, company=company)
+
+    @commands.command(name='trasferisci', usage="{}trasferisci <utente> <importo>",
+                      description="Trasferisci parte del tuo saldo a un altro utente")
+    async def transfer(self, ctx, member: discord.Member, amount: int):
+        if amount <= 0:
+            await self.bot.send_error_embed(ctx, 'amount_invalid')
+            return
+        if member == ctx.author or member.bot:
+            await self.bot.send_error_embed(ctx, 'transfer_invalid')
+            return
+
+        if not await self.company_manager.transfer(ctx.author, member, amount):
+            await self.bot.send_error_embed(ctx, 'insufficient_balance')
+            return
+
+        await self.bot.send_success_embed(ctx, 'transfer_success', amount=amount, member=member.display_name)
+
+    @commands.command(name='classifica', usage="{}classifica",
+                      description="Mostra i membri che hanno donato di più alla tua Compagnia")
+    async def donors_leaderboard(self, ctx):
+        company = await self.company_manager.get_company_for(ctx.author)
+        if company is None:
+            await self.bot.send_error_embed(ctx, 'not_in_company')
+            return
+
+        board = self.company_manager.get_donor_leaderboard(ctx.guild.id, company)
+        await ctx.send(embed=self.get_leaderboard_embed(board, 'leaderboard_donors_title', lambda key: f"<@{key}>",
+                                                        company=company))
+
+    @commands.command(name='classifica-compagnie', usage="{}classifica-compagnie",
+                      description="Mostra le Compagnie con il saldo più alto")
+    async def companies_leaderboard(self, ctx):
+        board = self.company_manager.get_company_leaderboard(ctx.guild.id)
+        await ctx.send(embed=self.get_leaderboard_embed(board, 'leaderboard_companies_title', str))
+
     @commands.command(name='comandi', usage="{}comandi", description="Mostra questo messaggio di aiuto")
     async def companies_help(self, ctx):
         help_embed = discord.Embed(color=discord.Colour.blue(), title='__**Comandi Compagnie**__')
@@ -312,58 +430,143 @@ class User(commands.Cog):
     # Helpers
     #
 
-    async def add_to_company(self, member: discord.Member, company: str):
-        tag, role_id, faction = self.company_manager.get_company_basic_info(company)
+    async def add_to_company(self, member: discord.Member, company: str, staff_role: discord.Role = None):
+        """Makes the member join the company, if staff_role is given the member joins as part of the company staff"""
+        tag, role_id, faction = await self.company_manager.get_company_basic_info(member.guild.id, company)
         if role_id is None:
             raise CompanyError
-        role = self.bot.guilds[0].get_role(role_id)
+        role = member.guild.get_role(role_id)
         if role is None:
             raise RoleError
+        config = self.bot.get_guild_config(member.guild)
+        to_add = [role, config.roles['to_add']]
+        if staff_role is not None:
+            to_add.append(staff_role)
         if faction is not None:
-            faction_member_role = self.bot.faction_roles[faction]['member']
-            await member.add_roles(role, self.bot.roles['to_add'], faction_member_role)
-        else:
-            await member.add_roles(role, self.bot.roles['to_add'])
-        await member.remove_roles(self.bot.roles['to_remove'])
-        if member is not member.guild.owner:
-            try:
-                await member.edit(nick=f"{tag} - {member.display_name}")
-            except discord.Forbidden:
-                logging.warning("Can't modify username of " + member.display_name)
-        self.company_manager.add_member_to_company(company, member)
+            to_add.append(config.faction_roles[faction]['staff' if staff_role is not None else 'member'])
+        await self.bot.role_editor.edit(member, add=to_add, remove=[config.roles['to_remove']],
+                                        nick=f"{tag} - {member.display_name}")
+        await self.company_manager.add_member_to_company(company, member)
 
     async def remove_from_company(self, member: discord.Member, prevent_governatore_removal=True, delete_from_db=True):
-        company = self.company_manager.get_company_for(member)
+        company = await self.company_manager.get_company_for(member)
         if company is None:
             raise CompanyError
-        if self.bot.roles['governatore'] in member.roles:
-            if prevent_governatore_removal:
-                raise RoleError
-            else:
-                await member.remove_roles(self.bot.roles['governatore'])
+        config = self.bot.get_guild_config(member.guild)
+        if config.roles['governatore'] in member.roles and prevent_governatore_removal:
+            raise RoleError
 
-        self.company_manager.reset_donations(member)
-        if member is not member.guild.owner:
-            try:
-                await member.edit(nick=None)
-            except discord.Forbidden:
-                logging.warning("Can't modify username of " + member.display_name)
-        tag, role_id, faction = self.company_manager.get_company_basic_info(company)
-        role = member.guild.get_role(role_id)
-        console_role = self.bot.roles['console']
-        if faction is not None:
-            faction_member_role = self.bot.faction_roles[faction]['member']
-            faction_staff_role = self.bot.faction_roles[faction]['staff']
-            await member.remove_roles(role, self.bot.roles['to_add'], console_role, faction_staff_role,
-                                      faction_member_role)
-        else:
-            await member.remove_roles(role, self.bot.roles['to_add'], console_role)
-        await member.add_roles(self.bot.roles['to_remove'])
+        tag, role_id, faction = await self.company_manager.get_company_basic_info(member.guild.id, company)
+        await self.bot.role_editor.edit(member, add=[config.roles['to_remove']],
+                                        remove=self.get_company_roles(config, member.guild.get_role(role_id),
+                                                                      faction),
+                                        nick=None)
         if delete_from_db:
-            self.company_manager.remove_member_from_company(member)
+            await self.company_manager.remove_member_from_company(member)
+
+    async def send_username_alert(self, guild: discord.Guild):
+        """Waits for the alert window to end, then sends a single alert for all the flagged members"""
+        window = self.bot.settings.username_alert_window
+        await asyncio.sleep(window)
+        flagged = self.flagged_usernames.pop(guild.id)
+        self.username_alert_tasks.pop(guild.id)
+
+        channel = guild.get_channel(self.bot.get_guild_config(guild).username_channel_id)
+        if channel is None:
+            logging.warning(f"Can't find username warn channel, {len(flagged)} alerts discarded")
+            return
+        if len(flagged) == 1:
+            await channel.send(self.bot.get_message('username_warn', member=flagged[0][0]))
+            return
+
+        counts = dict()
+        for _, matched in flagged:
+            for name in matched:
+                counts[name] = counts.get(name, 0) + 1
+        members = ''
+        for i, (mention, _) in enumerate(flagged):
+            if len(members) + len(mention) > USERNAME_ALERT_MEMBERS_LENGTH:
+                members += ' ' + self.bot.get_message('username_warn_others', count=len(flagged) - i)
+                break
+            members += (', ' if i > 0 else '') + mention
+        await channel.send(self.bot.get_message('username_warn_batch', count=len(flagged), seconds=window,
+                                                patterns=', '.join(f"{name}: {count}"
+                                                                   for name, count in counts.items()),
+                                                members=members))
+
+    def end_survey(self, channel_id):
+        """Forgets the survey of a request channel that has been deleted"""
+        self.surveys.end(channel_id)
+
+    @tasks.loop(seconds=SURVEY_SAVE_INTERVAL)
+    async def save_surveys_task(self):
+        await self.save_surveys()
+
+    async def save_surveys(self):
+        if len(self.surveys.changed) == 0 and len(self.surveys.deleted) == 0:
+            return
+
+        changed, deleted = self.surveys.pop_changes()
+        try:
+            await self.company_manager.save_surveys(changed, deleted)
+        except Exception:
+            logging.error("Can't save surveys, retrying later", exc_info=True)
+            self.surveys.restore_changes(changed, deleted)
+
+    @tasks.loop(seconds=INVITE_SWEEP_INTERVAL)
+    async def expire_invites_task(self):
+        expired = self.company_manager.get_expired_invites(datetime.utcnow())
+        for i in range(0, len(expired), INVITE_SWEEP_BATCH):
+            invites = await self.company_manager.delete_invites(expired[i:i + INVITE_SWEEP_BATCH])
+            # The invited member may have deleted the message or closed the DMs, the invite expires anyway
+            await gather_limited(self.bot.cfg['Concurrency']['invites'],
+                                 *(self.expire_invite_message(invite) for invite in invites), return_exceptions=True)
+        if len(expired) > 0:
+            logging.info(f"Expired {len(expired)} invites")
+
+    async def expire_invite_message(self, invite: 'company_manager.PendingInvite'):
+        channel = self.bot.get_channel(invite.channel_id)
+        if channel is None:
+            user: discord.User = self.bot.get_user(invite.member_id)
+            if user is None:
+                return
+            channel = await user.create_dm()
+        await channel.get_partial_message(invite.message_id).edit(embed=self.get_expired_invite_embed())
+
+    def get_expired_invite_embed(self):
+        return discord.Embed(colour=discord.Colour.red(), title="Invito Scaduto",
+                             description=self.bot.get_message('join_company_expired'))
+
+    def get_leaderboard_embed(self, board, title, format_key, **kwargs):
+        """Returns the embed of the top entries of the leaderboard, rendered again only after they change"""
+        if board.rendered is None:
+            lines = [f"{rank}. {format_key(key)} **-** {score:g}" for rank, (key, score) in enumerate(board.top(), 1)]
+            board.rendered = discord.Embed(colour=discord.Colour.gold(), title=self.bot.get_message(title, **kwargs),
+                                           description='\n'.join(lines) or self.bot.get_message('leaderboard_empty'))
+        return board.rendered
+
+    def get_company_roles(self, config: GuildConfig, company_role, faction):
+        """Returns every role a member can have because of being in a company"""
+        roles = [company_role, config.roles['to_add'], config.roles['governatore'], config.roles['console']]
+        if faction is not None:
+            roles.append(config.faction_roles[faction]['member'])
+            roles.append(config.faction_roles[faction]['staff'])
+        return roles
+
+    async def set_company_staff(self, member: discord.Member, staff_role: discord.Role, faction):
+        """Promotes a company member to Governatore or Console, replacing the other staff role"""
+        config = self.bot.get_guild_config(member.guild)
+        to_remove = [config.roles['governatore'], config.roles['console']]
+        to_remove.remove(staff_role)
+        to_add = [staff_role]
+        if faction is not None:
+            to_remove.append(config.faction_roles[faction]['member'])
+            to_add.append(config.faction_roles[faction]['staff'])
+        await self.bot.role_editor.edit(member, add=to_add, remove=to_remove)
 
-    def get_member_list_embed(self, company, guild):
-        members = self.company_manager.get_company_members(company)
+    async def get_member_list_embed(self, company, guild):
+        members = await self.company_manager.get_company_members(guild.id, company)
+        roles = self.bot.get_guild_config(guild).roles
         embed = discord.Embed(colour=discord.Colour.teal(), title=f"Membri {company}")
         governatore = ''
         consoli = ''
@@ -373,12 +576,12 @@ class User(commands.Cog):
 
             if member is None:
                 logging.warning(f"Member with id {member_id} cannot be found in current guild")
-                self.company_manager.delete_member(member_id)
+                await self.company_manager.delete_member(guild.id, member_id)
                 break
 
-            if self.bot.roles['governatore'] in member.roles:
+            if roles['governatore'] in member.roles:
                 governatore += f"{member.display_name}\n"
-            elif self.bot.roles['console'] in member.roles:
+            elif roles['console'] in member.roles:
                 consoli += f"- {member.display_name}\n"
             else:
                 membri += f"- {member.display_name}\n"
@@ -1,6 +1,9 @@
+import asyncio
 import logging
 import logging.handlers
+import os
 import sys
+import time
 
 import discord
 from configobj import ConfigObj
@@ -9,21 +12,35 @@ from validate import Validator
 
 from cogs import user, admin, company_manager
 from database import Database
+from guilds import GuildConfig
+from metrics import Metrics
+from reactions import ReactionRouter
+from roles import RoleEditor
+from settings import Settings
 
-logging.basicConfig(level=logging.INFO)
-fh = logging.handlers.RotatingFileHandler('logs/error.log', maxBytes=1000000, backupCount=4)
-fh.setLevel(logging.INFO)
-fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s : %(name)s : %(message)s', datefmt='%m-%d %H:%M:%S'))
-logging.getLogger('').addHandler(fh)
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default_config.ini')
 
 
 class Config:
     def __init__(self):
-        self.cfgspec = ['[SpecialRoles]', '__many__ = id',
+        self.cfgspec = ['[Database]', "backend = option('mysql', 'sqlite', default='mysql')",
+                        "path = string(default='companies.db')", 'workers = integer(min=1, default=4)',
+                        "liveness = option('pre_ping', 'recycle', 'optimistic', default='pre_ping')",
+                        'pool_size = integer(min=1, default=5)', 'max_overflow = integer(min=0, default=10)',
+                        'pool_recycle = integer(min=1, default=3600)',
+                        '[Concurrency]', 'channels = integer(min=1, default=4)',
+                        'roles = integer(min=1, default=5)', 'teardown = integer(min=1, default=5)',
+                        'notify = integer(min=1, default=5)', 'invites = integer(min=1, default=5)',
+                        '[Metrics]', "file = string(default='')", 'interval = integer(min=1, default=60)',
+                        '[SpecialRoles]', '__many__ = id',
                         '[Channels]', '__many__ = id',
                         '[CompanyCreationSurvey]', 'category = id', 'questions = custom_list',
-                        '[Username]', 'channel = id',
+                        '[Username]', 'channel = id', 'alert_window = integer(min=1, default=30)',
+                        '[Invites]', 'expiry = integer(min=1, default=48)',
                         '[Factions]', '[[__many__]]', 'member_role = id', 'staff_role = id',
+                        '[Guilds]', '[[__many__]]', '[[[SpecialRoles]]]', '__many__ = id', '[[[Channels]]]',
+                        '__many__ = id', '[[[CompanyCreationSurvey]]]', '__many__ = id', '[[[Username]]]',
+                        '__many__ = id', '[[[Factions]]]', '[[[[__many__]]]]', 'member_role = id', 'staff_role = id',
                         '[Messages]', '__many__ = multiline', ]
         self.checks = {
             'multiline': self.multiline,
@@ -31,11 +48,25 @@ class Config:
             'custom_list': self.custom_list
         }
 
-    def load(self):
-        cfg = ConfigObj('config.ini', configspec=self.cfgspec, encoding='utf8', list_values=False)
+    def load(self, path='config.ini'):
+        cfg = ConfigObj(path, configspec=self.cfgspec, encoding='utf8', list_values=False)
         cfg.validate(Validator(self.checks))
+        self.add_missing_messages(cfg)
         return cfg
 
+    def add_missing_messages(self, cfg):
+        """Fills the messages added by an update of the bot, which a config.ini written for an older version
+        doesn't have, from default_config.ini"""
+        if not os.path.exists(DEFAULT_CONFIG_PATH):
+            logging.warning(f"{DEFAULT_CONFIG_PATH} not found, messages missing from the config can't be filled")
+            return
+        defaults = ConfigObj(DEFAULT_CONFIG_PATH, encoding='utf8', list_values=False)['Messages']
+        missing = [name for name in defaults if name not in cfg['Messages']]
+        if len(missing) > 0:
+            logging.warning(f"Messages missing from the config, using the default ones: {', '.join(missing)}")
+        for name in missing:
+            cfg['Messages'][name] = self.multiline(defaults[name])
+
     def multiline(self, value):
         return value.replace('\\n', '\n')
 
@@ -50,119 +81,182 @@ class Config:
         return value.split(',')
 
 
-class CompaniesClient(commands.Bot):
-    def __init__(self, **options):
-        self.cfg = Config().load()
+class CompaniesClient(commands.AutoShardedBot):
+    def __init__(self, config_path='config.ini', **options):
+        # Seconds spent in each startup phase
+        self.startup_timings = {}
+        start = time.perf_counter()
+        self.cfg = Config().load(config_path)
+        self.settings = Settings(self.cfg)
+        self.record_startup_phase('config', start)
 
         self.db = None
+        # Set once initialize has succeeded, a failed startup is retried at the next on_ready
+        self.initialized = False
+        self.initializing = False
         super().__init__(self.cfg['Prefix'], **options)
+        self.metrics = Metrics()
+        self.http.request = self.metrics.wrap_http(self.http.request)
+        self.reactions = ReactionRouter(self.metrics)
 
         self.add_check(self.globally_block_dms)
 
-        self.roles = {
-            'connect_to_voice': None,
-            'approve_companies': None,
-            'view_voice_channels': None,
-            'view_voice_channels_2': None,
-            'governatore': None,
-            'console': None,
-            'to_remove': None,
-            'to_add': None
-        }
-        self.faction_roles = {}
+        # Guild id -> GuildConfig
+        self.guild_configs = {}
+        self.role_editor = RoleEditor()
 
     async def on_ready(self):
-        self.fetch_roles()
-        self.db = Database(self)
-        self.load_cogs()
+        # on_ready is fired again every time the bot reconnects to the gateway, even while the startup is running
+        if self.initialized:
+            # The guild cache may have been rebuilt with new role objects
+            self.load_guild_configs()
+        elif not self.initializing:
+            self.initializing = True
+            try:
+                await self.initialize()
+                self.initialized = True
+            except Exception:
+                logging.error("Startup failed, it will be retried at the next reconnection", exc_info=True)
+                self.discard_startup()
+            finally:
+                self.initializing = False
 
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening,
                                                              name=f"{self.command_prefix}comandi"))
 
         logging.info("Companies loaded in {0} servers".format(len(self.guilds)))
 
+    async def on_guild_join(self, guild):
+        self.guild_configs[guild.id] = GuildConfig(self.cfg, guild)
+
+    async def on_guild_remove(self, guild):
+        self.guild_configs.pop(guild.id, None)
+
+    async def on_raw_reaction_add(self, payload):
+        await self.reactions.dispatch(payload)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        with self.metrics.track('command', ctx.command.qualified_name):
+            await super().invoke(ctx)
+        if not ctx.command_failed:
+            self.metrics.count_outcome(ctx.command.qualified_name, 'success')
+
     async def on_command_error(self, ctx, exception):
+        command = ctx.command.qualified_name if ctx.command is not None else ''
         if isinstance(exception, (commands.errors.MissingRequiredArgument, commands.errors.TooManyArguments)):
+            self.metrics.count_outcome(command, 'incorrect_usage')
             await self.send_error_embed(ctx, 'incorrect_command_usage',
                                         cmd=ctx.command.usage.format(self.cfg['Prefix']))
         elif isinstance(exception, commands.errors.BadArgument):
+            self.metrics.count_outcome(command, 'bad_arguments')
             await self.send_error_embed(ctx, 'bad_command_arguments')
         elif isinstance(exception, commands.errors.CheckFailure):
+            self.metrics.count_outcome(command, 'check_failure')
             if ctx.cog.qualified_name == 'Admin':
                 await self.send_error_embed(ctx, 'no_permissions')
         elif isinstance(exception, commands.errors.CommandOnCooldown):
+            self.metrics.count_outcome(command, 'cooldown')
             await self.send_error_embed(ctx, 'cooldown', time=int(exception.retry_after))
         elif isinstance(exception, commands.errors.CommandNotFound):
-            pass
+            self.metrics.count_outcome(command, 'not_found')
         else:
+            self.metrics.count_outcome(command, 'unhandled_error')
             await super().on_command_error(ctx, exception)
 
     async def globally_block_dms(self, ctx):
         return ctx.guild is not None
 
-    def fetch_roles(self):
-        guild: discord.Guild = self.guilds[0]
-
-        roles_sec: dict = self.cfg['SpecialRoles']
-        self.roles['connect_to_voice'] = guild.get_role(roles_sec['connect_to_voice'])
-        self.roles['approve_companies'] = guild.get_role(roles_sec['approve_companies'])
-        self.roles['view_voice_channels'] = guild.get_role(roles_sec['view_voice_channels'])
-        self.roles['view_voice_channels_2'] = guild.get_role(roles_sec['view_voice_channels_2'])
-        self.roles['governatore'] = guild.get_role(roles_sec['governatore'])
-        self.roles['console'] = guild.get_role(roles_sec['console'])
-        self.roles['to_remove'] = guild.get_role(roles_sec['to_remove'])
-        self.roles['to_add'] = guild.get_role(roles_sec['to_add'])
-
-        factions_sec: dict = self.cfg['Factions']
-        for faction, roles in factions_sec.items():
-            staff_role = guild.get_role(roles['staff_role'])
-            if staff_role is None:
-                logging.error(f"Il ruolo staff della fazione {faction} non è stato configurato correttamente")
-            member_role = guild.get_role(roles['member_role'])
-            if member_role is None:
-                logging.error(f"Il ruolo membri della fazione {faction} non è stato configurato correttamente")
-            self.faction_roles[faction] = {}
-            self.faction_roles[faction]['staff'] = staff_role
-            self.faction_roles[faction]['member'] = member_role
-
-        for key in self.roles.keys():
-            if self.roles[key] is None:
-                logging.error(f"Il ruolo {key} non è stato configurato correttamente")
-
-    def load_cogs(self):
-        self.add_cog(company_manager.CompanyManager(self))
-        self.add_cog(user.User(self))
+    def load_guild_configs(self):
+        """Resolves the roles and channels of every guild, the role objects are replaced when the cache is rebuilt"""
+        self.guild_configs = {guild.id: GuildConfig(self.cfg, guild) for guild in self.guilds}
+
+    def get_guild_config(self, guild: discord.Guild) -> GuildConfig:
+        config = self.guild_configs.get(guild.id)
+        if config is None:
+            config = self.guild_configs[guild.id] = GuildConfig(self.cfg, guild)
+        return config
+
+    async def initialize(self):
+        start = time.perf_counter()
+        self.load_guild_configs()
+        start = self.record_startup_phase('roles', start)
+
+        self.db = Database(self)
+        await self.db.run(self.db.create_tables)
+        start = self.record_startup_phase('db', start)
+
+        manager = company_manager.CompanyManager(self)
+        _, surveys, role_jobs = await asyncio.gather(manager.load(), manager.fetch_surveys(),
+                                                     manager.fetch_role_jobs())
+        start = self.record_startup_phase('cache preload', start)
+
+        self.load_cogs(manager, surveys)
+        start = self.record_startup_phase('cogs', start)
+
+        await self.get_cog('Admin').resume_role_jobs(role_jobs)
+        self.record_startup_phase('role jobs', start)
+
+        logging.info("Startup completed in {0:.2f}s ({1})".format(
+            sum(self.startup_timings.values()),
+            ', '.join(f"{phase}: {seconds:.2f}s" for phase, seconds in self.startup_timings.items())))
+
+    def discard_startup(self):
+        """Undoes what a failed initialize has done, so that it can run again from the start"""
+        for cog in ('Admin', 'User', 'CompanyManager'):
+            self.remove_cog(cog)
+        if self.db is not None:
+            self.db.executor.shutdown(wait=False)
+            self.db.engine.dispose()
+            self.db = None
+
+    def record_startup_phase(self, phase, start):
+        end = time.perf_counter()
+        self.startup_timings[phase] = end - start
+        return end
+
+    def load_cogs(self, manager, surveys):
+        self.add_cog(manager)
+        user_cog = user.User(self)
+        user_cog.load(surveys)
+        self.add_cog(user_cog)
         self.add_cog(admin.Admin(self))
 
+    def reload_settings(self):
+        """Applies the changes made to cfg, replacing the settings snapshot in one assignment"""
+        self.settings = Settings(self.cfg)
+        self.load_guild_configs()
+
     def get_message(self, message: str, **kwargs):
-        return self.cfg['Messages'][message].format(**kwargs)
+        return self.settings.messages[message].format(**kwargs)
 
     async def send_success_embed(self, ctx, message: str, **kwargs):
-        embed = discord.Embed(
-            color=discord.Colour.green(),
-            description=self.get_message(message, **kwargs))
+        embed = self.settings.success_embeds.get(message)
+        if embed is None:
+            embed = discord.Embed(
+                color=discord.Colour.green(),
+                description=self.get_message(message, **kwargs))
         await ctx.send(embed=embed)
 
     async def send_error_embed(self, ctx, message: str, **kwargs):
-        embed = discord.Embed(
-            color=discord.Colour.red(),
-            description=self.get_message(message, **kwargs))
+        embed = self.settings.error_embeds.get(message)
+        if embed is None:
+            embed = discord.Embed(
+                color=discord.Colour.red(),
+                description=self.get_message(message, **kwargs))
         await ctx.send(embed=embed)
 
     async def send_survey_embed(self, channel, raw_message: str):
-        embed = discord.Embed(
-            color=discord.Colour.gold(),
-            description=raw_message)
+        embed = self.settings.survey_embeds.get(raw_message)
+        if embed is None:
+            embed = discord.Embed(
+                color=discord.Colour.gold(),
+                description=raw_message)
         msg = await channel.send(embed=embed)
         return msg
 
 
-intents = discord.Intents.default()
-intents.members = True
-bot = CompaniesClient(case_insensitive=True, help_command=None, intents=intents)
-bot.run(bot.cfg['Token'])
-
-
 def log_uncaught_exceptions(exctype, value, tb):
     logging.error("Uncaught Exception:\n" +
                   f"Type: {exctype}\n" +
@@ -170,4 +264,17 @@ def log_uncaught_exceptions(exctype, value, tb):
                   f"Traceback: {tb}\n")
 
 
-sys.excepthook = log_uncaught_exceptions
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    fh = logging.handlers.RotatingFileHandler('logs/error.log', maxBytes=1000000, backupCount=4)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s : %(name)s : %(message)s',
+                                      datefmt='%m-%d %H:%M:%S'))
+    logging.getLogger('').addHandler(fh)
+
+    intents = discord.Intents.default()
+    intents.members = True
+    bot = CompaniesClient(case_insensitive=True, help_command=None, intents=intents)
+    bot.run(bot.cfg['Token'])
+
+    sys.excepthook = log_uncaught_exceptions
@@ -1,9 +1,24 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
 import urllib.parse
-from sqlalchemy import create_engine, Column, String, BigInteger, Boolean, Float, ForeignKey, event
-from sqlalchemy.exc import OperationalError, DisconnectionError
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, inspect, Column, String, BigInteger, Boolean, DateTime, Float, ForeignKey, \
+    ForeignKeyConstraint, Index, Integer, Text, UniqueConstraint, event
+from sqlalchemy.exc import DBAPIError, DisconnectionError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.pool import Pool
+from sqlalchemy.pool import StaticPool
+
+import migrations
+
+# MySQL compares strings case insensitively, SQLite needs the NOCASE collation on the names to behave the same
+Name = String(50).with_variant(String(50, collation='NOCASE'), 'sqlite')
+Tag = String(4).with_variant(String(4, collation='NOCASE'), 'sqlite')
 
 
 class Database:
@@ -11,34 +26,139 @@ class Database:
 
     def __init__(self, bot):
         self.bot = bot
-        self.engine = create_engine(f'mysql+mysqldb://{self.bot.cfg["Database"]["user"]}:' + urllib.parse.quote_plus(self.bot.cfg["Database"]["password"]) + f'@{self.bot.cfg["Database"]["host"]}/{self.bot.cfg["Database"]["db"]}')
+        db_sec = self.bot.cfg["Database"]
+        self.backend = db_sec["backend"]
+        self.liveness = db_sec["liveness"]
+        self.engine = self.create_engine(db_sec)
         self.Session = sessionmaker(bind=self.engine)
-        event.listen(Pool, "checkout", check_connection)
+        # SQLite allows a single writer at a time: all statements go through one thread and its connection, so that
+        # they never wait on each other's locks
+        workers = 1 if self.backend == "sqlite" else db_sec["workers"]
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="database")
+
+        self.stats = {'connections': 0, 'pings': 0, 'reconnects': 0}
+        self.stats_lock = threading.Lock()
+        event.listen(self.engine, "connect", self.on_connect)
+        event.listen(self.engine, "invalidate", self.on_invalidate)
+        event.listen(self.engine, "before_cursor_execute", self.on_execute)
+        if self.liveness == "pre_ping" and self.backend == "mysql":
+            event.listen(self.engine, "checkout", self.check_connection)
+
+    def create_engine(self, db_sec):
+        if self.backend == "sqlite":
+            # The same connection is reused by the database thread for the whole life of the bot
+            engine = create_engine(f'sqlite:///{db_sec["path"]}', poolclass=StaticPool,
+                                   connect_args={'check_same_thread': False})
+            event.listen(engine, "connect", self.set_sqlite_pragmas)
+            return engine
+
+        return create_engine(f'mysql+mysqldb://{db_sec["user"]}:' + urllib.parse.quote_plus(db_sec["password"]) + f'@{db_sec["host"]}/{db_sec["db"]}',
+                             pool_size=db_sec["pool_size"], max_overflow=db_sec["max_overflow"],
+                             pool_recycle=db_sec["pool_recycle"] if self.liveness == "recycle" else -1)
+
+    def set_sqlite_pragmas(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        # Readers don't block the writer and commits don't wait for the data to reach the disk, only for the log
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Enforce ON DELETE and ON UPDATE of the foreign keys, like InnoDB does
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking function in the database thread pool, so that slow queries don't stall the event loop"""
+        start = time.perf_counter()
+        try:
+            return await self.execute(func, *args, **kwargs)
+        finally:
+            self.bot.metrics.add_db_time(time.perf_counter() - start)
+
+    async def execute(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Run in a copy of the current context, so that statements are counted for the invocation that made them
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        if self.liveness != "optimistic":
+            return await loop.run_in_executor(self.executor, call)
+
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        except DBAPIError as ex:
+            if not ex.connection_invalidated:
+                raise
+            # Optimistic disconnect handling: the pool has already discarded the dead connection, retry once
+            logging.warning("Database connection lost, retrying on a new connection")
+            return await loop.run_in_executor(self.executor, call)
+
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def on_connect(self, dbapi_con, con_record):
+        self.count('connections')
+
+    def on_invalidate(self, dbapi_con, con_record, exception):
+        self.count('reconnects')
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.bot.metrics.count_statement()
+
+    def check_connection(self, dbapi_con, con_record, con_proxy):
+        """Listener for Pool checkout events that pings every connection before using.
+        Implements pessimistic disconnect handling strategy. See also:
+        http://docs.sqlalchemy.org/en/rel_0_8/core/pooling.html#disconnect-handling-pessimistic"""
+
+        self.count('pings')
+        cursor = dbapi_con.cursor()
+        try:
+            cursor.execute("SELECT 1")  # could also be dbapi_con.ping(),
+        except self.engine.dialect.dbapi.OperationalError as ex:
+            if ex.args[0] in (2006,  # MySQL server has gone away
+                              2013,  # Lost connection to MySQL server during query
+                              2055):  # Lost connection to MySQL server at '%s', system error: %d
+                # caught by pool, which will retry with a new connection
+                raise DisconnectionError()
+            else:
+                raise
+        finally:
+            cursor.close()
 
-        self.create_tables()
+    # The Company data of each guild is separate, every table is scoped by guild_id
 
     class User(Base):
         __tablename__ = "users"
+        # remove_company clears company_name before deleting the company, SET NULL would also clear guild_id
+        # The donors ranking of a Company is read backwards from ix_users_donations, see CompanyManager.get_top_donors
+        __table_args__ = (ForeignKeyConstraint(['guild_id', 'company_name'], ['companies.guild_id', 'companies.name'],
+                                               onupdate="CASCADE"),
+                          Index('ix_users_donations', 'guild_id', 'company_name', 'company_donations', 'member_id'))
 
+        guild_id = Column(BigInteger, primary_key=True)
         member_id = Column(BigInteger, primary_key=True)
         balance = Column(Float, nullable=False, default=0)
         blacklisted = Column(Boolean, nullable=False, default=False)
-        company_name = Column(String(50), ForeignKey("companies.name", ondelete="SET NULL", onupdate="CASCADE"))
+        company_name = Column(Name, index=True)
         company = relationship("Company", back_populates="members")
-        company_donations = Column(Float, nullable=False, default=0)  # TODO Reset when leaving company
+        # Donations to the current Company, reset when leaving it
+        company_donations = Column(Float, nullable=False, default=0)
 
         def __repr__(self):
             return f"<User(id='{self.member_id}', balance='{self.balance}')>"
 
     class Company(Base):
         __tablename__ = "companies"
+        # The richest Companies ranking is read backwards from ix_companies_balance
+        __table_args__ = (UniqueConstraint('guild_id', 'tag'),
+                          Index('ix_companies_balance', 'guild_id', 'balance', 'name'))
 
-        name = Column(String(50), primary_key=True)
-        tag = Column(String(4), unique=True, nullable=False)
+        guild_id = Column(BigInteger, primary_key=True)
+        name = Column(Name, primary_key=True)
+        tag = Column(Tag, nullable=False)
         category_id = Column(BigInteger, nullable=False)
         role = Column(BigInteger, nullable=False)
         faction = Column(String(50))
         balance = Column(Float, nullable=False, default=0)
+        notify_channel_id = Column(BigInteger)
         members = relationship("User", back_populates="company")
 
         def __repr__(self):
@@ -47,30 +167,96 @@ class Database:
     class CompanyRequest(Base):
         __tablename__ = "requests"
 
+        guild_id = Column(BigInteger, primary_key=True)
         member_id = Column(BigInteger, primary_key=True)
-        name = Column(String(50), nullable=False)
-        tag = Column(String(4), nullable=False)
-        approve_message_id = Column(BigInteger)
-        approve_channel_id = Column(BigInteger)
+        name = Column(Name, nullable=False, index=True)
+        tag = Column(Tag, nullable=False, index=True)
+        approve_message_id = Column(BigInteger, index=True)
+        approve_channel_id = Column(BigInteger, index=True)
+        abort_message_id = Column(BigInteger)
+        # The default only fills the requests copied from the tables of older releases, see migrations
+        created_at = Column(DateTime, nullable=False, server_default='1970-01-01 00:00:00')
+
+    class CompanyName(Base):
+        """Name and tag taken by a Company or by a pending request. Reserved with the request in the same
+        transaction, so that the constraints reject a duplicate even when two requests race"""
+        __tablename__ = "company_names"
+        __table_args__ = (UniqueConstraint('guild_id', 'tag', name='uq_company_names_tag'),)
+
+        guild_id = Column(BigInteger, primary_key=True)
+        name = Column(Name, primary_key=True)
+        tag = Column(Tag, nullable=False)
+
+    class Invite(Base):
+        """Invite to join a Company sent in DM by the recruit command, valid until expires_at"""
+        __tablename__ = "invites"
+        __table_args__ = (ForeignKeyConstraint(['guild_id', 'company_name'], ['companies.guild_id', 'companies.name'],
+                                               ondelete="CASCADE", onupdate="CASCADE"),)
+
+        message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+        guild_id = Column(BigInteger, nullable=False)
+        channel_id = Column(BigInteger, nullable=False)
+        inviter_id = Column(BigInteger, nullable=False)
+        member_id = Column(BigInteger, nullable=False)
+        company_name = Column(Name, nullable=False)
+        expires_at = Column(DateTime, nullable=False)
+
+    class SchemaVersion(Base):
+        """Migrations applied to the schema, see migrations.py"""
+        __tablename__ = "schema_version"
+
+        version = Column(Integer, primary_key=True, autoincrement=False)
+        description = Column(String(100), nullable=False)
+        applied_at = Column(DateTime, nullable=False)
+
+    class Survey(Base):
+        """Progress of a Company creation survey, step is the index of the next question or -1 when completed"""
+        __tablename__ = "surveys"
+
+        channel_id = Column(BigInteger, primary_key=True, autoincrement=False)
+        member_id = Column(BigInteger, nullable=False)
+        step = Column(Integer, nullable=False)
+        answers = Column(Text, nullable=False)  # JSON list of the answers given
+
+    class RoleJob(Base):
+        """Faction roles being added to or removed from all members of a Company in the background"""
+        __tablename__ = "role_jobs"
+
+        id = Column(Integer, primary_key=True, autoincrement=True)
+        guild_id = Column(BigInteger, nullable=False)
+        action = Column(String(10), nullable=False)  # 'add' or 'remove'
+        company_name = Column(Name, nullable=False)
+        faction = Column(String(50), nullable=False)
+        total = Column(Integer, nullable=False)
+        channel_id = Column(BigInteger, nullable=False)
+        message_id = Column(BigInteger)
+        members = relationship("RoleJobMember", cascade="all, delete-orphan", passive_deletes=True)
+
+    class RoleJobMember(Base):
+        __tablename__ = "role_job_members"
+
+        job_id = Column(Integer, ForeignKey("role_jobs.id", ondelete="CASCADE"), primary_key=True)
+        member_id = Column(BigInteger, primary_key=True)
+        done = Column(Boolean, nullable=False, default=False)
 
     def create_tables(self):
+        tables = inspect(self.engine).get_table_names()
+        # upgrade creates schema_version before migrating, companies may have been renamed by an interrupted migration
+        fresh = 'companies' not in tables and 'schema_version' not in tables
+        if not fresh:
+            # The new tables may reference the columns that the migrations add to the existing ones
+            migrations.upgrade(self, fresh)
         self.Base.metadata.create_all(self.engine)
+        if fresh:
+            migrations.upgrade(self, fresh)
+        migrations.check_lookup_indexes(self)
+
+
+def run_in_executor(func):
+    """Decorator that turns a blocking method of a cog into a coroutine executed in the database thread pool"""
 
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await self.bot.db.run(func, self, *args, **kwargs)
+    return wrapper
 
-@event.listens_for(Pool, "checkout")
-def check_connection(dbapi_con, con_record, con_proxy):
-    """Listener for Pool checkout events that pings every connection before using.
-    Implements pessimistic disconnect handling strategy. See also:
-    http://docs.sqlalchemy.org/en/rel_0_8/core/pooling.html#disconnect-handling-pessimistic"""
-
-    cursor = dbapi_con.cursor()
-    try:
-        cursor.execute("SELECT 1")  # could also be dbapi_con.ping(),
-    except OperationalError as ex:
-        if ex.args[0] in (2006,  # MySQL server has gone away
-                          2013,  # Lost connection to MySQL server during query
-                          2055):  # Lost connection to MySQL server at '%s', system error: %d
-            # caught by pool, which will retry with a new connection
-            raise DisconnectionError()
-        else:
-            raise
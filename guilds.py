@@ -0,0 +1,66 @@
+import logging
+
+import discord
+
+SPECIAL_ROLES = ('connect_to_voice', 'approve_companies', 'view_voice_channels', 'view_voice_channels_2',
+                 'governatore', 'console', 'to_remove', 'to_add')
+
+
+def get_guild_section(cfg, guild_id, section) -> dict:
+    """Returns a section of the config as it applies to the guild: the top level section with the values set for the
+    guild in [Guilds] replacing the defaults. A guild with its own Factions doesn't inherit the default ones."""
+    values = dict(cfg[section])
+    override = cfg['Guilds'].get(str(guild_id), {}).get(section)
+    if override:
+        if section == 'Factions':
+            values = dict(override)
+        else:
+            values.update(override)
+    return values
+
+
+class GuildConfig:
+    """Roles and channels of a guild, resolved from the config and the guild cache when the bot connects and when
+    the config changes, see CompaniesClient.load_guild_configs"""
+    __slots__ = ('guild_id', 'roles', 'faction_roles', 'factions', 'survey_category_id', 'apply_channel_id',
+                 'user_command_channel_id', 'username_channel_id')
+
+    def __init__(self, cfg, guild: discord.Guild):
+        self.guild_id = guild.id
+
+        roles_sec = get_guild_section(cfg, guild.id, 'SpecialRoles')
+        self.roles = {key: guild.get_role(roles_sec.get(key)) for key in SPECIAL_ROLES}
+        for key, role in self.roles.items():
+            if role is None:
+                logging.error(f"Il ruolo {key} non è stato configurato correttamente nel server {guild.id}")
+
+        # Faction name -> section with member_role, staff_role and emoji
+        self.factions = get_guild_section(cfg, guild.id, 'Factions')
+        self.faction_roles = {}
+        for faction, roles in self.factions.items():
+            staff_role = guild.get_role(roles['staff_role'])
+            if staff_role is None:
+                logging.error(f"Il ruolo staff della fazione {faction} non è stato configurato correttamente "
+                              f"nel server {guild.id}")
+            member_role = guild.get_role(roles['member_role'])
+            if member_role is None:
+                logging.error(f"Il ruolo membri della fazione {faction} non è stato configurato correttamente "
+                              f"nel server {guild.id}")
+            self.faction_roles[faction] = {'staff': staff_role, 'member': member_role}
+
+        channels_sec = get_guild_section(cfg, guild.id, 'Channels')
+        self.apply_channel_id = channels_sec.get('company_apply_channel')
+        self.user_command_channel_id = channels_sec.get('user_command_channel', '')
+        self.survey_category_id = get_guild_section(cfg, guild.id, 'CompanyCreationSurvey').get('category')
+        self.username_channel_id = get_guild_section(cfg, guild.id, 'Username').get('channel')
+
+
+def get_guild_override(cfg, guild_id, section):
+    """Returns the section of [Guilds] with the values of the guild, creating it if needed"""
+    guilds = cfg['Guilds']
+    if str(guild_id) not in guilds:
+        guilds[str(guild_id)] = {}
+    guild_sec = guilds[str(guild_id)]
+    if section not in guild_sec:
+        guild_sec[section] = {}
+    return guild_sec[section]
@@ -0,0 +1,50 @@
+import bisect
+
+
+class Leaderboard:
+    """Scores by key kept in ranking order, so that the top entries are read without sorting. Updated incrementally
+    on every change of a score, only positive scores are ranked.
+
+    rendered holds the embed of the top entries built by the caller, it is cleared whenever they change."""
+
+    def __init__(self, size, tiebreak=None):
+        self.size = size
+        # Orders the keys with the same score, highest first like the ORDER BY of the query that recomputes the
+        # ranking, which reads the index backwards
+        self.tiebreak = tiebreak if tiebreak is not None else (lambda key: key)
+        self.scores = dict()
+        # (score, tiebreak, key) tuples in ascending order, the top entries are at the end
+        self.ranking = []
+        self.rendered = None
+
+    def __len__(self):
+        return len(self.scores)
+
+    def entry(self, key):
+        return self.scores[key], self.tiebreak(key), key
+
+    def set(self, key, score):
+        changed = False
+        if key in self.scores:
+            i = bisect.bisect_left(self.ranking, self.entry(key))
+            changed = i >= len(self.ranking) - self.size
+            del self.ranking[i]
+            del self.scores[key]
+        if score > 0:
+            self.scores[key] = score
+            entry = self.entry(key)
+            i = bisect.bisect_left(self.ranking, entry)
+            self.ranking.insert(i, entry)
+            changed = changed or i >= len(self.ranking) - self.size
+        if changed:
+            self.rendered = None
+
+    def add(self, key, amount):
+        self.set(key, self.scores.get(key, 0) + amount)
+
+    def remove(self, key):
+        self.set(key, 0)
+
+    def top(self):
+        """Returns the (key, score) pairs of the top entries, highest score first"""
+        return [(key, score) for score, _, key in reversed(self.ranking[-self.size:])]
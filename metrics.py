@@ -0,0 +1,197 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Upper bounds in seconds of the latency histogram buckets, the last one catches everything
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# Invocation of the command or listener running in the current task, copied to the tasks it starts and to the
+# database threads by Database.run
+current_invocation = contextvars.ContextVar('current_invocation', default=None)
+
+
+class Invocation:
+    __slots__ = ('statements', 'db_time', 'http_calls')
+
+    def __init__(self):
+        self.statements = 0
+        # Seconds spent waiting for the database
+        self.db_time = 0.0
+        self.http_calls = 0
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket containing the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class HandlerStats:
+    """Totals of all the invocations of a command or listener"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.latency = Histogram()
+        self.statements = 0
+        self.db_time = 0.0
+        self.http_calls = 0
+
+
+class Metrics:
+    """Collects latency, SQL statements and Discord HTTP calls of every command and listener"""
+
+    def __init__(self):
+        self.handlers = dict()
+        # (command, outcome) -> number of invocations
+        self.outcomes = defaultdict(int)
+        self.statements = 0
+        self.http_calls = 0
+        self.lock = threading.Lock()
+
+    def track(self, kind, name):
+        return Tracker(self, kind, name)
+
+    def record(self, kind, name, elapsed, invocation: Invocation):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats(kind)
+        stats.latency.observe(elapsed)
+        stats.statements += invocation.statements
+        stats.db_time += invocation.db_time
+        stats.http_calls += invocation.http_calls
+
+    def count_outcome(self, command, outcome):
+        self.outcomes[(command, outcome)] += 1
+
+    def count_statement(self):
+        """Called from the database threads before every SQL statement"""
+        invocation = current_invocation.get()
+        with self.lock:
+            self.statements += 1
+            if invocation is not None:
+                invocation.statements += 1
+
+    def add_db_time(self, seconds):
+        invocation = current_invocation.get()
+        if invocation is not None:
+            invocation.db_time += seconds
+
+    def count_http_call(self):
+        self.http_calls += 1
+        invocation = current_invocation.get()
+        if invocation is not None:
+            invocation.http_calls += 1
+
+    def wrap_http(self, request):
+        """Wraps HTTPClient.request, which makes every call to the Discord API"""
+        @functools.wraps(request)
+        async def counted_request(*args, **kwargs):
+            self.count_http_call()
+            return await request(*args, **kwargs)
+        return counted_request
+
+    def render(self, gauges=None):
+        """Returns all the metrics in the Prometheus text format. gauges maps a metric name to its value, or to a dict
+        labels -> value"""
+        lines = ['# TYPE companies_handler_latency_seconds histogram']
+        for name, stats in sorted(self.handlers.items()):
+            labels = f'handler="{name}",kind="{stats.kind}"'
+            cumulative = 0
+            for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'companies_handler_latency_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'companies_handler_latency_seconds_sum{{{labels}}} {stats.latency.sum}')
+            lines.append(f'companies_handler_latency_seconds_count{{{labels}}} {stats.latency.count}')
+
+        lines.append('# TYPE companies_handler_sql_statements_total counter')
+        for name, stats in sorted(self.handlers.items()):
+            lines.append(f'companies_handler_sql_statements_total{{handler="{name}"}} {stats.statements}')
+        lines.append('# TYPE companies_handler_db_seconds_total counter')
+        for name, stats in sorted(self.handlers.items()):
+            lines.append(f'companies_handler_db_seconds_total{{handler="{name}"}} {stats.db_time}')
+        lines.append('# TYPE companies_handler_discord_requests_total counter')
+        for name, stats in sorted(self.handlers.items()):
+            lines.append(f'companies_handler_discord_requests_total{{handler="{name}"}} {stats.http_calls}')
+
+        lines.append('# TYPE companies_command_outcomes_total counter')
+        for (command, outcome), count in sorted(self.outcomes.items()):
+            lines.append(f'companies_command_outcomes_total{{command="{command}",outcome="{outcome}"}} {count}')
+
+        lines.append('# TYPE companies_sql_statements_total counter')
+        lines.append(f'companies_sql_statements_total {self.statements}')
+        lines.append('# TYPE companies_discord_requests_total counter')
+        lines.append(f'companies_discord_requests_total {self.http_calls}')
+        for name, value in (gauges or {}).items():
+            lines.append(f'# TYPE {name} gauge')
+            if isinstance(value, dict):
+                lines.extend(f'{name}{{{labels}}} {series}' for labels, series in value.items())
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, gauges=None):
+        """Replaces the file atomically, so that the scraper never reads a partial file"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render(gauges))
+        os.replace(tmp_path, path)
+
+
+class Tracker:
+    """Context manager measuring one invocation of a command or listener"""
+
+    def __init__(self, metrics, kind, name):
+        self.metrics = metrics
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.parent = current_invocation.get()
+        self.invocation = Invocation()
+        self.token = current_invocation.set(self.invocation)
+        self.start = time.perf_counter()
+        return self.invocation
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        current_invocation.reset(self.token)
+        self.metrics.record(self.kind, self.name, elapsed, self.invocation)
+        # A nested invocation is also part of the one that contains it
+        if self.parent is not None:
+            self.parent.statements += self.invocation.statements
+            self.parent.db_time += self.invocation.db_time
+            self.parent.http_calls += self.invocation.http_calls
+        return False
+
+
+def instrumented(func):
+    """Decorator for cog listeners, measures each call in the bot metrics"""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with self.bot.metrics.track('listener', func.__qualname__):
+            return await func(self, *args, **kwargs)
+    return wrapper
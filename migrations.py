@@ -0,0 +1,249 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import LargeBinary, and_, cast, inspect, exists
+
+# Versioned schema changes for databases created by older releases of the bot, applied in order at startup.
+# New databases are created by create_all with the latest schema and are stamped with the last version, so every
+# change to the models that create_all can't apply to an existing table needs a migration here.
+# Migrations must be safe to run on a schema that already has the change. On an existing database they run before
+# create_all, since the new tables may reference columns that they add: they only change the tables that exist, the
+# missing ones are then created by create_all with the latest schema.
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def has_table(con, table):
+    return table in inspect(con).get_table_names()
+
+
+def get_columns(con, table):
+    return [column['name'] for column in inspect(con).get_columns(table)]
+
+
+def add_column(con, table, column, ddl_type):
+    if column not in get_columns(con, table):
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+
+
+def add_index(db, con, table, column):
+    """Creates the index declared on the model for the column, unless the column is already indexed"""
+    for index in inspect(con).get_indexes(table):
+        if index['column_names'] == [column]:
+            return
+    for index in db.Base.metadata.tables[table].indexes:
+        if [col.name for col in index.columns] == [column]:
+            index.create(con)
+            return
+    raise ValueError(f"No index declared for {table}.{column}")
+
+
+@migration(1, "Add companies.notify_channel_id")
+def add_notify_channel(db, con):
+    add_column(con, 'companies', 'notify_channel_id', 'BIGINT')
+
+
+@migration(2, "Index the lookup columns of requests and users")
+def add_lookup_indexes(db, con):
+    for column in ('name', 'tag', 'approve_message_id', 'approve_channel_id'):
+        add_index(db, con, 'requests', column)
+    add_index(db, con, 'users', 'company_name')
+
+
+def rebuild_pending(con, table, column):
+    """Returns True if the table has to be rebuilt to add the column, or if its rebuild was interrupted"""
+    if has_table(con, f"{table}_old"):
+        return True
+    return has_table(con, table) and column not in get_columns(con, table)
+
+
+def rebuild_table(db, con, table, values: dict):
+    """Recreates the table with the schema of its model and copies the rows, for the changes that ALTER TABLE can't
+    make on every backend, like the primary key. values maps the new columns to the SQL expression that fills them.
+    Foreign key checks must be disabled, see set_foreign_key_checks.
+
+    DDL statements are not rolled back with the migration: MySQL commits before each one and SQLite runs them
+    outside the transaction, which only starts with the copy. A rebuild interrupted after the rename is resumed
+    from the rows left in the renamed table."""
+    old_table = f"{table}_old"
+    if not has_table(con, old_table):
+        con.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    if con.dialect.name == 'sqlite':
+        # Index names are unique in the whole SQLite database, they move to the renamed table
+        for index in inspect(con).get_indexes(old_table):
+            con.execute(f"DROP INDEX {index['name']}")
+    model_table = db.Base.metadata.tables[table]
+    if not has_table(con, table):
+        model_table.create(con)
+    # The copy is a single statement, the new table has rows only if an interrupted rebuild completed it
+    if con.execute(f"SELECT COUNT(*) FROM {table}").scalar() == 0:
+        copied = [column for column in get_columns(con, old_table) if column in model_table.columns]
+        con.execute(f"INSERT INTO {table} ({', '.join(copied + list(values.keys()))}) "
+                    f"SELECT {', '.join(copied + list(values.values()))} FROM {old_table}")
+    con.execute(f"DROP TABLE {old_table}")
+
+
+def set_foreign_key_checks(con, enabled: bool):
+    if con.dialect.name == 'sqlite':
+        # Without legacy_alter_table renaming a table would also rename the references to it in the other tables
+        con.execute(f"PRAGMA foreign_keys = {'ON' if enabled else 'OFF'}")
+        con.execute(f"PRAGMA legacy_alter_table = {'OFF' if enabled else 'ON'}")
+    elif con.dialect.name == 'mysql':
+        con.execute(f"SET FOREIGN_KEY_CHECKS = {1 if enabled else 0}")
+
+
+@migration(3, "Add requests.abort_message_id")
+def add_abort_message(db, con):
+    add_column(con, 'requests', 'abort_message_id', 'BIGINT')
+
+
+@migration(4, "Scope the Company data by guild_id")
+def add_guild_id(db, con):
+    # Until now the bot served only its first guild, all the existing data belongs to it
+    guild_id = db.bot.guilds[0].id if len(db.bot.guilds) > 0 else 0
+    logging.info(f"Assigning the existing Companies to guild {guild_id}")
+    # Referenced tables first, so that the new foreign keys point to the new tables
+    for table in ('companies', 'users', 'requests', 'invites'):
+        if rebuild_pending(con, table, 'guild_id'):
+            rebuild_table(db, con, table, {'guild_id': str(guild_id)})
+    if has_table(con, 'role_jobs') and 'guild_id' not in get_columns(con, 'role_jobs'):
+        add_column(con, 'role_jobs', 'guild_id', 'BIGINT NOT NULL DEFAULT 0')
+        con.execute(f"UPDATE role_jobs SET guild_id = {guild_id}")
+
+
+@migration(5, "Reserve the names and tags of the existing Companies and requests")
+def reserve_company_names(db, con):
+    reserved = db.Base.metadata.tables['company_names']
+    reserved.create(con, checkfirst=True)
+    names = set()
+    tags = set()
+    for guild_id, name, tag in con.execute("SELECT guild_id, name, tag FROM company_names").fetchall():
+        names.add((guild_id, name.lower()))
+        tags.add((guild_id, tag.lower()))
+
+    rows = []
+    # Companies first, a request that clashes with a Company could never be approved anyway
+    for table in ('companies', 'requests'):
+        for guild_id, name, tag in con.execute(f"SELECT guild_id, name, tag FROM {table}").fetchall():
+            if (guild_id, name.lower()) in names or (guild_id, tag.lower()) in tags:
+                if table == 'requests':
+                    logging.warning(f"Request for Company {name} [{tag}] clashes with another Company or request, "
+                                    f"it won't be approved")
+                continue
+            names.add((guild_id, name.lower()))
+            tags.add((guild_id, tag.lower()))
+            rows.append({'guild_id': guild_id, 'name': name, 'tag': tag})
+    if len(rows) > 0:
+        con.execute(reserved.insert(), rows)
+
+
+@migration(6, "Index the leaderboard rankings")
+def add_leaderboard_indexes(db, con):
+    for table, name in (('users', 'ix_users_donations'), ('companies', 'ix_companies_balance')):
+        if name not in [index['name'] for index in inspect(con).get_indexes(table)]:
+            next(index for index in db.Base.metadata.tables[table].indexes if index.name == name).create(con)
+
+
+@migration(7, "Stop generating the ids of invites and surveys, they are the ids of Discord messages and channels")
+def drop_discord_id_autoincrement(db, con):
+    # A single BIGINT primary key was created with AUTO_INCREMENT on MySQL, SQLite has nothing to change
+    if con.dialect.name == 'mysql':
+        for table, column in (('invites', 'message_id'), ('surveys', 'channel_id')):
+            if has_table(con, table):
+                con.execute(f"ALTER TABLE {table} MODIFY {column} BIGINT NOT NULL")
+
+
+@migration(8, "Add requests.created_at")
+def add_request_created_at(db, con):
+    # The requests copied by the rebuild of migration 4 already have it, with the default of the model: they come
+    # from a release that served a single guild from a single process, nothing can be completing them
+    if 'created_at' not in get_columns(con, 'requests'):
+        # Other processes of the bot may be completing the existing requests, they count as created now
+        add_column(con, 'requests', 'created_at', "DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'")
+        con.execute(f"UPDATE requests SET created_at = '{datetime.utcnow():%Y-%m-%d %H:%M:%S}'")
+
+
+def upgrade(db, fresh: bool):
+    """Brings the schema to the last version, fresh must be True if the tables have just been created"""
+    version_model = db.SchemaVersion
+    version_model.__table__.create(db.engine, checkfirst=True)
+    session = db.Session()
+    current = session.query(version_model.version).order_by(version_model.version.desc()).limit(1).scalar() or 0
+    session.close()
+
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+        if fresh:
+            logging.info(f"Schema created at version {version}: {description}")
+        else:
+            logging.info(f"Migrating schema to version {version}: {description}")
+            with db.engine.connect() as con:
+                # SQLite ignores the change of foreign_keys inside a transaction
+                set_foreign_key_checks(con, False)
+                try:
+                    with con.begin():
+                        func(db, con)
+                finally:
+                    set_foreign_key_checks(con, True)
+
+        session = db.Session()
+        session.add(version_model(version=version, description=description, applied_at=datetime.utcnow()))
+        session.commit()
+        session.close()
+
+
+def get_lookups(db):
+    """Representative statements of the lookups done by CompanyManager on each command"""
+    user, company, request = db.User, db.Company, db.CompanyRequest
+    session = db.Session()
+    lookups = {
+        'company by member': session.query(user.company_name).filter_by(guild_id=0, member_id=0),
+        'company by name': session.query(company.tag, company.role, company.faction).filter_by(guild_id=0, name=''),
+        'company members': session.query(company.category_id, user.member_id).outerjoin(company.members)
+                                  .filter(company.guild_id == 0, company.name == ''),
+        'company name exists': session.query(exists().where(and_(company.guild_id == 0, company.name == ''))),
+        'request by member': session.query(request.name).filter_by(guild_id=0, member_id=0),
+        'top donors': session.query(user.member_id, user.company_donations)
+                             .filter(user.guild_id == 0, user.company_name == '', user.company_donations > 0)
+                             .order_by(user.company_donations.desc(), user.member_id.desc()).limit(10),
+        'top companies': session.query(company.name, company.balance)
+                                .filter(company.guild_id == 0, company.balance > 0)
+                                .order_by(company.balance.desc(), cast(company.name, LargeBinary).desc())
+                                .limit(10),
+        'request by message': session.query(request.member_id).filter_by(approve_message_id=0),
+        'request by channel': session.query(request.member_id).filter_by(approve_channel_id=0),
+    }
+    session.close()
+    return lookups
+
+
+def check_lookup_indexes(db):
+    """Runs EXPLAIN on every lookup and logs the index it uses, warning about the ones that scan a whole table"""
+    dialect = db.engine.dialect.name
+    if dialect not in ('mysql', 'sqlite'):
+        logging.info(f"Lookup index check not supported on {dialect}, skipping it")
+        return
+    with db.engine.connect() as con:
+        for name, query in get_lookups(db).items():
+            sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+            if dialect == 'mysql':
+                rows = con.execute("EXPLAIN " + sql).fetchall()
+                scans = [row['table'] for row in rows if row['type'] == 'ALL']
+                keys = [f"{row['table']}.{row['key']}" for row in rows if row['key'] is not None]
+            else:
+                # Each row describes a step of the plan, like 'SEARCH requests USING INDEX ix_requests_name (name=?)'
+                steps = [row['detail'].split() for row in con.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+                scans = [step[-1] for step in steps
+                         if step[0] == 'SCAN' and 'USING' not in step and step[1] != 'CONSTANT']
+                keys = [f"{step[1]}.{step[step.index('INDEX') + 1]}" for step in steps if 'INDEX' in step]
+            if len(scans) > 0:
+                logging.warning(f"Lookup '{name}' scans the whole table {', '.join(scans)}")
+            else:
+                logging.info(f"Lookup '{name}' uses indexes {', '.join(keys) or '-'}")
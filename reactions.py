@@ -0,0 +1,30 @@
+import discord
+
+
+class ReactionRouter:
+    """Sends the reactions added to the messages the bot is waiting on to their handler: approval messages, survey
+    abort messages and recruit invites. Any other reaction is dropped with a single lookup."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        # message_id -> coroutine function called with the RawReactionActionEvent
+        self.handlers = dict()
+        self.seen = 0
+        self.handled = 0
+
+    def register(self, message_id, handler):
+        self.handlers[message_id] = handler
+
+    def unregister(self, *message_ids):
+        for message_id in message_ids:
+            self.handlers.pop(message_id, None)
+
+    async def dispatch(self, payload: discord.RawReactionActionEvent):
+        self.seen += 1
+        handler = self.handlers.get(payload.message_id)
+        if handler is None:
+            return
+
+        self.handled += 1
+        with self.metrics.track('reaction', handler.__qualname__):
+            await handler(payload)
@@ -0,0 +1,56 @@
+import logging
+
+import discord
+
+# Sentinel for edits that must leave the nickname as it is, None resets it
+UNCHANGED = object()
+
+
+class RoleEditor:
+    """Applies all role and nickname changes of an operation on a member with a single member.edit call,
+    instead of one add_roles, remove_roles and edit call each"""
+
+    def __init__(self):
+        self.edits = 0
+        self.calls = 0
+        self.calls_saved = 0
+
+    def compute_roles(self, member: discord.Member, add=(), remove=()):
+        """Returns the roles the member will have after the change"""
+        remove = {role for role in remove if role is not None}
+        roles = [role for role in member.roles if not role.is_default() and role not in remove]
+        for role in add:
+            if role is not None and role not in roles:
+                roles.append(role)
+        return roles
+
+    async def edit(self, member: discord.Member, add=(), remove=(), nick=UNCHANGED):
+        """Adds and removes the given roles and changes the nickname of the member. Roles that are None, because
+        they are not configured, are ignored and the nickname of the guild owner is never touched.
+        Returns the number of HTTP calls made."""
+        # Calls that would have been made with separate add_roles, remove_roles and edit(nick=...)
+        separate_calls = int(len(add) > 0) + int(len(remove) > 0) + int(nick is not UNCHANGED)
+        self.edits += 1
+
+        roles = self.compute_roles(member, add, remove)
+        if member.guild.owner_id == member.id or nick == member.nick:
+            nick = UNCHANGED
+        if set(roles) == {role for role in member.roles if not role.is_default()} and nick is UNCHANGED:
+            self.calls_saved += separate_calls
+            return 0
+
+        calls = 1
+        try:
+            if nick is UNCHANGED:
+                await member.edit(roles=roles)
+            else:
+                try:
+                    await member.edit(roles=roles, nick=nick)
+                except discord.Forbidden:
+                    logging.warning("Can't modify username of " + member.display_name)
+                    calls += 1
+                    await member.edit(roles=roles)
+        finally:
+            self.calls += calls
+            self.calls_saved += max(separate_calls - calls, 0)
+        return calls
@@ -0,0 +1,104 @@
+import re
+from datetime import timedelta
+from string import Formatter
+from types import MappingProxyType
+
+import discord
+
+
+class MessageTemplate:
+    """A [Messages] value parsed once, formatting it only joins the literal text with the given values"""
+    __slots__ = ('raw', 'parts', 'static')
+
+    def __init__(self, raw: str):
+        self.raw = raw
+        # Literal text and field names alternated, None if the template uses format specs or attribute access
+        self.parts = []
+        literals = ''
+        for literal, field, spec, conversion in Formatter().parse(raw):
+            # Escaped braces split the literal text in more pieces
+            literals += literal
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                self.parts = None
+                break
+            self.parts.extend((literals, field))
+            literals = ''
+        else:
+            self.parts.append(literals)
+        # The message itself if it has no fields
+        self.static = self.parts[0] if self.parts is not None and len(self.parts) == 1 else None
+
+    def format(self, **kwargs):
+        if self.static is not None:
+            return self.static
+        if self.parts is None:
+            return self.raw.format(**kwargs)
+        parts = self.parts
+        return ''.join([parts[i] if i % 2 == 0 else format(kwargs[parts[i]], '') for i in range(len(parts))])
+
+
+class PatternSet:
+    """Regexes compiled once, a name is checked against all of them with a single search when they can be combined"""
+    __slots__ = ('patterns', 'combined')
+
+    def __init__(self, patterns: dict):
+        self.patterns = tuple((name, re.compile(regex)) for name, regex in patterns.items() if regex != '')
+        self.combined = None
+        # Groups would be renumbered in the combined regex, breaking backreferences
+        if len(self.patterns) > 1 and all(regex.groups == 0 for _, regex in self.patterns):
+            try:
+                self.combined = re.compile('|'.join(f'(?:{regex.pattern})' for _, regex in self.patterns))
+            except re.error:
+                pass
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+
+    def match(self, text):
+        """Returns the names of the patterns found in the text"""
+        if self.combined is not None and self.combined.search(text) is None:
+            return []
+        return [name for name, regex in self.patterns if regex.search(text) is not None]
+
+
+class Settings:
+    """Immutable snapshot of the settings read by the listeners and commands on every call, built from the config.
+    Changes to the config are applied by building a new snapshot, see CompaniesClient.reload_settings.
+    The roles and channels of each guild are in its GuildConfig."""
+    __slots__ = ('emoji_check', 'emoji_cross', 'reaction_emojis', 'survey_questions', 'survey_first_message',
+                 'survey_last_message', 'username_patterns', 'username_alert_window', 'invite_expiry', 'messages',
+                 'success_embeds', 'error_embeds', 'survey_embeds')
+
+    def __init__(self, cfg):
+        set_ = super().__setattr__
+        set_('emoji_check', cfg['Emoji']['check'])
+        set_('emoji_cross', cfg['Emoji']['cross'])
+        set_('reaction_emojis', frozenset((self.emoji_check, self.emoji_cross)))
+
+        survey_sec = cfg['CompanyCreationSurvey']
+        set_('survey_questions', tuple(survey_sec['questions']))
+        set_('survey_first_message', survey_sec['first_message'])
+        set_('survey_last_message', survey_sec['last_message'])
+        set_('survey_embeds', MappingProxyType({
+            text: discord.Embed(color=discord.Colour.gold(), description=text)
+            for text in (self.survey_first_message, self.survey_last_message, *self.survey_questions)}))
+
+        username_sec = cfg['Username']
+        set_('username_patterns', PatternSet({'regex': username_sec.get('regex', ''),
+                                              **username_sec.get('Patterns', {})}))
+        set_('username_alert_window', username_sec['alert_window'])
+        set_('invite_expiry', timedelta(hours=cfg['Invites']['expiry']))
+
+        messages = {name: MessageTemplate(raw) for name, raw in cfg['Messages'].items()}
+        set_('messages', MappingProxyType(messages))
+        set_('success_embeds', MappingProxyType({
+            name: discord.Embed(color=discord.Colour.green(), description=template.static)
+            for name, template in messages.items() if template.static is not None}))
+        set_('error_embeds', MappingProxyType({
+            name: discord.Embed(color=discord.Colour.red(), description=template.static)
+            for name, template in messages.items() if template.static is not None}))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable, build a new snapshot")
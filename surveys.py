@@ -0,0 +1,76 @@
+import json
+
+# Step of a survey whose questions have all been answered, waiting for the staff approval
+COMPLETED = -1
+
+
+class Survey:
+    __slots__ = ('member_id', 'step', 'answers')
+
+    def __init__(self, member_id, step, answers):
+        self.member_id = member_id
+        # Index of the next question to send, COMPLETED when all the questions have been answered
+        self.step = step
+        self.answers = answers
+
+
+class SurveyMachine:
+    """Company creation surveys by channel id. A survey is answering until it receives the answer to the last
+    question, then it is completed until its channel is deleted.
+
+    active holds the channels of the answering surveys only, every other message is skipped with one set lookup.
+    Changes are collected in changed and deleted and saved to the database in batches, see User.save_surveys."""
+
+    def __init__(self):
+        self.surveys = dict()
+        self.active = set()
+        self.changed = set()
+        self.deleted = set()
+
+    def load(self, rows):
+        for channel_id, member_id, step, answers in rows:
+            self.surveys[channel_id] = Survey(member_id, step, json.loads(answers))
+            if step != COMPLETED:
+                self.active.add(channel_id)
+
+    def start(self, channel_id, member_id):
+        """Starts the survey of a new request channel, where the first question has already been sent"""
+        self.surveys[channel_id] = Survey(member_id, 1, [])
+        self.active.add(channel_id)
+        self.changed.add(channel_id)
+
+    def answer(self, channel_id, content, questions: int) -> int:
+        """Records the answer to the last question sent. Returns the index of the next question to send, or
+        COMPLETED if it was the last one"""
+        survey = self.surveys[channel_id]
+        survey.answers.append(content)
+        self.changed.add(channel_id)
+        if survey.step < questions:
+            survey.step += 1
+            return survey.step - 1
+
+        survey.step = COMPLETED
+        self.active.discard(channel_id)
+        return COMPLETED
+
+    def end(self, channel_id):
+        """Forgets the survey of a request channel that has been deleted"""
+        self.active.discard(channel_id)
+        if self.surveys.pop(channel_id, None) is not None:
+            self.changed.discard(channel_id)
+            self.deleted.add(channel_id)
+
+    def pop_changes(self):
+        """Returns the rows of the changed surveys and the channel ids of the deleted ones, clearing them"""
+        changed = [{'channel_id': channel_id, 'member_id': self.surveys[channel_id].member_id,
+                    'step': self.surveys[channel_id].step, 'answers': json.dumps(self.surveys[channel_id].answers)}
+                   for channel_id in self.changed]
+        deleted = list(self.deleted)
+        self.changed.clear()
+        self.deleted.clear()
+        return changed, deleted
+
+    def restore_changes(self, changed, deleted):
+        """Marks again the changes returned by pop_changes, when they could not be saved"""
+        self.changed.update(survey['channel_id'] for survey in changed if survey['channel_id'] in self.surveys)
+        self.deleted.update(deleted)
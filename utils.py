@@ -0,0 +1,13 @@
+import asyncio
+
+
+async def gather_limited(limit: int, *aws, return_exceptions=False):
+    """Like asyncio.gather, but runs at most limit awaitables at the same time.
+    Used to fan out Discord API calls without bursting into the rate limits."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=return_exceptions)